@@ -7,6 +7,8 @@ import argparse
 import numpy as np
 import os
 
+import instrument
+
 
 # === FUNCTION: Parsing command line arguments
 def _parse():
@@ -50,6 +52,16 @@ def _parse():
 
     parser.add_argument('--test', help = 'Just for debugging: check the output of deconvolution applied directly to the computer-generated sinesweep', action='store_true')
 
+    #--- streaming record engine
+    parser.add_argument('--stream', help = 'Record with the block-wise streaming engine: the recording is written to disk as it arrives instead of kept in memory', action='store_true')
+
+    parser.add_argument('--store', type = str, help = 'Save the measurements in this compressed session file (one group per measurement) instead of recorded/newrirN directories', default = None)
+
+    parser.add_argument("-bs", "--blocksize", type = int, help = "Block size of the streaming engine, in samples. Default: 2048.", default = 2048)
+
+    #--- stage timing
+    instrument.add_arguments(parser)
+
 
     args = parser.parse_args()
 
@@ -1,29 +1,264 @@
 import soundfile as sf
 import numpy as np
-from scipy.signal import correlate
+from scipy.signal import correlate, resample_poly
+from scipy import fft as sp_fft
+from numpy.lib.stride_tricks import sliding_window_view
 import argparse
-import librosa
 import json
 import matplotlib.pyplot as plt
+import os
+import tempfile
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-from deconvolve import replace_extension
+from deconvolve import replace_extension, read_sweep_params, get_stimulus
+from convolution import IRConvolver
+import audio_io
+import instrument
 
 
 def read_audio(file_path, sample_rate, num_channel=1):
-    audio_data, sample_rate = librosa.load(file_path, sr=sample_rate, mono=False)
+    return audio_io.read_audio(file_path, sample_rate, channel=num_channel)
+
+def select_channel(audio_data, num_channel):
+    # Multichannel audio from audio_io.read_audio(mono=False) is (samples, channels), mono audio is kept as is
     if len(audio_data.shape) > 1:
-        audio_data = audio_data[num_channel]
-    return audio_data, sample_rate
+        audio_data = audio_data[:, num_channel]
+    return audio_data
+
+def correlate_lags(audio1, audio2, min_lag, max_lag, block_size=None):
+    """
+    Cross-correlation restricted to the lags min_lag..max_lag (both included).
+
+    Uses the lag convention of find_delay: c[d - min_lag] = sum_n audio1[n + d] * audio2[n], so the
+    result equals correlate(audio1, audio2, mode='full')[d + len(audio2) - 1] for those lags. audio2
+    is split into blocks and each block is correlated with the matching stretch of audio1 through
+    an FFT of about block_size + (max_lag - min_lag) samples, so the cost grows with the lag range
+    instead of with the length of the signals.
+    """
+    num_lags = max_lag - min_lag + 1
+    block_size = block_size or max(num_lags, 4096)
+    nfft = sp_fft.next_fast_len(block_size + num_lags - 1, real=True)
+    num_blocks = int(np.ceil(len(audio2) / block_size))
+
+    # padded1[i] = audio1[i + min_lag], zero outside audio1
+    padded1 = np.zeros(num_blocks * block_size + num_lags - 1, dtype=audio1.dtype)
+    first = max(min_lag, 0)
+    last = min(len(audio1), min_lag + len(padded1))
+    if last > first:
+        padded1[first - min_lag:last - min_lag] = audio1[first:last]
+    padded2 = np.zeros(num_blocks * block_size, dtype=audio2.dtype)
+    padded2[:len(audio2)] = audio2
+
+    segments1 = sliding_window_view(padded1, block_size + num_lags - 1)[::block_size]
+    blocks2 = padded2.reshape(num_blocks, block_size)
 
-def find_delay(audio1, audio2):
-    correlated = correlate(audio1, audio2, mode='full', method='auto')
-    delay = np.argmax(correlated) - len(audio2) + 1
-    return delay
+    correlated = np.zeros(num_lags)
+    # A bounded number of blocks is transformed at a time to cap the memory
+    step = max(1, 2**22 // nfft)
+    for start in range(0, num_blocks, step):
+        spectra = sp_fft.rfft(segments1[start:start + step], nfft, axis=1)
+        spectra *= np.conj(sp_fft.rfft(blocks2[start:start + step], nfft, axis=1))
+        correlated += sp_fft.irfft(np.sum(spectra, axis=0), nfft)[:num_lags]
+    return correlated
+
+def _parabolic_peak(correlated, index):
+    # Sub-sample position of the peak from a parabola through the peak and its neighbours
+    if index <= 0 or index >= len(correlated) - 1:
+        return float(index)
+    y0, y1, y2 = correlated[index - 1], correlated[index], correlated[index + 1]
+    denominator = y0 - 2 * y1 + y2
+    if denominator == 0:
+        return float(index)
+    return index + 0.5 * (y0 - y2) / denominator
+
+@instrument.traced('correlate')
+def find_delay(audio1, audio2, max_lag=None, decimation=1, subsample=False):
+    """
+    Finds the lag of audio2 in audio1 (audio1[n + delay] ~ audio2[n]).
+
+    With decimation > 1 the search is coarse-to-fine: both signals are decimated and correlated
+    (within +-max_lag if given), then the lag is refined at full rate only around the coarse peak.
+    Without decimation and max_lag this is the full cross-correlation.
+
+    :param max_lag: Maximum absolute lag in samples. Default: any lag.
+    :param decimation: Decimation factor of the coarse search. 1 disables it.
+    :param subsample: Refine the peak by parabolic interpolation and return a float.
+    """
+    if decimation <= 1:
+        if max_lag is None:
+            correlated = correlate(audio1, audio2, mode='full', method='auto')
+            min_lag = 1 - len(audio2)
+        else:
+            correlated = correlate_lags(audio1, audio2, -max_lag, max_lag)
+            min_lag = -max_lag
+    else:
+        # Coarse search on decimated signals
+        coarse1 = resample_poly(audio1, 1, decimation)
+        coarse2 = resample_poly(audio2, 1, decimation)
+        if max_lag is None:
+            coarse_delay = np.argmax(correlate(coarse1, coarse2, mode='full', method='auto')) - len(coarse2) + 1
+        else:
+            coarse_max_lag = int(np.ceil(max_lag / decimation))
+            coarse_delay = np.argmax(correlate_lags(coarse1, coarse2, -coarse_max_lag, coarse_max_lag)) - coarse_max_lag
 
-def align_audio(audio1, audio2):
-    delay = find_delay(audio1, audio2)
+        # Refine at full rate around the coarse peak
+        min_lag = coarse_delay * decimation - 2 * decimation
+        correlated = correlate_lags(audio1, audio2, min_lag, coarse_delay * decimation + 2 * decimation)
+
+    index = np.argmax(correlated)
+    if subsample:
+        return min_lag + _parabolic_peak(correlated, index)
+    return min_lag + index
+
+@instrument.traced('correlate')
+def align_segment(segment, chunk, offset, max_lag, block_size=None):
+    """
+    Finds the lag of a recorded chunk in an original segment, searching only +-max_lag around the
+    expected lag -offset (the chunk is expected to start offset samples before the segment).
+
+    The FFT length only depends on max_lag and block_size, so it is the same for every segment
+    and scipy.fft reuses its cached plan across segments.
+
+    :param segment: Original audio segment.
+    :param chunk: Recorded audio chunk, starting about offset samples before the segment.
+    :param offset: Expected start of the segment within the chunk, in samples.
+    :param max_lag: Maximum deviation from the expected lag, in samples.
+    :return: (delay, peak, confidence) with the find_delay lag convention, the correlation peak and
+             the peak normalized by the energy of the overlapping parts (1 for identical signals).
+    """
+    min_lag = -offset - max_lag
+    correlated = correlate_lags(segment, chunk, min_lag, -offset + max_lag, block_size)
+
+    # Lags without any overlap between the signals are not candidates
+    lags = np.arange(min_lag, min_lag + len(correlated))
+    correlated[(lags <= -len(chunk)) | (lags >= len(segment))] = -np.inf
+    index = np.argmax(correlated)
+    delay = int(min_lag + index)
+    peak = correlated[index]
 
+    if delay > 0:
+        overlap_segment, overlap_chunk = segment[delay:], chunk[:len(segment) - delay]
+    else:
+        overlap_segment, overlap_chunk = segment[:len(chunk) + delay], chunk[-delay:-delay + len(segment)]
+    energy = np.sqrt(np.sum(np.square(overlap_segment, dtype=np.float64)) * np.sum(np.square(overlap_chunk, dtype=np.float64)))
+    confidence = peak / energy if energy > 0 else 0.0
+    return delay, peak, confidence
+
+def sweep_matched_filter(sweep_params, sample_rate):
+    """
+    Matched filter of the sweep described by a sweep JSON file: its inverse filter at sample_rate.
+
+    The sweep is generated at its own rate and the inverse filter is resampled, so the filter still
+    matches sweeps that were resampled when they were concatenated.
+
+    :return: (IRConvolver of the inverse filter, position of the linear IR peak in the filtered output
+             of a sweep starting at sample 0, in samples at sample_rate).
+    """
+    testStimulus = get_stimulus(dict(sweep_params, reps=1))
+    fs = sweep_params['fs']
+    invfilter = audio_io.resample(testStimulus.invfilter, fs, sample_rate)
+    return IRConvolver(invfilter), testStimulus.linearIRStart * sample_rate / fs
+
+def locate_sweep(recorded_audio, matched_filter, peak_position, expected, search):
+    """
+    Locates a sweep in the recording, within +-search samples of its expected start.
+
+    :param matched_filter: (IRConvolver, peak position) from sweep_matched_filter.
+    :return: (start of the sweep in the recording with sub-sample precision, peak magnitude).
+    """
+    filter_length = len(matched_filter)
+    chunk_start = max(int(np.floor(expected)) - search, 0)
+    chunk = recorded_audio[chunk_start:int(np.ceil(expected)) + search + filter_length]
+    filtered = np.abs(matched_filter.convolve(chunk))
+
+    # Only peaks of sweeps starting within the search range are candidates
+    first = max(int(np.floor(expected - search + peak_position)) - chunk_start, 0)
+    last = min(int(np.ceil(expected + search + peak_position)) - chunk_start + 1, len(filtered))
+    if last <= first:
+        raise ValueError('The search range is outside the recording')
+    index = first + int(np.argmax(filtered[first:last]))
+    return chunk_start + _parabolic_peak(filtered, index) - peak_position, float(filtered[index])
+
+def fit_drift(original_positions, recorded_positions, tolerance, iterations=3):
+    """
+    Fits recorded = offset + rate * original to anchor positions, rejecting outliers.
+
+    Anchors further than max(tolerance, 3 robust standard deviations) from the fit are dropped and
+    the fit repeated. With a single anchor, only the offset is fitted.
+
+    :return: (offset, rate, boolean mask of the anchors kept).
+    """
+    original_positions = np.asarray(original_positions, dtype=np.float64)
+    recorded_positions = np.asarray(recorded_positions, dtype=np.float64)
+    inliers = np.ones(len(original_positions), dtype=bool)
+    for _ in range(iterations):
+        if np.sum(inliers) >= 2:
+            rate, offset = np.polyfit(original_positions[inliers], recorded_positions[inliers], 1)
+        else:
+            rate, offset = 1.0, np.median(recorded_positions[inliers] - original_positions[inliers])
+        residuals = recorded_positions - (offset + rate * original_positions)
+        sigma = 1.4826 * np.median(np.abs(residuals[inliers]))
+        kept = np.abs(residuals) <= max(tolerance, 3 * sigma)
+        if not kept.any() or np.array_equal(kept, inliers):
+            break
+        inliers = kept
+    return offset, rate, inliers
+
+@instrument.traced('drift')
+def estimate_drift(lines, recorded_audio_aligned, sweep_params, sample_rate, search, tolerance):
+    """
+    Estimates the clock drift of the recording from the sweeps listed in the JSONL lines.
+
+    Each sweep is located with the matched filter within +-search samples of the position predicted
+    from the sweeps found before it, so the drift may accumulate beyond search over the session.
+
+    :param recorded_audio_aligned: Recording after the global alignment, whose indices match those of the original.
+    :return: (offset, rate, anchors) with recorded index ~ offset + rate * original index, or None if
+             no sweep was found. anchors lists (original start, recorded start, peak, kept) per sweep.
+    """
+    matched_filter, peak_position = sweep_matched_filter(sweep_params, sample_rate)
+
+    original_positions, recorded_positions, peaks = [], [], []
+    offset, rate = 0.0, 1.0
+    for line in lines:
+        data = json.loads(line)
+        if not data.get('is_sweep'):
+            continue
+        if data.get('sample_rate') == sample_rate:
+            start = data['start_sample']
+        else:
+            start = int(data['start'] * sample_rate)
+        try:
+            position, peak = locate_sweep(recorded_audio_aligned, matched_filter, peak_position, offset + rate * start, search)
+        except ValueError:
+            continue
+        original_positions.append(start)
+        recorded_positions.append(position)
+        peaks.append(peak)
+        offset, rate, _ = fit_drift(original_positions, recorded_positions, tolerance)
+
+    if not original_positions:
+        return None
+    offset, rate, inliers = fit_drift(original_positions, recorded_positions, tolerance)
+    anchors = list(zip(original_positions, recorded_positions, peaks, inliers.tolist()))
+    return offset, rate, anchors
+
+# Default bound of the global alignment, in seconds. Recordings start within a few seconds of the
+# playback (call setup), so the bounded coarse search only rules out lags that can't happen
+GLOBAL_MAX_LAG = 30.0
+
+def global_max_lag_samples(global_max_lag, sample_rate):
+    """--global_max_lag in samples, None (any lag) if it is 0 or negative."""
+    if global_max_lag is None or global_max_lag <= 0:
+        return None
+    return int(global_max_lag * sample_rate)
+
+def align_audio(audio1, audio2, max_lag=None, decimation=4):
+    delay = int(round(find_delay(audio1, audio2, max_lag=max_lag, decimation=decimation)))
+    return trim_to_delay(audio1, audio2, delay)
+
+def trim_to_delay(audio1, audio2, delay):
     if delay > 0:
         audio1 = audio1[delay:]  # Trim the start of audio1
     else:
@@ -47,103 +282,220 @@ def parse_args():
     parser.add_argument('--plot', action='store_true', help='Generate plots')
     parser.add_argument('--basedir', type=str, default='.', help='Base input directory. Example: /data/audio/EXP28-tel/')
     parser.add_argument('--max_lag', type=float, default=0.25, help='Maximum lag in seconds')
-    return parser.parse_args()
+    parser.add_argument('--global_max_lag', type=float, default=GLOBAL_MAX_LAG, help=f'Maximum lag in seconds of the global alignment, i.e. how far apart the start of the recording and of the playback can be. 0 searches any lag, at the cost of a full-length correlation. Default: {GLOBAL_MAX_LAG}')
+    parser.add_argument('--decimation', type=int, default=4, help='Decimation factor of the coarse global alignment search (1 = full-rate correlation). Default: 4')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes aligning and writing segments. Default: 1')
+    parser.add_argument('--drift', action='store_true', help='Estimate the clock drift from the sweeps of the JSONL file and search each segment only --refine_lag around its predicted position. Requires --sweep_json')
+    parser.add_argument('--sweep_json', type=str, default=None, help='Sweep parameters of the sweeps in the JSONL file, as written by generate_sweep.py')
+    parser.add_argument('--refine_lag', type=float, default=0.005, help='Maximum lag in seconds around the drift prediction (with --drift). Default: 0.005')
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+    if args.drift and args.sweep_json is None:
+        parser.error('--drift requires --sweep_json')
+    return args
+    
+@instrument.traced('segment')
+def process_segment(n, line, original_audio, recorded_audio_aligned, recorded_length, args, drift=None):
+    """
+    Aligns and writes the segment described by one line of the JSONL file.
+
+    Log messages are returned rather than printed, so that segments processed in parallel can be
+    logged in file order.
+
+    :param n: Line number in the JSONL file.
+    :param line: The JSONL line.
+    :param recorded_length: Length of the recorded audio before the global alignment.
+    :param args: Parsed arguments (sample_rate, max_lag, basedir, output_dir, output_suffix, plot, refine_lag with drift).
+    :param drift: (offset, rate) from estimate_drift. The segment is then searched only args.refine_lag
+                  around its predicted position instead of args.max_lag around its original position.
+    :return: (log lines, result dict with filename, output, delay, max_corr, confidence and error).
+    """
+    log = []
+    SR = args.sample_rate
+    MAX_LAG = int(args.max_lag * SR) # fine-tune lag range 
+
+    result = {'line': n, 'filename': None, 'start': None, 'end': None, 'output': None,
+              'delay': None, 'max_corr': None, 'confidence': None, 'error': None}
+
+    try:      
+        # Parse the JSON object
+        data = json.loads(line)
+        if data.get("sample_rate") == SR:
+            # Exact sample positions written by concatenate_audio_files.py
+            start, end = data["start_sample"], data["end_sample"]
+        else:
+            start = int(data["start"]*SR)
+            end = int(data["end"]*SR)
+        result.update(filename=data['filename'], start=start, end=end)
+        # Load the long audio file
+        original_filename = data['filename']
+        if original_filename == "sweep.wav":
+            original_filename = "sweeps/" + replace_extension(original_filename, f"_{start}_{end}.wav")
+
+        original_audio_segment = original_audio[start:end]
+
+        if drift is not None:
+            expected = int(round(drift[0] + drift[1] * start))
+            lag = int(args.refine_lag * SR)
+        else:
+            expected, lag = start, MAX_LAG
+
+        recorded_audio_start = np.max([0, expected - lag])
+        recorded_audio_end = np.min([recorded_length, expected + (end - start) + lag])
+        recorded_audio_chunk = recorded_audio_aligned[recorded_audio_start:recorded_audio_end]
+        
+        log.append(f"Original audio segment: {start}:{end} (len: {len(original_audio_segment)})")
+        log.append(f"Recorded audio chunk: {recorded_audio_start}:{recorded_audio_end} (len: {len(recorded_audio_chunk)})")
+        
+        # Compute the cross-correlation only for lags within +-lag of the expected segment position
+        delay, max_corr, confidence = align_segment(original_audio_segment, recorded_audio_chunk, expected - recorded_audio_start, lag)
+        max_corr_index = delay + len(recorded_audio_chunk) - 1
+        
+        if delay > 0:
+            original_audio_segment = original_audio_segment[delay:]  # Trim the start of audio1
+        else:
+            recorded_audio_chunk = recorded_audio_chunk[-delay:]
+        
+        
+        output_filename = original_filename.replace(args.basedir, "")
+        output_filename = Path(args.output_dir) / output_filename
+        output_filename.parent.mkdir(parents=True, exist_ok=True)
+        output_filename = replace_extension(output_filename, args.output_suffix)
+        log.append(f"Output filename: {output_filename}")
+
+        with instrument.span('write'):
+            sf.write(output_filename, recorded_audio_chunk[:len(original_audio_segment)], SR)
+        result.update(output=str(output_filename), delay=delay, max_corr=float(max_corr), confidence=float(confidence))
+        
+        log.append(f"Filename: {data['filename']}, delay {max_corr_index}, max corr {max_corr}, confidence {confidence:.3f}, Start Index in Long Array: {delay}")
+        
+        if args.plot:
+            with instrument.span('plot'):
+                fig, axs = plt.subplots(3, 1, figsize=(12, 6), sharex=True)
+
+                # Plot audio1
+                axs[0].plot(original_audio_segment)
+                axs[0].set_title("Original audio segment")
+                axs[0].set_ylabel("Amplitude")
+                axs[0].grid()
+
+                # Plot audio2
+                axs[1].plot(recorded_audio_aligned[recorded_audio_start:recorded_audio_end])
+                axs[1].set_title("Recorded audio chunk")
+                axs[1].set_xlabel("Sample Index")
+                axs[1].set_ylabel("Amplitude")
+                axs[1].grid()
+
+                # Plot recovered recorded segment
+                axs[2].plot(recorded_audio_chunk[:len(original_audio_segment)])
+                axs[2].set_title(f"Recovered recorded segment (Start Index: {delay})")
+                axs[2].set_xlabel("Sample Index")
+                axs[2].set_ylabel("Amplitude")
+                axs[2].grid()
+
+                plt.tight_layout()
+                # plt.show()
+                plot_filename = replace_extension(output_filename, ".png")                
+                plt.savefig(plot_filename)
+                plt.close(fig)
+                log.append(f"Plot saved as: {plot_filename}")
     
+    except Exception as e:
+        log.append(f"Error processing line {n}: {e}")
+        result['error'] = str(e)
+
+    return log, result
+
+
+# Audio shared with the workers of align_segments, memory-mapped from a temporary directory
+_worker_audio = None
+
+def _load_shared(audio):
+    # Arrays are passed as .npy files, AudioReaders as they are
+    return np.load(audio, mmap_mode='r') if isinstance(audio, str) else audio
+
+def _init_worker(original_audio, recorded_audio_aligned, recorded_length, args, drift):
+    global _worker_audio
+    _worker_audio = (_load_shared(original_audio), _load_shared(recorded_audio_aligned), recorded_length, args, drift)
+
+def _process_segment_task(task):
+    original_audio, recorded_audio_aligned, recorded_length, args, drift = _worker_audio
+    return process_segment(task[0], task[1], original_audio, recorded_audio_aligned, recorded_length, args, drift)
+
+
+def align_segments(lines, original_audio, recorded_audio_aligned, recorded_length, args, jobs=1, drift=None):
+    """
+    Aligns and writes every segment listed in the JSONL lines.
+
+    With jobs > 1 the segments are processed by a pool of worker processes. Arrays are written once
+    to memory-mapped files that all workers map, instead of being copied to each of them, while
+    audio_io.AudioReader inputs are passed as they are and each worker reads only its segments.
+
+    :param drift: (offset, rate) from estimate_drift, see process_segment.
+    :return: Generator of process_segment results (log lines, result), in line order.
+    """
+    if jobs <= 1:
+        for n, line in enumerate(lines):
+            yield process_segment(n, line, original_audio, recorded_audio_aligned, recorded_length, args, drift)
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shared = []
+        for name, audio in (('original', original_audio), ('recorded', recorded_audio_aligned)):
+            if isinstance(audio, np.ndarray):
+                audio_file = os.path.join(tmpdir, name + '.npy')
+                np.save(audio_file, audio)
+                audio = audio_file
+            shared.append(audio)
+
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(*shared, recorded_length, args, drift)) as executor:
+            # map keeps the line order, whatever order the segments finish in
+            yield from executor.map(_process_segment_task, enumerate(lines), chunksize=4)
+
+
 def main():
     
     args = parse_args()
+    instrument.setup(args)
     
     SR = args.sample_rate
     
     original_audio, _ = read_audio(args.original, args.sample_rate, args.channel)
     recorded_audio, _ = read_audio(args.recorded, args.sample_rate, args.channel)
     
-    original_audio_aligned, recorded_audio_aligned = align_audio(original_audio, recorded_audio)
-    
-    MAX_LAG = int(args.max_lag * SR) # fine-tune lag range 
+    global_max_lag = global_max_lag_samples(args.global_max_lag, SR)
+    delay = int(round(find_delay(original_audio, recorded_audio, max_lag=global_max_lag, decimation=args.decimation)))
+    original_audio_aligned, recorded_audio_aligned = trim_to_delay(original_audio, recorded_audio, delay)
+
     # Iterate through each line in the JSONL file
     with open(args.jsonl, 'r') as file:
-        n = 0
-        for line in file:
-            # Parse the JSON object
-            data = json.loads(line)
-            start = int(data["start"]*SR)
-            end = int(data["end"]*SR)
-            # Load the long audio file
-            original_filename = data['filename']
-            if original_filename == "sweep.wav":
-                original_filename = "sweeps/" + replace_extension(original_filename, f"_{start}_{end}.wav")
-                
-            try:      
-                original_audio_segment = original_audio[start:end]
-
-                recorded_audio_start = np.max([0, start - MAX_LAG])
-                recorded_audio_end = np.min([len(recorded_audio), end + MAX_LAG])
-                recorded_audio_chunk = recorded_audio_aligned[recorded_audio_start:recorded_audio_end]
-                
-                print(f"Original audio segment: {start}:{end} (len: {len(original_audio_segment)})")
-                print(f"Recorded audio chunk: {recorded_audio_start}:{recorded_audio_end} (len: {len(recorded_audio_chunk)})")
-                
-                # Compute the cross-correlation with the long array
-                cross_corr = correlate(original_audio_segment, recorded_audio_chunk, mode='full', method='auto')
-                
-                # Find the index of the maximum correlation
-                max_corr_index = np.argmax(cross_corr)
-                
-                # Calculate the start index in the long array
-                delay = max_corr_index - len(recorded_audio_chunk) + 1
-                
-                if delay > 0:
-                    original_audio_segment = original_audio_segment[delay:]  # Trim the start of audio1
-                else:
-                    recorded_audio_chunk = recorded_audio_chunk[-delay:]
-                
-                
-                output_filename = original_filename.replace(args.basedir, "")
-                output_filename = Path(args.output_dir) / output_filename
-                output_filename.parent.mkdir(parents=True, exist_ok=True)
-                output_filename = replace_extension(output_filename, args.output_suffix)
-                print(f"Output filename: {output_filename}")
-
-                sf.write(output_filename, recorded_audio_chunk[:len(original_audio_segment)], SR)
-                
-                print(f"Filename: {data['filename']}, delay {max_corr_index}, max corr {cross_corr[max_corr_index]}, Start Index in Long Array: {delay}")
-                
-                if args.plot:
-                    fig, axs = plt.subplots(3, 1, figsize=(12, 6), sharex=True)
-
-                    # Plot audio1
-                    axs[0].plot(original_audio_segment)
-                    axs[0].set_title("Original audio segment")
-                    axs[0].set_ylabel("Amplitude")
-                    axs[0].grid()
-
-                    # Plot audio2
-                    axs[1].plot(recorded_audio_aligned[recorded_audio_start:recorded_audio_end])
-                    axs[1].set_title("Recorded audio chunk")
-                    axs[1].set_xlabel("Sample Index")
-                    axs[1].set_ylabel("Amplitude")
-                    axs[1].grid()
-
-                    # Plot recovered recorded segment
-                    axs[2].plot(recorded_audio_chunk[:len(original_audio_segment)])
-                    axs[2].set_title(f"Recovered recorded segment (Start Index: {delay})")
-                    axs[2].set_xlabel("Sample Index")
-                    axs[2].set_ylabel("Amplitude")
-                    axs[2].grid()
-
-                    plt.tight_layout()
-                    # plt.show()
-                    plot_filename = replace_extension(output_filename, ".png")                
-                    plt.savefig(plot_filename)
-                    print(f"Plot saved as: {plot_filename}")
-            
-            except Exception as e:
-                print(f"Error processing line {n}: {e}")
-                continue
-            
-            n += 1
+        lines = [line for line in file if line.strip()]
+
+    drift = None
+    if args.drift:
+        estimate = estimate_drift(lines, recorded_audio_aligned, read_sweep_params(args.sweep_json), SR,
+                                  search=int(args.max_lag * SR), tolerance=int(args.refine_lag * SR))
+        if estimate is None:
+            print("No sweep found, aligning without drift model")
+        else:
+            offset, rate, anchors = estimate
+            drift = (offset, rate)
+            print(f"Drift model: offset {offset:.2f} samples, rate {(rate - 1) * 1e6:.2f} ppm, "
+                  f"{sum(kept for *_, kept in anchors)}/{len(anchors)} sweeps used")
+
+    if args.jobs > 1:
+        # Workers read their segments straight from the files when they need no resampling,
+        # slicing the same samples as the arrays above
+        if sf.info(args.original).samplerate == SR:
+            original_audio = audio_io.AudioReader(args.original, SR, channel=args.channel)
+        if sf.info(args.recorded).samplerate == SR:
+            recorded_audio_aligned = audio_io.AudioReader(args.recorded, SR, channel=args.channel, offset=max(-delay, 0))
+    
+    for log, _ in align_segments(lines, original_audio, recorded_audio_aligned, len(recorded_audio), args, jobs=args.jobs, drift=drift):
+        for message in log:
+            print(message)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -13,6 +13,12 @@ SUFFIXES=(
     "20250425_172028_plus0000_RE84763b9fcbee4fb2f2fdf603d95e9e00"
 )
 
+# Same alignment in a single Python process (each original decoded once, sessions in parallel):
+# python align_sessions.py --sessions "${SUFFIXES[@]}" --variants twilio:1 \
+#     --recordings_dir /data/audio/EXP28-tel/concatenated_sweep/recordings/ \
+#     --output_dir /data/audio/EXP28-tel/recordings/ \
+#     --basedir /data/audio/EXP28-tel/ --jobs 8
+
 for suffix in "${SUFFIXES[@]}"; do
     # Nokia 3310 recordings (mono)
     # echo "python align_audio.py --original /data/audio/EXP28-tel/concatenated_sweep/recordings/${suffix}_original.wav \
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import audio_io
+import instrument
+from align_audio import find_delay, trim_to_delay, select_channel, align_segments, global_max_lag_samples, GLOBAL_MAX_LAG
+
+
+def parse_variant(variant):
+    """
+    Parses a recording variant given as NAME or NAME:CHANNEL, e.g. 'nokia3310' or 'twilio:1'.
+
+    The recording of a variant is {session}_{NAME}.wav in the recordings directory.
+    """
+    name, _, channel = variant.partition(':')
+    return name, int(channel) if channel else 0
+
+
+@instrument.traced('session')
+def align_session(session, variants, args):
+    """
+    Aligns every recording variant of a session against its original, decoding the original once.
+
+    For each variant, writes the aligned segments and a log file, and returns a report with the
+    global delay and the per-segment results.
+
+    :param session: Session ID, e.g. 20250424_112112_plus0000_RE5292d71d0c42dfdc79b594a1d9445dac.
+    :param variants: List of (name, channel) pairs.
+    :param args: Parsed arguments of this script.
+    :return: Report dict, also written to {session}_align_report.json in the report directory.
+    """
+    SR = args.sample_rate
+    prefix = os.path.join(args.recordings_dir, session)
+    original_all, _ = audio_io.read_audio(prefix + '_original.wav', SR, mono=False)
+    with open(prefix + '_info.jsonl', 'r') as file:
+        lines = [line for line in file if line.strip()]
+
+    report_dir = args.report_dir or args.recordings_dir
+    report = {'session': session, 'variants': []}
+    global_max_lag = global_max_lag_samples(args.global_max_lag, SR)
+
+    for name, channel in variants:
+        recorded_file = f'{prefix}_{name}.wav'
+        variant_report = {'name': name, 'channel': channel, 'recorded': recorded_file}
+        log_file = os.path.join(report_dir, f'{session}_align_{name}.log')
+        try:
+            original_audio = select_channel(original_all, channel)
+            recorded_audio, _ = audio_io.read_audio(recorded_file, SR, channel=channel)
+
+            delay = int(round(find_delay(original_audio, recorded_audio, max_lag=global_max_lag, decimation=args.decimation)))
+            _, recorded_audio_aligned = trim_to_delay(original_audio, recorded_audio, delay)
+
+            # Same options as align_audio.py, with the output suffix used by align_audio.sh
+            segment_args = argparse.Namespace(sample_rate=SR, max_lag=args.max_lag, basedir=args.basedir, output_dir=args.output_dir,
+                                              output_suffix=f'.{session}.{name}.wav', plot=args.plot)
+            segments = []
+            with open(log_file, 'w') as log:
+                for messages, result in align_segments(lines, original_audio, recorded_audio_aligned, len(recorded_audio), segment_args):
+                    log.writelines(message + '\n' for message in messages)
+                    segments.append(result)
+
+            variant_report.update(global_delay=delay, errors=sum(result['error'] is not None for result in segments), segments=segments)
+        except Exception as e:
+            variant_report['error'] = f'{type(e).__name__}: {e}'
+        report['variants'].append(variant_report)
+
+    with open(os.path.join(report_dir, f'{session}_align_report.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Align the recordings of many sessions against their originals (batch version of align_audio.sh)')
+    parser.add_argument('--sessions', nargs='+', default=[], help='Session IDs. Example: 20250424_112112_plus0000_RE5292d71d0c42dfdc79b594a1d9445dac')
+    parser.add_argument('--sessions_file', type=str, default=None, help='Text file with one session ID per line')
+    parser.add_argument('--variants', nargs='+', default=['twilio:1'], help='Recording variants as NAME[:CHANNEL], recorded in {session}_{NAME}.wav. Example: nokia3310 twilio:1. Default: twilio:1')
+    parser.add_argument('--recordings_dir', required=True, help='Directory with {session}_original.wav, {session}_info.jsonl and the recordings. Example: /data/audio/EXP28-tel/concatenated_sweep/recordings/')
+    parser.add_argument('--report_dir', type=str, default=None, help='Directory for the per-session reports and logs. Default: recordings_dir')
+    parser.add_argument('--output_dir', default='.', help='Output directory. Example: /data/audio/EXP28-tel/recordings/')
+    parser.add_argument('--basedir', type=str, default='.', help='Base input directory. Example: /data/audio/EXP28-tel/')
+    parser.add_argument('--sample_rate', type=int, default=8000, help='Sampling rate')
+    parser.add_argument('--plot', action='store_true', help='Generate plots')
+    parser.add_argument('--max_lag', type=float, default=0.25, help='Maximum lag in seconds')
+    parser.add_argument('--global_max_lag', type=float, default=GLOBAL_MAX_LAG, help=f'Maximum lag in seconds of the global alignment, i.e. how far apart the start of the recording and of the playback can be. 0 searches any lag, at the cost of a full-length correlation. Default: {GLOBAL_MAX_LAG}')
+    parser.add_argument('--decimation', type=int, default=4, help='Decimation factor of the coarse global alignment search (1 = full-rate correlation). Default: 4')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of sessions processed in parallel. Default: 1')
+    instrument.add_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    instrument.setup(args)
+
+    sessions = list(args.sessions)
+    if args.sessions_file:
+        with open(args.sessions_file, 'r') as f:
+            sessions += [line.strip() for line in f if line.strip()]
+    variants = [parse_variant(variant) for variant in args.variants]
+    if args.report_dir:
+        os.makedirs(args.report_dir, exist_ok=True)
+
+    failed = False
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        futures = {executor.submit(align_session, session, variants, args): session for session in sessions}
+        for future in as_completed(futures):
+            session = futures[future]
+            try:
+                report = future.result()
+            except Exception as e:
+                print(f"Session {session}: error {e}")
+                failed = True
+                continue
+            for variant in report['variants']:
+                if 'error' in variant:
+                    print(f"Session {session}, {variant['name']}: error {variant['error']}")
+                    failed = True
+                else:
+                    print(f"Session {session}, {variant['name']}: global delay {variant['global_delay']}, "
+                          f"{len(variant['segments'])} segments, {variant['errors']} errors")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,303 @@
 import argparse
-import librosa
+import json
 import numpy as np
 import os
+import sys
+import glob
+from itertools import chain
 import soundfile as sf
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from deconvolve import replace_extension
+from convolution import IRConvolver, IRBank
+import audio_io
+import instrument
 
+@instrument.traced('process')
 def process(audio_file, ir_data, sample_rate, suffix: str, output_directory: str):
     """
     Applies the reverb effect to the given audio file using the provided IR parameter.
     
     :param audio_file: The name of the audio file to process.
-    :param ir: The impulse response parameter for the reverb effect.
+    :param ir_data: The impulse response, either as an array or as an IRConvolver to reuse its spectrum across files.
     """
+    convolver = ir_data if isinstance(ir_data, IRConvolver) else IRConvolver(ir_data)
 
     # Load the audio file
-    audio_data, sample_rate = librosa.load(audio_file, sr=sample_rate)
+    audio_data, sample_rate = audio_io.read_audio(audio_file, sample_rate)
     print(f"Loaded audio file: {audio_file}, Sample rate: {sample_rate}")
 
+    output_file = _output_file(audio_file, suffix, output_directory)
+    with instrument.span('convolve'):
+        output = convolver.convolve(audio_data)
+    
+    with instrument.span('write'):
+        sf.write(output_file, output, sample_rate)
+    print(f"Processed audio file saved as: {output_file}")
+
+
+@instrument.traced('process')
+def process_bank(audio_file, ir_bank, sample_rate, output_directory: str):
+    """
+    Applies every impulse response of the bank to the given audio file, decoding the file once.
+
+    One output is written per impulse response, suffixed with the impulse response name.
+    
+    :param audio_file: The name of the audio file to process.
+    :param ir_bank: IRBank with the impulse responses, named after their files.
+    """
+    audio_data, sample_rate = audio_io.read_audio(audio_file, sample_rate)
+    print(f"Loaded audio file: {audio_file}, Sample rate: {sample_rate}")
+
+    for suffix, output in ir_bank.convolve(audio_data):
+        output_file = _output_file(audio_file, suffix, output_directory)
+        with instrument.span('write'):
+            sf.write(output_file, output, sample_rate)
+        print(f"Processed audio file saved as: {output_file}")
+
+
+@instrument.traced('process')
+def process_stream(audio_file, ir_data, sample_rate, suffix: str, output_directory: str, block_size=65536):
+    """
+    Applies the reverb effect block by block, without loading the whole audio file into memory.
+
+    Blocks are read with soundfile, resampled to sample_rate if the file rate differs, convolved
+    with the uniformly partitioned impulse response and written to the output file as they come,
+    so memory does not grow with the file length. The output has the rate and the samples of the
+    in-memory path (process), up to the rounding of the convolution.
+
+    :param audio_file: The name of the audio file to process.
+    :param ir_data: The impulse response, either as an array or as an IRConvolver.
+    :param block_size: Number of samples per block (and per IR partition).
+    """
+    convolver = ir_data if isinstance(ir_data, IRConvolver) else IRConvolver(ir_data)
+    output_file = _output_file(audio_file, suffix, output_directory)
+
+    with sf.SoundFile(audio_file) as f_in:
+        print(f"Streaming audio file: {audio_file}, Sample rate: {f_in.samplerate}")
+        partitioned = convolver.partitioned(block_size)
+
+        with sf.SoundFile(output_file, 'w', samplerate=sample_rate, channels=1) as f_out:
+            for block in _stream_blocks(f_in, sample_rate, block_size):
+                f_out.write(partitioned.process(block))
+            for block in partitioned.flush():
+                f_out.write(block)
+
+    print(f"Processed audio file saved as: {output_file}")
+
+
+def _stream_blocks(f_in, sample_rate, block_size):
+    # Mono blocks of an open file at sample_rate, all block_size samples long but the last one
+    blocks = f_in.blocks(blocksize=block_size, dtype='float32', always_2d=True)
+    # Downmix to mono as audio_io.read_audio does in the in-memory path
+    blocks = (block[:, 0] if block.shape[1] == 1 else np.mean(block, axis=1) for block in blocks)
+    if f_in.samplerate == sample_rate:
+        yield from blocks
+        return
+
+    resampler = audio_io.BlockResampler(f_in.samplerate, sample_rate)
+    pending = np.zeros(0, dtype=np.float32)
+    for block in chain(blocks, [None]):
+        # None marks the end of the file, the resampler then returns its last samples
+        pending = np.concatenate((pending, resampler.flush() if block is None else resampler.process(block)))
+        while pending.shape[0] >= block_size:
+            yield pending[:block_size]
+            pending = pending[block_size:]
+    if pending.shape[0]:
+        yield pending
+
+
+def _output_file(audio_file, suffix, output_directory):
     output_file = replace_extension(audio_file, "_"+suffix)    
     if output_directory:
         output_file = os.path.join(output_directory, output_file)
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        
-    output = np.convolve(audio_data, ir_data, mode='full')    
-    
-    sf.write(output_file, output, sample_rate)
-    print(f"Processed audio file saved as: {output_file}")
-    
+    return output_file
+
+
+def find_irs(ir_paths, pattern="*.wav"):
+    """
+    Expands the --ir arguments into a sorted list of impulse response files.
+
+    :param ir_paths: Impulse response files or directories.
+    :param pattern: Glob pattern used inside directories, e.g. "*_RIR_trimmed_T30.wav".
+    """
+    ir_files = []
+    for path in ir_paths:
+        if os.path.isdir(path):
+            ir_files += sorted(glob.glob(os.path.join(path, pattern)))
+        else:
+            ir_files.append(path)
+    return ir_files
+
+
+def ir_names(ir_files):
+    """
+    Output suffixes of the impulse responses of a bank, one per file.
+
+    Files are named after their base name, or after their path relative to the common parent
+    directory (with separators replaced by '_') when base names collide, e.g. roomA/ir.wav and
+    roomB/ir.wav become roomA_ir.wav and roomB_ir.wav.
+
+    :param ir_files: Impulse response files, e.g. from find_irs().
+    :return: List of unique names, or None if the same file is given twice.
+    """
+    names = [os.path.basename(ir_file) for ir_file in ir_files]
+    if len(set(names)) < len(names):
+        paths = [os.path.abspath(ir_file) for ir_file in ir_files]
+        parent = os.path.commonpath([os.path.dirname(path) for path in paths])
+        names = [os.path.relpath(path, parent).replace(os.sep, '_') for path in paths]
+    if len(set(names)) < len(names):
+        return None
+    return names
+
+
+def read_file_list(list_file):
+    """
+    Reads the audio files to process from a text file (one path per line) or a JSONL manifest.
+
+    JSONL manifests are in the format written by concatenate_audio_files.py; sweep entries are skipped.
+
+    :param list_file: Path to the file list or manifest.
+    :return: List of audio file paths.
+    """
+    audio_files = []
+    with open(list_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if list_file.endswith('.jsonl'):
+                entry = json.loads(line)
+                if entry.get('is_sweep', False):
+                    continue
+                audio_files.append(entry['filename'])
+            else:
+                audio_files.append(line)
+    return audio_files
+
+
+# Impulse response of a pool worker, set once per process by _init_worker
+_worker_convolver = None
+
+def _init_worker(convolver):
+    global _worker_convolver
+    _worker_convolver = convolver
+
+def _process_task(audio_file, sample_rate, suffix, output_directory, block_size=None):
+    try:
+        if block_size:
+            process_stream(audio_file, _worker_convolver, sample_rate, suffix=suffix, output_directory=output_directory, block_size=block_size)
+        elif isinstance(_worker_convolver, IRBank):
+            process_bank(audio_file, _worker_convolver, sample_rate, output_directory=output_directory)
+        else:
+            process(audio_file, _worker_convolver, sample_rate, suffix=suffix, output_directory=output_directory)
+    except Exception as e:
+        return audio_file, f"{type(e).__name__}: {e}"
+    return audio_file, None
+
+
+def process_batch(audio_files, convolver, sample_rate, suffix: str, output_directory: str, jobs=1, max_in_flight=None, block_size=None):
+    """
+    Applies the impulse response to many audio files, optionally over a pool of worker processes.
+
+    The convolver is sent to each worker once. At most max_in_flight files are queued or being
+    processed at any time, which bounds the number of decoded buffers held in memory.
+
+    :param audio_files: The names of the audio files to process.
+    :param convolver: IRConvolver with the impulse response, or IRBank to apply several impulse responses per file.
+    :param jobs: Number of worker processes. 1 processes the files in this process.
+    :param max_in_flight: Maximum number of files submitted to the pool at once. Default: 2 * jobs.
+    :param block_size: If given, files are streamed block by block with process_stream.
+    :return: List of (audio_file, error message) for the files that failed.
+    """
+    failures = []
+
+    if jobs <= 1:
+        _init_worker(convolver)
+        for audio_file in audio_files:
+            _, error = _process_task(audio_file, sample_rate, suffix, output_directory, block_size)
+            if error is not None:
+                print(f"Error processing {audio_file}: {error}")
+                failures.append((audio_file, error))
+        return failures
+
+    max_in_flight = max_in_flight or 2 * jobs
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(convolver,)) as executor:
+        pending = set()
+        for audio_file in audio_files:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                failures += _collect(done)
+            pending.add(executor.submit(_process_task, audio_file, sample_rate, suffix, output_directory, block_size))
+        done, _ = wait(pending)
+        failures += _collect(done)
+
+    return failures
+
+def _collect(done):
+    failures = []
+    for future in done:
+        audio_file, error = future.result()
+        if error is not None:
+            print(f"Error processing {audio_file}: {error}")
+            failures.append((audio_file, error))
+    return failures
+
 
 def main():
     parser = argparse.ArgumentParser(description="Apply reverb to audio files.")
-    parser.add_argument("audio_files", nargs="+", help="List of audio files to process.")
-    parser.add_argument("--ir", required=True, help="Impulse response parameter for reverb.")
+    parser.add_argument("audio_files", nargs="*", help="List of audio files to process.")
+    parser.add_argument("--file_list", help="Text file with one audio file per line, or JSONL manifest with a 'filename' per line.")
+    parser.add_argument("--ir", required=True, nargs="+", help="Impulse response(s) for reverb: files and/or directories of IR files.")
+    parser.add_argument("--ir_pattern", default="*.wav", help="Glob pattern for IR files inside --ir directories. Example: '*_RIR_trimmed_T30.wav'. Default: '*.wav'")
     parser.add_argument("--output_directory", default="", help="Directory to save processed audio files.")
+    parser.add_argument("--sample_rate", type=int, default=22050, help="Sampling rate the IRs and audio files are resampled to. Default: 22050")
+    parser.add_argument("--method", default="auto", choices=["auto", "fft", "oa", "direct"], help="Convolution method, also for a bank of several IRs. Default: auto (picked per file).")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes. Default: 1")
+    parser.add_argument("--max_in_flight", type=int, default=None, help="Maximum number of files queued in the worker pool at once. Default: 2 * jobs")
+    parser.add_argument("--stream", action="store_true", help="Stream files block by block with constant memory (partitioned convolution, the input is resampled block by block).")
+    parser.add_argument("--block_size", type=int, default=65536, help="Block size in samples for --stream. Default: 65536")
+    instrument.add_arguments(parser)
     
     args = parser.parse_args()
-    ir_data, sample_rate = librosa.load(args.ir)
+    instrument.setup(args)
+    audio_files = list(args.audio_files)
+    if args.file_list:
+        audio_files += read_file_list(args.file_list)
+    if not audio_files:
+        parser.error("No audio files given. Pass them as arguments or with --file_list")
+
+    ir_files = find_irs(args.ir, args.ir_pattern)
+    if not ir_files:
+        parser.error(f"No impulse responses found in {args.ir}")
+
+    if args.stream and len(ir_files) > 1:
+        parser.error("--stream supports a single impulse response")
+
+    # Bank outputs are suffixed with the IR names, which must not overwrite each other
+    names = ir_names(ir_files)
+    if names is None:
+        parser.error("The same impulse response is given more than once")
+
+    if len(ir_files) == 1:
+        ir_data, sample_rate = audio_io.read_audio(ir_files[0], args.sample_rate)
+        convolver = IRConvolver(ir_data, method=args.method)
+    else:
+        irs = []
+        for ir_file in ir_files:
+            ir_data, sample_rate = audio_io.read_audio(ir_file, args.sample_rate)
+            irs.append(ir_data)
+        convolver = IRBank(irs, names=names, method=args.method)
+        print(f"Loaded {len(ir_files)} impulse responses")
     
-    for audio_file in args.audio_files:
-        process(audio_file, ir_data, sample_rate, suffix=os.path.basename(args.ir), output_directory=args.output_directory)
+    failures = process_batch(audio_files, convolver, sample_rate, suffix=os.path.basename(ir_files[0]), output_directory=args.output_directory,
+                             jobs=args.jobs, max_in_flight=args.max_in_flight, block_size=args.block_size if args.stream else None)
+
+    if failures:
+        print(f"{len(failures)} of {len(audio_files)} files failed:")
+        for audio_file, error in failures:
+            print(f"  {audio_file}: {error}")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,243 @@
+import struct
+from fractions import Fraction
+from functools import lru_cache
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly, firwin, upfirdn
+
+import instrument
+
+# WAV format tags
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Sample formats that can be mapped directly as NumPy arrays, per (format tag, bits per sample)
+_WAV_DTYPES = {
+    (WAVE_FORMAT_PCM, 16): np.dtype('<i2'),
+    (WAVE_FORMAT_PCM, 32): np.dtype('<i4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype('<f4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype('<f8'),
+}
+
+
+def wav_memmap(file_path):
+    """
+    Memory-maps the samples of a WAV file, without decoding or copying them.
+
+    Only 16/32-bit PCM and 32/64-bit float WAV files can be mapped.
+
+    :param file_path: Path to the audio file.
+    :return: (array of shape (frames, channels) in the file's sample format, sample rate), or None
+             if the file is not a WAV file that can be mapped.
+    """
+    with open(file_path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, chunk_size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                f.seek(chunk_size % 2, 1)
+            elif chunk_id == b'data':
+                offset = f.tell()
+                break
+            else:
+                # Chunks are word aligned
+                f.seek(chunk_size + chunk_size % 2, 1)
+
+    if fmt is None or len(fmt) < 16:
+        return None
+    format_tag, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+        # The actual format is in the first two bytes of the sub-format GUID
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    dtype = _WAV_DTYPES.get((format_tag, bits))
+    if dtype is None or block_align != channels * dtype.itemsize:
+        return None
+
+    # The data size in the header can be wrong (e.g. streamed files), the file size can't
+    frames = min(chunk_size, _file_size(file_path) - offset) // block_align
+    if frames == 0:
+        return np.zeros((0, channels), dtype=dtype), sample_rate
+    return np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=(frames, channels)), sample_rate
+
+
+def _file_size(file_path):
+    with open(file_path, 'rb') as f:
+        return f.seek(0, 2)
+
+
+def to_float32(data):
+    """Converts samples to float32 in [-1, 1) like soundfile does. float32 data is returned as is."""
+    if data.dtype == np.float32:
+        return data
+    if data.dtype.kind == 'i':
+        return data.astype(np.float32) / np.float32(2 ** (8 * data.dtype.itemsize - 1))
+    return data.astype(np.float32)
+
+
+@lru_cache(maxsize=16)
+def _resample_filter(up, down):
+    # Same low-pass filter as scipy.signal.resample_poly, designed once per rate ratio
+    max_rate = max(up, down)
+    return firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+
+
+def resample(audio_data, orig_sr, target_sr):
+    """
+    Polyphase resampling along axis 0. The anti-aliasing filter is cached per rate ratio.
+
+    :return: The input itself if the rates are equal, a new float32 array otherwise.
+    """
+    if orig_sr == target_sr:
+        return audio_data
+    ratio = Fraction(int(target_sr), int(orig_sr))
+    with instrument.span('resample'):
+        h = _resample_filter(ratio.numerator, ratio.denominator)
+        return resample_poly(audio_data, ratio.numerator, ratio.denominator, axis=0, window=h).astype(np.float32, copy=False)
+
+
+class BlockResampler:
+    """
+    Polyphase resampling of a signal given block by block, with the same output as resample() on
+    the whole signal: process() returns the output samples that only depend on the input so far,
+    flush() the remaining ones once the input has ended.
+    """
+
+    def __init__(self, orig_sr, target_sr):
+        ratio = Fraction(int(target_sr), int(orig_sr))
+        self.up, self.down = ratio.numerator, ratio.denominator
+        h = _resample_filter(self.up, self.down)
+        # Filter and output delay of resample_poly
+        half_len = (h.shape[0] - 1) // 2
+        pre_pad = self.down - half_len % self.down
+        self._h = np.concatenate((np.zeros(pre_pad), h * self.up))
+        self._next = (half_len + pre_pad) // self.down
+        self._first = self._next
+        self._buffer = np.zeros(0, dtype=np.float32)
+        # Input index of the first buffered sample, always a multiple of down
+        self._offset = 0
+        self._received = 0
+
+    def _output(self, stop):
+        # Output samples [self._next, stop) of the filtered signal, from the buffered input
+        buffer = self._buffer
+        shift = self._offset * self.up // self.down
+        needed = (stop - shift - 1) * self.down // self.up + 1
+        if needed > buffer.shape[0]:
+            buffer = np.concatenate((buffer, np.zeros(needed - buffer.shape[0], dtype=buffer.dtype)))
+        y = upfirdn(self._h, buffer, self.up, self.down)[self._next - shift:stop - shift]
+        self._next = stop
+
+        # Drop the input that no later output sample depends on
+        first = max(-(-(stop * self.down - self._h.shape[0] + 1) // self.up), 0)
+        first = first // self.down * self.down
+        if first > self._offset:
+            self._buffer = self._buffer[first - self._offset:]
+            self._offset = first
+        return y.astype(np.float32, copy=False)
+
+    def process(self, block):
+        self._buffer = np.concatenate((self._buffer, block))
+        self._received += block.shape[0]
+        # Output m depends on the input samples up to m * down / up
+        stop = -(-self._received * self.up // self.down)
+        if stop <= self._next:
+            return np.zeros(0, dtype=np.float32)
+        return self._output(stop)
+
+    def flush(self):
+        stop = self._first + -(-self._received * self.up // self.down)
+        if stop <= self._next:
+            return np.zeros(0, dtype=np.float32)
+        return self._output(stop)
+
+
+def _select(data, mono, channel):
+    # data is (frames, channels). Mono files are returned as (frames,) like librosa.load does,
+    # whatever the channel index, which only applies to multichannel files.
+    if data.shape[1] == 1:
+        return data[:, 0]
+    if channel is not None:
+        return data[:, channel]
+    if mono:
+        return np.mean(to_float32(data), axis=1)
+    return data
+
+
+def read_audio(file_path, sample_rate=None, mono=True, channel=None, start=0, stop=None):
+    """
+    Reads (part of) an audio file as float32, replacing librosa.load.
+
+    PCM and float WAV files are memory-mapped, so only the requested frames are read from disk and
+    32-bit float files at the target rate are returned as zero-copy views of the file. Other
+    formats (e.g. FLAC) are read with soundfile, also only for the requested frames. The audio is
+    only resampled if the file rate differs from sample_rate.
+
+    :param file_path: Path to the audio file.
+    :param sample_rate: Target sample rate. None keeps the file rate.
+    :param mono: Average the channels (ignored when a channel is selected).
+    :param channel: Channel to return from a multichannel file. Mono files are returned as they are.
+    :param start: First frame to read, in samples at the target rate.
+    :param stop: Frame after the last one to read, in samples at the target rate. None reads to the end.
+    :return: (audio, sample_rate), audio of shape (frames,) for mono files, a selected channel or
+             mono=True, and (frames, channels) for multichannel files with mono=False.
+    """
+    info = wav_memmap(file_path)
+    native_sr = info[1] if info is not None else sf.info(file_path).samplerate
+    sample_rate = sample_rate or native_sr
+
+    # Frame range in the file
+    scale = native_sr / sample_rate
+    native_start = int(np.floor(start * scale))
+    native_stop = None if stop is None else int(np.ceil(stop * scale))
+
+    with instrument.span('load'):
+        if info is not None:
+            data = info[0][native_start:native_stop]
+        else:
+            data = sf.read(file_path, start=native_start, stop=native_stop, dtype='float32', always_2d=True)[0]
+        audio_data = to_float32(_select(data, mono, channel))
+
+    audio_data = resample(audio_data, native_sr, sample_rate)
+    if stop is not None and native_sr != sample_rate:
+        audio_data = audio_data[:stop - start]
+    return audio_data, sample_rate
+
+
+class AudioReader:
+    """
+    Array-like access to one channel of an audio file, reading only the slices that are indexed.
+
+    reader[start:stop] returns float32 samples at the target rate, like read_audio with start and
+    stop. Readers only hold the file name, so they are cheap to send to worker processes.
+    """
+
+    def __init__(self, file_path, sample_rate=None, channel=None, offset=0):
+        """
+        :param offset: Number of frames skipped at the start of the file (index 0 is frame offset).
+        """
+        self.file_path = file_path
+        self.channel = channel
+        self.offset = offset
+        info = sf.info(file_path)
+        self.sample_rate = sample_rate or info.samplerate
+        self._length = int(np.ceil(info.frames * self.sample_rate / info.samplerate)) - offset
+
+    def __len__(self):
+        return max(self._length, 0)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise TypeError('AudioReader only supports contiguous slices')
+        start, stop, _ = index.indices(len(self))
+        if stop <= start:
+            return np.zeros(0, dtype=np.float32)
+        return read_audio(self.file_path, self.sample_rate, channel=self.channel,
+                          start=start + self.offset, stop=stop + self.offset)[0]
@@ -0,0 +1,248 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import scipy
+import soundfile as sf
+
+import stimulus as stim
+import align_audio
+import deconvolve
+import apply_ir_to_audio
+import concatenate_audio_files
+
+# Recordings larger than this are skipped by the grids, in bytes of float64 samples
+MAX_RECORDING_BYTES = 2 * 1024**3
+
+# Parameter grids per preset. 'quick' runs in about a minute, 'full' covers the production range
+# (fs 8 kHz - 96 kHz, sweeps 2 - 30 s, 1 - 64 channels, recordings 1 minute - 1 hour).
+GRIDS = {
+    'quick': {
+        'generate': {'fs': [8000, 48000], 'duration': [2, 10]},
+        'deconvolve': {'fs': [8000, 48000], 'duration': [5], 'channels': [1, 8]},
+        'find_delay': {'fs': [8000], 'minutes': [1, 5]},
+        'compute_tdecay': {'fs': [8000, 48000], 'channels': [1, 8]},
+        'apply_ir': {'fs': [16000], 'minutes': [0.5]},
+        'concatenate': {'fs': [16000], 'clips': [20]},
+    },
+    'full': {
+        'generate': {'fs': [8000, 16000, 44100, 48000, 96000], 'duration': [2, 10, 30]},
+        'deconvolve': {'fs': [8000, 48000, 96000], 'duration': [2, 10, 30], 'channels': [1, 8, 32, 64]},
+        'find_delay': {'fs': [8000, 16000], 'minutes': [1, 10, 60]},
+        'compute_tdecay': {'fs': [8000, 48000, 96000], 'channels': [1, 8, 64]},
+        'apply_ir': {'fs': [16000, 48000], 'minutes': [1, 10, 60]},
+        'concatenate': {'fs': [16000, 48000], 'clips': [100, 1000]},
+    },
+}
+
+
+def _sweep(fs, duration):
+    testStimulus = stim.stimulus('sinesweep', fs)
+    testStimulus.generate(fs, duration, 0.5, 1, 1, 1, [0, 0])
+    return testStimulus
+
+
+def _rir(fs, channels, rng, length=1.0, rt60=0.5):
+    # Exponentially decaying noise, a synthetic room impulse response
+    t = np.arange(int(length * fs)) / fs
+    return rng.standard_normal((t.shape[0], channels)) * np.exp(-6.9 * t / rt60)[:, np.newaxis]
+
+
+def bench_generate(rng, tmpdir, fs, duration):
+    def run():
+        # Bypass the stimulus cache, the generation itself is measured
+        stim.clearCache()
+        _sweep(fs, duration)
+    return run, duration * fs
+
+
+def bench_deconvolve(rng, tmpdir, fs, duration, channels):
+    testStimulus = _sweep(fs, duration)
+    recorded = testStimulus.signal + 1e-3 * rng.standard_normal((testStimulus.signal.shape[0], channels))
+    window = testStimulus.irWindow(fs, predelay=fs // 2)
+    return lambda: testStimulus.deconvolve(recorded, window=window), recorded.size
+
+
+def bench_find_delay(rng, tmpdir, fs, minutes):
+    length = int(minutes * 60 * fs)
+    original = rng.standard_normal(length).astype(np.float32)
+    recorded = np.concatenate((np.zeros(fs // 10, dtype=np.float32), original))[:length]
+    return lambda: align_audio.find_delay(original, recorded, decimation=4), length
+
+
+def bench_compute_tdecay(rng, tmpdir, fs, channels):
+    impulse_response = _rir(fs, channels, rng)
+    return lambda: deconvolve.compute_tdecay(impulse_response, fs, 30), impulse_response.size
+
+
+def bench_apply_ir(rng, tmpdir, fs, minutes):
+    audio_file = os.path.join(tmpdir, 'audio.wav')
+    sf.write(audio_file, 0.1 * rng.standard_normal(int(minutes * 60 * fs)), fs)
+    ir = _rir(fs, 1, rng)[:, 0]
+    return lambda: apply_ir_to_audio.process(audio_file, ir, fs, 'ir.wav', tmpdir), int(minutes * 60 * fs)
+
+
+def bench_concatenate(rng, tmpdir, fs, clips):
+    clip_dir = os.path.join(tmpdir, 'clips')
+    os.makedirs(clip_dir, exist_ok=True)
+    names = []
+    samples = 0
+    for idx in range(clips):
+        length = int(rng.integers(2 * fs, 6 * fs))
+        sf.write(os.path.join(clip_dir, f'{idx}.wav'), (0.1 * rng.standard_normal(length) * 32767).astype(np.int16), fs, subtype='PCM_16')
+        names.append(f'{idx}.wav')
+        samples += length
+    sweep_file = os.path.join(tmpdir, 'sweep.wav')
+    sf.write(sweep_file, _sweep(fs, 2).signal[:, 0], fs, subtype='PCM_16')
+    sweep_audio = concatenate_audio_files.AudioClip.from_file(sweep_file)
+    output_dir = os.path.join(tmpdir, 'long')
+    os.makedirs(output_dir, exist_ok=True)
+
+    def run():
+        random.seed(0)
+        concatenate_audio_files.generate_long_audios(list(names), sweep_audio, output_dir, 0.3, clip_dir, 300)
+    return run, samples
+
+
+BENCHMARKS = {
+    'generate': bench_generate,
+    'deconvolve': bench_deconvolve,
+    'find_delay': bench_find_delay,
+    'compute_tdecay': bench_compute_tdecay,
+    'apply_ir': bench_apply_ir,
+    'concatenate': bench_concatenate,
+}
+
+
+def cases(preset):
+    """
+    Expands the grid of a preset.
+
+    :return: Generator of (case name, benchmark name, parameters), e.g.
+             ('deconvolve[fs=8000,duration=5,channels=1]', 'deconvolve', {'fs': 8000, 'duration': 5, 'channels': 1}).
+    """
+    for name, grid in GRIDS[preset].items():
+        for values in itertools.product(*grid.values()):
+            params = dict(zip(grid.keys(), values))
+            seconds = params.get('duration', 0) + 2 if 'duration' in params else params.get('minutes', 0) * 60
+            if seconds * params['fs'] * params.get('channels', 1) * 8 > MAX_RECORDING_BYTES:
+                continue
+            label = ','.join(f'{key}={value}' for key, value in params.items())
+            yield f'{name}[{label}]', name, params
+
+
+def run_case(name, params, repeat=3):
+    """
+    Runs one benchmark: the best wall time of repeat runs, and the peak memory of a separate run
+    traced with tracemalloc (which slows down the run, so it is not timed).
+
+    :return: Dict with wall (s), cpu (s), peak_mb and samples_per_s.
+    """
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmpdir, contextlib.redirect_stdout(io.StringIO()):
+        run, samples = BENCHMARKS[name](rng, tmpdir, **params)
+        walls, cpus = [], []
+        for _ in range(repeat):
+            wall, cpu = time.perf_counter(), time.process_time()
+            run()
+            walls.append(time.perf_counter() - wall)
+            cpus.append(time.process_time() - cpu)
+
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    wall = min(walls)
+    return {'wall': wall, 'cpu': min(cpus), 'peak_mb': peak / 1024**2, 'samples_per_s': samples / wall if wall > 0 else None}
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with a baseline.
+
+    :return: List of (case, metric, baseline value, new value) for every wall time or peak memory
+             more than threshold (e.g. 0.25 = 25 %) above the baseline.
+    """
+    regressions = []
+    for case, result in results.items():
+        reference = baseline.get(case)
+        if reference is None:
+            continue
+        for metric in ['wall', 'peak_mb']:
+            if result[metric] > reference[metric] * (1 + threshold):
+                regressions.append((case, metric, reference[metric], result[metric]))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the signal processing hot paths on synthetic signals (no audio device needed) and check them against a baseline')
+    parser.add_argument('--preset', choices=list(GRIDS), default='quick', help='Parameter grid. Default: quick')
+    parser.add_argument('--filter', type=str, default=None, help='Only run the cases whose name contains this string. Example: deconvolve[fs=48000')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case, the best one is kept. Default: 3')
+    parser.add_argument('--baseline', type=str, default='benchmark_baseline.json', help='Baseline JSON file. Default: benchmark_baseline.json')
+    parser.add_argument('--update', action='store_true', help='Write the results to the baseline instead of comparing with it')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Relative increase of wall time or peak memory counted as a regression. Default: 0.25')
+    parser.add_argument('--output', type=str, default=None, help='Also write the results of this run to a JSON file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = {}
+    for case, name, params in cases(args.preset):
+        if args.filter and args.filter not in case:
+            continue
+        results[case] = run_case(name, params, args.repeat)
+        result = results[case]
+        print(f"{case}: {result['wall']:.4f} s, {result['peak_mb']:.1f} MB, {result['samples_per_s']:.3g} samples/s")
+
+    report = {'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+                              'machine': platform.machine(), 'cpus': os.cpu_count()},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    if args.update:
+        # Cases of other presets or filters already in the baseline are kept
+        baseline = {'results': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+        baseline['environment'] = report['environment']
+        baseline['results'].update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline {args.baseline}, run with --update to create it")
+        return
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline['results'], args.threshold)
+    for case, metric, before, after in regressions:
+        print(f"Regression in {case}: {metric} {before:.4g} -> {after:.4g} (+{(after / before - 1) * 100:.0f} %)")
+    missing = [case for case in results if case not in baseline['results']]
+    if missing:
+        print(f"{len(missing)} cases not in the baseline")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,16 @@ import soundfile as sf   # for loading wavfiles
 from scipy.signal import spectrogram
 import os
 
+import utils
+
 fs = 44100
 
+lastdir = utils.lastRecording()
+if lastdir is None:
+    raise SystemExit('No recording found, run measure.py first')
+
 # THE ROOM IMPULSE RESPONSES
-RIR = np.load('recorded/lastRecording/RIR.npy')
+RIR = np.load(os.path.join(lastdir, 'RIR.npy'))
 maxval = np.max(RIR)
 minval = np.min(RIR)
 taxis = np.arange(0,RIR.shape[0]/fs,1/fs)
@@ -35,11 +41,11 @@ for idx in range(numplots):
 
 
 # The emitted and recorded signals
-sigtest, ff = sf.read('recorded/lastRecording/sigtest.wav')
+sigtest, ff = sf.read(os.path.join(lastdir, 'sigtest.wav'))
 
 sigrec = np.zeros(shape = (sigtest.shape[0],RIR.shape[1]))
 for idx in range(RIR.shape[1]):
-    tmp, ff = sf.read('sigrec' + str(idx+1)+ '.wav')
+    tmp, ff = sf.read(os.path.join(lastdir, 'sigrec' + str(idx+1)+ '.wav'))
     sigrec[:,idx] = tmp
 
 fig = plt.figure(figsize = (9,3))
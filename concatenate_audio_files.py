@@ -1,79 +1,339 @@
 import os
 import random
 import argparse
-from pydub import AudioSegment
+import json
+import heapq
+from collections import deque
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import soundfile as sf
 import jsonlines
 
+import audio_io
+import instrument
+
+# Bytes per sample of the output for each input subtype, the widest input wins
+SAMPLE_WIDTHS = {'PCM_S8': 1, 'PCM_U8': 1, 'PCM_16': 2, 'PCM_24': 3, 'PCM_32': 4, 'FLOAT': 4, 'DOUBLE': 4}
+WAV_SUBTYPES = {1: 'PCM_U8', 2: 'PCM_16', 3: 'PCM_24', 4: 'PCM_32'}
+
+
+class AudioClip:
+    """
+    Header information of an audio file, read once without decoding the samples.
+    """
+
+    def __init__(self, path, frames, sample_rate, channels, sample_width):
+        self.path = path
+        self.frames = frames
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.sample_width = sample_width
+
+    @classmethod
+    def from_file(cls, path):
+        info = sf.info(path)
+        return cls(path, info.frames, info.samplerate, info.channels, SAMPLE_WIDTHS.get(info.subtype, 2))
+
+    @property
+    def duration_seconds(self):
+        return self.frames / self.sample_rate
+
+    def output_frames(self, sample_rate):
+        """Number of frames of the clip at sample_rate, as returned by audio_io.resample."""
+        if sample_rate == self.sample_rate:
+            return self.frames
+        return int(np.ceil(self.frames * sample_rate / self.sample_rate))
+
+    def read(self, sample_rate, channels):
+        """
+        Reads the clip for an output with the given rate and number of channels.
+
+        Clips at the output rate are read as int32, which holds any PCM sample exactly, so they are
+        copied bit for bit. Other clips are resampled in floating point.
+        """
+        with instrument.span('load'):
+            if sample_rate == self.sample_rate:
+                data, _ = sf.read(self.path, dtype='int32', always_2d=True)
+            else:
+                data, _ = sf.read(self.path, dtype='float64', always_2d=True)
+                data = audio_io.resample(data, self.sample_rate, sample_rate).astype(np.float64)
+        # Mono clips are copied to every channel
+        return np.broadcast_to(data, (data.shape[0], channels))
+
+
+class DurationIndex:
+    """
+    Persistent cache of audio file headers, so repeated runs over a corpus don't open every file.
+
+    Entries are keyed by absolute path and are only reused while the file modification time and
+    size are unchanged. The index is a JSON file, rewritten by save() when entries were added.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: Path to the index file. None keeps the index in memory only.
+        """
+        self.path = path
+        self._entries = {}
+        self._dirty = False
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self._entries = json.load(f)
+
+    def clip(self, file):
+        """Returns the AudioClip of a file, reading its header only if it is not indexed or has changed."""
+        stat = os.stat(file)
+        key = os.path.abspath(file)
+        entry = self._entries.get(key)
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            clip = AudioClip.from_file(file)
+            self._entries[key] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'frames': clip.frames,
+                                  'sample_rate': clip.sample_rate, 'channels': clip.channels, 'sample_width': clip.sample_width}
+            self._dirty = True
+            return clip
+        return AudioClip(file, entry['frames'], entry['sample_rate'], entry['channels'], entry['sample_width'])
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        # Write to a temporary file first, so an interrupted run never leaves a truncated index
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
 
 def maybe_insert_sweep(sweep_audio, probability):
     """
     Determines whether to insert the sweep audio based on the specified probability.
 
     Args:
-        sweep_audio (AudioSegment): The sweep audio segment.
+        sweep_audio (AudioClip): The sweep audio clip.
         probability (float): The probability of inserting the sweep audio (0 to 1).
 
     Returns:
-        tuple: A tuple containing the sweep audio segment (or silence) and a boolean indicating whether the sweep was inserted.
+        tuple: A tuple containing the sweep audio clip (or None) and a boolean indicating whether the sweep was inserted.
     """
     if random.random() < probability:
         return sweep_audio, True
     else:
-        return AudioSegment.silent(duration=0), False
+        return None, False
 
-def generate_long_audios(input_files, sweep_audio, output_dir, sweep_probability, root_dir, output_length_seconds):
+def plan_long_audio(input_files, sweep_audio, sweep_probability, root_dir, output_length_seconds, index=None):
     """
-    Generates audio files of specified length by concatenating multiple input audio files and inserting sweep audio segments.
+    Picks the clips of the next long audio file, in order, from the file headers only.
+
+    Consumes the used files from input_files. Random numbers are drawn in the same order as when
+    the audio was concatenated while reading it, so the same seed gives the same layout.
 
     Args:
         input_files (list): List of input audio file paths relative to root_dir.
-        sweep_audio (AudioSegment): The sweep audio segment.
-        output_dir (str): Directory to save the output audio files.
+        sweep_audio (AudioClip): The sweep audio clip.
         sweep_probability (float): Probability of inserting the sweep audio segment (0 to 1).
         root_dir (str): Root directory containing the audio files.
         output_length_seconds (int): Length of the output audio files in seconds.
+        index (DurationIndex): Header cache. Default: an in-memory index.
+
+    Returns:
+        list: (AudioClip, filename, is_sweep) tuples, starting and ending with the sweep.
     """
-    output_length_ms = output_length_seconds * 1000  # Convert seconds to milliseconds
-    file_count = 1
+    index = index or DurationIndex()
+    clips = [(sweep_audio, 'sweep.wav', True)]  # Start with the sweep audio
+    duration = sweep_audio.duration_seconds
 
-    while input_files:
-        current_audio = sweep_audio  # Start with the sweep audio
-        file_info = [{'filename': 'sweep.wav', 'start': 0, 'end': sweep_audio.duration_seconds, 'is_sweep': True}]  # Init file info with the first sweep
+    random.shuffle(input_files)  # Shuffle input files for randomness
+    remaining = deque(input_files)
+
+    while remaining and duration < output_length_seconds:
+        file = os.path.join(root_dir, remaining.popleft())
+        audio_segment = index.clip(file)
+        sweep_segment, was_sweep_inserted = maybe_insert_sweep(sweep_audio, sweep_probability)
 
-        random.shuffle(input_files)  # Shuffle input files for randomness
+        clips.append((audio_segment, file, False))
+        duration += audio_segment.duration_seconds
+        if was_sweep_inserted:
+            clips.append((sweep_segment, 'sweep.wav', True))
+            duration += sweep_segment.duration_seconds
 
-        while input_files and current_audio.duration_seconds < output_length_seconds:
-            file = os.path.join(root_dir, input_files.pop(0))
-            audio_segment = AudioSegment.from_file(file)
-            sweep_segment, was_sweep_inserted = maybe_insert_sweep(sweep_audio, sweep_probability)
-            
-            start = current_audio.duration_seconds
-            end = start + audio_segment.duration_seconds
-            file_info.append({'filename': file, 'start': start, 'end': end, 'is_sweep': False})
+    input_files[:] = remaining
 
-            current_audio += audio_segment + sweep_segment
+    # Add the sweep audio at the end
+    clips.append((sweep_audio, 'sweep.wav', True))
+    return clips
+
+def _first_fit(sizes, capacity):
+    # Each item goes to the first output it fits in, or to a new one
+    remaining = np.zeros(len(sizes))
+    bins = []
+    for idx, size in enumerate(sizes):
+        fits = remaining[:len(bins)] >= size
+        b = int(np.argmax(fits)) if len(bins) and fits.any() else len(bins)
+        if b == len(bins):
+            bins.append([])
+            remaining[b] = capacity
+        bins[b].append(idx)
+        remaining[b] -= size
+    return bins
+
+def _balanced(sizes, capacity):
+    # As few outputs as the total length allows, the longest items first go to the shortest output
+    numBins = max(1, int(np.ceil(sum(sizes) / capacity)))
+    heap = [(0.0, b) for b in range(numBins)]
+    bins = [[] for _ in range(numBins)]
+    for idx in sorted(range(len(sizes)), key=lambda idx: -sizes[idx]):
+        load, b = heapq.heappop(heap)
+        bins[b].append(idx)
+        heapq.heappush(heap, (load + sizes[idx], b))
+    # Keep the shuffled order within each output
+    return [sorted(members) for members in bins if members]
+
+PACKINGS = {'first_fit': _first_fit, 'balanced': _balanced}
+
+def pack_long_audios(input_files, sweep_audio, sweep_probability, root_dir, output_length_seconds, index=None, packing='first_fit'):
+    """
+    Plans all long audio files by bin packing the input files, consuming input_files.
+
+    Unlike plan_long_audios, which fills each output until it reaches output_length_seconds,
+    'first_fit' puts each file into the first output with room left, so outputs only exceed the
+    target length when a single file does not fit. 'balanced' spreads the files over as few outputs
+    as the total length allows, with similar lengths: an output can then exceed the target length,
+    by up to about the longest file.
+
+    Returns:
+        list: One clip list per output file, as returned by plan_long_audio.
 
+    Raises:
+        ValueError: If output_length_seconds leaves no room for files next to the sweep.
+    """
+    # The sweep at the end comes on top of the target length, as in plan_long_audio
+    capacity = output_length_seconds - sweep_audio.duration_seconds
+    if capacity <= 0:
+        raise ValueError(f"The output length ({output_length_seconds} s) must be longer than the sweep ({sweep_audio.duration_seconds:.2f} s)")
+
+    index = index or DurationIndex()
+    random.shuffle(input_files)
+
+    items = []
+    for name in input_files:
+        file = os.path.join(root_dir, name)
+        _, was_sweep_inserted = maybe_insert_sweep(sweep_audio, sweep_probability)
+        items.append((index.clip(file), file, was_sweep_inserted))
+    input_files.clear()
+
+    sizes = [clip.duration_seconds + (sweep_audio.duration_seconds if was_sweep_inserted else 0)
+             for clip, _, was_sweep_inserted in items]
+
+    plans = []
+    for members in PACKINGS[packing](sizes, capacity):
+        clips = [(sweep_audio, 'sweep.wav', True)]
+        for idx in members:
+            clip, file, was_sweep_inserted = items[idx]
+            clips.append((clip, file, False))
             if was_sweep_inserted:
-                sweep_start = end
-                sweep_end = sweep_start + sweep_segment.duration_seconds
-                file_info.append({'filename': 'sweep.wav', 'start': sweep_start, 'end': sweep_end, 'is_sweep': True})
+                clips.append((sweep_audio, 'sweep.wav', True))
+        clips.append((sweep_audio, 'sweep.wav', True))
+        plans.append(clips)
+    return plans
+
+@instrument.traced('plan')
+def plan_long_audios(input_files, sweep_audio, sweep_probability, root_dir, output_length_seconds, index=None, packing='sequential'):
+    """
+    Plans all long audio files up front, consuming input_files.
+
+    Args:
+        packing (str): 'sequential' fills the outputs one after the other with plan_long_audio,
+            'first_fit' and 'balanced' bin pack the files with pack_long_audios.
+
+    Returns:
+        list: One plan_long_audio clip list per output file.
+    """
+    if packing != 'sequential':
+        return pack_long_audios(input_files, sweep_audio, sweep_probability, root_dir, output_length_seconds, index, packing)
+    index = index or DurationIndex()
+    plans = []
+    while input_files:
+        plans.append(plan_long_audio(input_files, sweep_audio, sweep_probability, root_dir, output_length_seconds, index))
+    return plans
+
+def write_long_audio(clips, output_file, prefetch=2):
+    """
+    Writes the planned clips one after the other into a WAV file, in a single pass.
+
+    The output takes the highest sample rate, number of channels and sample width of the clips.
+    A reader thread decodes up to prefetch clips ahead of the one being written.
+
+    Returns:
+        tuple: The file info entries with the start and end of each clip, in seconds and in samples, and the output duration in seconds.
+    """
+    sample_rate = max(clip.sample_rate for clip, _, _ in clips)
+    channels = max(clip.channels for clip, _, _ in clips)
+    subtype = WAV_SUBTYPES[max(clip.sample_width for clip, _, _ in clips)]
+
+    file_info = []
+    position = 0
+    with sf.SoundFile(output_file, 'w', samplerate=sample_rate, channels=channels, subtype=subtype, format='WAV') as f, \
+            ThreadPoolExecutor(max_workers=1) as reader:
+        queue = deque()
+        for clip, filename, is_sweep in clips:
+            queue.append((reader.submit(clip.read, sample_rate, channels), filename, is_sweep))
+            if len(queue) > prefetch:
+                position = _write_next(f, queue, file_info, position, sample_rate)
+        while queue:
+            position = _write_next(f, queue, file_info, position, sample_rate)
 
-        # Add the sweep audio at the end
-        end_sweep_start = current_audio.duration_seconds
-        end_sweep_end = end_sweep_start + sweep_audio.duration_seconds
-        current_audio += sweep_audio
-        file_info.append({'filename': 'sweep.wav', 'start': end_sweep_start, 'end': end_sweep_end, 'is_sweep': True})
+    return file_info, position / sample_rate
 
-        output_file = os.path.join(output_dir, f'long_audio_{file_count:04}.wav')
-        current_audio.export(output_file, format="wav")
+def _write_next(f, queue, file_info, position, sample_rate):
+    data, filename, is_sweep = queue.popleft()
+    data = data.result()
+    with instrument.span('write'):
+        f.write(data)
+    start, end = position, position + data.shape[0]
+    file_info.append({'filename': filename, 'start': start / sample_rate, 'end': end / sample_rate, 'is_sweep': is_sweep,
+                      'start_sample': start, 'end_sample': end, 'sample_rate': sample_rate})
+    return end
 
-        with jsonlines.open(os.path.join(output_dir, f'long_audio_{file_count:04}_info.jsonl'), 'w') as info_file:
-            for entry in file_info:
-                info_file.write(entry)
+@instrument.traced('output')
+def _write_job(file_count, clips, output_dir):
+    output_file = os.path.join(output_dir, f'long_audio_{file_count:04}.wav')
+    file_info, duration = write_long_audio(clips, output_file)
 
-        print(f"Generated {output_file} with duration {current_audio.duration_seconds / 60.0} minutes")
+    with jsonlines.open(os.path.join(output_dir, f'long_audio_{file_count:04}_info.jsonl'), 'w') as info_file:
+        for entry in file_info:
+            info_file.write(entry)
+    return output_file, duration
 
-        file_count += 1
+def generate_long_audios(input_files, sweep_audio, output_dir, sweep_probability, root_dir, output_length_seconds, jobs=1, index=None, packing='sequential'):
+    """
+    Generates audio files of specified length by concatenating multiple input audio files and inserting sweep audio segments.
+
+    All files are planned before any is written, so the output only depends on the random seed,
+    not on the number of jobs.
+
+    Args:
+        input_files (list): List of input audio file paths relative to root_dir.
+        sweep_audio (AudioClip): The sweep audio clip.
+        output_dir (str): Directory to save the output audio files.
+        sweep_probability (float): Probability of inserting the sweep audio segment (0 to 1).
+        root_dir (str): Root directory containing the audio files.
+        output_length_seconds (int): Length of the output audio files in seconds.
+        jobs (int): Number of output files written in parallel by worker processes.
+        index (DurationIndex): Header cache of the input files. Default: an in-memory index.
+        packing (str): 'sequential', 'first_fit' or 'balanced', see plan_long_audios.
+    """
+    plans = plan_long_audios(input_files, sweep_audio, sweep_probability, root_dir, output_length_seconds, index, packing)
+    file_counts = range(1, len(plans) + 1)
+
+    if jobs <= 1:
+        for output_file, duration in map(_write_job, file_counts, plans, repeat(output_dir)):
+            print(f"Generated {output_file} with duration {duration / 60.0} minutes")
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for output_file, duration in executor.map(_write_job, file_counts, plans, repeat(output_dir)):
+            print(f"Generated {output_file} with duration {duration / 60.0} minutes")
 
 def main():
     """
@@ -86,18 +346,32 @@ def main():
     parser.add_argument('--sweep_probability', type=float, required=True, help="Probability of inserting the sweep audio file (0 to 1)")
     parser.add_argument('--root_dir', type=str, required=True, help="Root directory containing the audio files")
     parser.add_argument('--output_length', type=int, required=True, help="Length of the output audio files in seconds")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed, for reproducible outputs")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of output files written in parallel")
+    parser.add_argument('--packing', choices=['sequential', *PACKINGS], default='sequential', help="How input files are distributed over the outputs. 'sequential' fills one output after the other, 'first_fit' and 'balanced' bin pack the files to the output length. Default: sequential")
+    parser.add_argument('--duration_index', type=str, default=None, help="JSON file caching the header information of the input files between runs")
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
+    instrument.setup(args)
+
+    if args.seed is not None:
+        random.seed(args.seed)
 
     with open(args.input_list, 'r') as f:
         input_files = [line.strip() for line in f]
 
-    sweep_audio = AudioSegment.from_file(args.sweep_file)
+    sweep_audio = AudioClip.from_file(args.sweep_file)
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    generate_long_audios(input_files, sweep_audio, args.output_dir, args.sweep_probability, args.root_dir, args.output_length)
+    index = DurationIndex(args.duration_index)
+    try:
+        generate_long_audios(input_files, sweep_audio, args.output_dir, args.sweep_probability, args.root_dir, args.output_length,
+                             jobs=args.jobs, index=index, packing=args.packing)
+    finally:
+        index.save()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
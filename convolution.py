@@ -0,0 +1,357 @@
+from collections import OrderedDict
+
+import numpy as np
+from scipy import fft as sp_fft
+
+# Below this length on either side direct convolution beats any FFT method
+DIRECT_MAX_LENGTH = 64
+
+# Maximum number of impulse response spectra (one per FFT length) kept per convolver
+SPECTRUM_CACHE_SIZE = 8
+
+
+def _lru_get(cache, key, compute):
+    # Looks key up in an OrderedDict used as an LRU cache of SPECTRUM_CACHE_SIZE entries
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+    value = cache[key] = compute()
+    while len(cache) > SPECTRUM_CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+
+def _fft_cost(nfft):
+    return nfft * np.log2(nfft)
+
+
+def _oa_fft_length(ir_length):
+    # Blocks of a few IR lengths keep the per-sample overlap-add overhead low
+    return sp_fft.next_fast_len(8 * ir_length, real=True)
+
+
+def choose_method(signal_length, ir_length, spectrum_cached=True):
+    """
+    Picks the cheapest way to compute a full linear convolution.
+
+    :param signal_length: Number of samples of the signal.
+    :param ir_length: Number of samples of the impulse response.
+    :param spectrum_cached: Whether the IR spectrum for the 'fft' method is already computed. If not,
+                            its transform is counted, since overlap-add reuses one spectrum for every signal length.
+    :return: 'direct', 'fft' or 'oa' (overlap-add).
+    """
+    if min(signal_length, ir_length) <= DIRECT_MAX_LENGTH:
+        return 'direct'
+
+    direct_cost = signal_length * ir_length
+    # One forward and one inverse transform per call, plus the IR spectrum if it is not cached
+    nfft = sp_fft.next_fast_len(signal_length + ir_length - 1, real=True)
+    fft_cost = (2 if spectrum_cached else 3) * _fft_cost(nfft)
+    nfft_oa = _oa_fft_length(ir_length)
+    hop = nfft_oa - ir_length + 1
+    oa_cost = 2 * int(np.ceil(signal_length / hop)) * _fft_cost(nfft_oa)
+
+    costs = {'direct': direct_cost, 'fft': fft_cost, 'oa': oa_cost}
+    return min(costs, key=costs.get)
+
+
+class IRConvolver:
+    """
+    Convolves signals with a fixed impulse response.
+
+    The spectrum of the impulse response is computed once per FFT length and
+    reused, so convolving many files with the same IR only costs one forward
+    and one inverse transform per file. Overlap-add uses a single FFT length per
+    IR, whatever the signal length, while the 'fft' method needs one spectrum per
+    distinct signal length: the last SPECTRUM_CACHE_SIZE of them are kept.
+    """
+
+    def __init__(self, ir, method='auto'):
+        self.ir = np.asarray(ir)
+        if self.ir.ndim != 1:
+            raise ValueError('The impulse response must be one-dimensional')
+        self.method = method
+        self._spectra = OrderedDict()
+        self._partitions = OrderedDict()
+
+    def __len__(self):
+        return self.ir.shape[0]
+
+    def spectrum(self, nfft):
+        """Returns the (cached) real FFT of the impulse response of length nfft."""
+        return _lru_get(self._spectra, nfft, lambda: sp_fft.rfft(self.ir.astype(np.float64), nfft))
+
+    def partitioned(self, block_size):
+        """Returns a new PartitionedConvolver for streaming, sharing the cached partition spectra."""
+        spectra = _lru_get(self._partitions, block_size, lambda: partition_spectra(self.ir, block_size))
+        return PartitionedConvolver(self.ir, block_size, spectra=spectra)
+
+    def convolve(self, x, method=None):
+        """
+        Full linear convolution of x with the impulse response along axis 0.
+
+        :param x: Signal, either (samples,) or (samples, channels).
+        :param method: 'auto', 'direct', 'fft' or 'oa'. Defaults to the method given to the constructor.
+        :return: Array of length len(x) + len(ir) - 1 with the dtype of np.convolve.
+        """
+        # Transforms at the precision of the output, a float32 signal would make them complex64
+        x = np.asarray(x)
+        x = x.astype(np.result_type(x, self.ir), copy=False)
+        method = method or self.method
+        if method == 'auto':
+            nfft = sp_fft.next_fast_len(x.shape[0] + len(self) - 1, real=True)
+            method = choose_method(x.shape[0], len(self), spectrum_cached=nfft in self._spectra)
+
+        if method == 'direct':
+            y = self._direct(x)
+        elif method == 'fft':
+            y = self._fft(x)
+        elif method == 'oa':
+            y = self._overlap_add(x)
+        else:
+            raise ValueError(f'Unknown convolution method: {method}')
+
+        return y.astype(np.result_type(x, self.ir), copy=False)
+
+    def _direct(self, x):
+        if x.ndim == 1:
+            return np.convolve(x, self.ir, mode='full')
+        return np.stack([np.convolve(x[:, idx], self.ir, mode='full') for idx in range(x.shape[1])], axis=1)
+
+    def _broadcast(self, H, x):
+        # Spectra are along axis 0, extra channel axes are broadcast
+        return H.reshape(H.shape + (1,) * (x.ndim - 1))
+
+    def _fft(self, x):
+        outlen = x.shape[0] + len(self) - 1
+        nfft = sp_fft.next_fast_len(outlen, real=True)
+        X = sp_fft.rfft(x, nfft, axis=0)
+        X *= self._broadcast(self.spectrum(nfft), X)
+        return sp_fft.irfft(X, nfft, axis=0)[:outlen]
+
+    def _overlap_add(self, x):
+        irlen = len(self)
+        outlen = x.shape[0] + irlen - 1
+        nfft = _oa_fft_length(irlen)
+        hop = nfft - irlen + 1
+        numBlocks = int(np.ceil(x.shape[0] / hop))
+
+        # Split the signal into (blocks, hop, ...) and transform all blocks at once
+        padded = np.zeros((numBlocks * hop,) + x.shape[1:], dtype=x.dtype)
+        padded[:x.shape[0]] = x
+        blocks = padded.reshape((numBlocks, hop) + x.shape[1:])
+        X = sp_fft.rfft(blocks, nfft, axis=1)
+        X *= self._broadcast(self.spectrum(nfft), X[0])[np.newaxis]
+        y_blocks = sp_fft.irfft(X, nfft, axis=1)
+
+        # Each block tail (irlen - 1 <= hop samples) overlaps the head of the next block
+        y = np.zeros(((numBlocks + 1) * hop,) + x.shape[1:])
+        y[:numBlocks * hop] += y_blocks[:, :hop].reshape((numBlocks * hop,) + x.shape[1:])
+        tails = np.zeros_like(blocks, dtype=y.dtype)
+        tails[:, :irlen - 1] = y_blocks[:, hop:]
+        y[hop:] += tails.reshape((numBlocks * hop,) + x.shape[1:])
+        return y[:outlen]
+
+
+class IRBank:
+    """
+    A set of impulse responses applied together to the same signals.
+
+    The signal is transformed once and multiplied against the cached spectra of all impulse
+    responses, so producing N reverberant versions of a file costs one forward FFT instead of N.
+    With overlap-add the signal is transformed in fixed blocks, so one set of spectra is reused
+    for every signal length.
+    """
+
+    def __init__(self, irs, names=None, max_batch=8, method='auto'):
+        """
+        :param irs: List of one-dimensional impulse responses, possibly of different lengths.
+        :param names: Optional name for each impulse response.
+        :param max_batch: Number of impulse responses inverse-transformed at once, bounds the memory used per call.
+        :param method: 'auto', 'direct', 'fft' or 'oa', as for IRConvolver.
+        """
+        irs = [np.asarray(ir) for ir in irs]
+        if not irs or any(ir.ndim != 1 for ir in irs):
+            raise ValueError('The impulse responses must be a non-empty list of one-dimensional arrays')
+        if method not in ('auto', 'direct', 'fft', 'oa'):
+            raise ValueError(f'Unknown convolution method: {method}')
+        self.lengths = np.array([ir.shape[0] for ir in irs])
+        self.names = list(names) if names is not None else [str(idx) for idx in range(len(irs))]
+        self.dtype = np.result_type(*irs)
+        self.max_batch = max_batch
+        self.method = method
+
+        self.irs = np.zeros((len(irs), self.lengths.max()))
+        for idx, ir in enumerate(irs):
+            self.irs[idx, :ir.shape[0]] = ir
+        self._spectra = OrderedDict()
+
+    def __len__(self):
+        return self.irs.shape[0]
+
+    def spectra(self, nfft):
+        """Returns the (cached) real FFTs of all impulse responses, shape (len(self), nfft // 2 + 1)."""
+        return _lru_get(self._spectra, nfft, lambda: sp_fft.rfft(self.irs, nfft, axis=1))
+
+    def convolve(self, x, method=None):
+        """
+        Full linear convolution of the one-dimensional signal x with every impulse response.
+
+        :param method: 'auto', 'direct', 'fft' or 'oa'. Defaults to the method given to the constructor.
+        :return: Generator of (name, output) pairs, one per impulse response, in order.
+        """
+        x = np.asarray(x)
+        if x.ndim != 1:
+            raise ValueError('IRBank only convolves one-dimensional signals')
+        irlen = int(self.lengths.max())
+        method = method or self.method
+        if method == 'auto':
+            nfft = sp_fft.next_fast_len(x.shape[0] + irlen - 1, real=True)
+            method = choose_method(x.shape[0], irlen, spectrum_cached=nfft in self._spectra)
+        dtype = np.result_type(x, self.dtype)
+        # Transforms at the precision of the output, a float32 signal would make them complex64
+        x = x.astype(dtype, copy=False)
+
+        if method == 'direct':
+            for idx in range(len(self)):
+                yield self.names[idx], np.convolve(x, self.irs[idx, :self.lengths[idx]]).astype(dtype)
+            return
+        if method == 'fft':
+            batches = self._fft(x, irlen)
+        elif method == 'oa':
+            batches = self._overlap_add(x, irlen)
+        else:
+            raise ValueError(f'Unknown convolution method: {method}')
+
+        for first, Y in batches:
+            for idx in range(first, first + Y.shape[0]):
+                outlen = x.shape[0] + self.lengths[idx] - 1
+                yield self.names[idx], Y[idx - first, :outlen].astype(dtype)
+
+    def _batches(self):
+        for first in range(0, len(self), self.max_batch):
+            yield first, min(first + self.max_batch, len(self))
+
+    def _fft(self, x, irlen):
+        nfft = sp_fft.next_fast_len(x.shape[0] + irlen - 1, real=True)
+        X = sp_fft.rfft(x, nfft)
+        H = self.spectra(nfft)
+        for first, last in self._batches():
+            yield first, sp_fft.irfft(H[first:last] * X[np.newaxis], nfft, axis=1)
+
+    def _overlap_add(self, x, irlen):
+        nfft = _oa_fft_length(irlen)
+        hop = nfft - irlen + 1
+        numBlocks = int(np.ceil(x.shape[0] / hop))
+
+        # The blocks of the signal are transformed once for all impulse responses
+        padded = np.zeros(numBlocks * hop, dtype=x.dtype)
+        padded[:x.shape[0]] = x
+        X = sp_fft.rfft(padded.reshape(numBlocks, hop), nfft, axis=1)
+        H = self.spectra(nfft)
+
+        for first, last in self._batches():
+            # (batch, blocks, nfft): each block tail (irlen - 1 <= hop samples) overlaps the next block
+            y_blocks = sp_fft.irfft(H[first:last, np.newaxis] * X[np.newaxis], nfft, axis=2)
+            batch = last - first
+            y = np.zeros((batch, (numBlocks + 1) * hop))
+            y[:, :numBlocks * hop] = y_blocks[:, :, :hop].reshape(batch, numBlocks * hop)
+            tails = np.zeros((batch, numBlocks, hop))
+            tails[:, :, :irlen - 1] = y_blocks[:, :, hop:]
+            y[:, hop:] += tails.reshape(batch, numBlocks * hop)
+            yield first, y
+
+
+def partition_spectra(ir, block_size):
+    """
+    Splits the impulse response into partitions of block_size samples and transforms each one.
+
+    :return: Array of shape (partitions, block_size + 1) with the rfft of each zero-padded partition.
+    """
+    numPartitions = int(np.ceil(len(ir) / block_size))
+    partitions = np.zeros((numPartitions, block_size))
+    partitions.reshape(-1)[:len(ir)] = ir
+    return sp_fft.rfft(partitions, 2 * block_size, axis=1)
+
+
+class PartitionedConvolver:
+    """
+    Streaming convolution with a uniformly partitioned impulse response (overlap-save).
+
+    Blocks of block_size samples go in and the same number of output samples come out, so memory
+    does not depend on the length of the signal. The output is the same as the full linear
+    convolution, followed by flush() for the last len(ir) - 1 samples.
+    """
+
+    def __init__(self, ir, block_size, spectra=None):
+        self.ir = np.asarray(ir)
+        self.block_size = block_size
+        self.spectra = spectra if spectra is not None else partition_spectra(self.ir, block_size)
+        self.reset()
+
+    def reset(self):
+        """Clears the input history, to start a new signal with the same impulse response."""
+        self._inbuf = None
+        self._fdl = None
+        self._pos = 0
+        # Output of the zero padding after a short (last) block, returned first by flush()
+        self._carry = None
+
+    def _init_state(self, trailing_shape):
+        numPartitions, numBins = self.spectra.shape
+        self._inbuf = np.zeros((2 * self.block_size,) + trailing_shape)
+        self._fdl = np.zeros((numPartitions, numBins) + trailing_shape, dtype=complex)
+
+    def process(self, block):
+        """
+        Convolves the next block of the signal.
+
+        :param block: Array of shape (n,) or (n, channels) with n <= block_size. Only the last block may be shorter.
+        :return: The next n output samples.
+        """
+        block = np.asarray(block)
+        n = block.shape[0]
+        if n > self.block_size:
+            raise ValueError(f'Blocks must be at most {self.block_size} samples long')
+        if self._carry is not None:
+            raise ValueError('Only the last block may be shorter than block_size')
+        if self._fdl is None:
+            self._init_state(block.shape[1:])
+        self._dtype = np.result_type(block, self.ir)
+
+        B = self.block_size
+        self._inbuf[:B] = self._inbuf[B:]
+        self._inbuf[B:B + n] = block
+        self._inbuf[B + n:] = 0
+
+        numPartitions = self.spectra.shape[0]
+        self._pos = (self._pos + 1) % numPartitions
+        self._fdl[self._pos] = sp_fft.rfft(self._inbuf, axis=0)
+
+        # Partition p is applied to the input spectrum from p blocks ago, in slot (pos - p) % P:
+        # slots 0..pos take partitions pos..0 and slots pos+1..P-1 take partitions P-1..pos+1.
+        # Both products are summed over views, without a (P, bins, channels) temporary.
+        pos = self._pos
+        Y = np.einsum('pk,pk...->k...', self.spectra[pos::-1], self._fdl[:pos + 1])
+        if pos + 1 < numPartitions:
+            Y += np.einsum('pk,pk...->k...', self.spectra[:pos:-1], self._fdl[pos + 1:])
+        y = sp_fft.irfft(Y, 2 * B, axis=0)[B:].astype(self._dtype, copy=False)
+        if n < B:
+            self._carry = y[n:]
+        return y[:n]
+
+    def flush(self):
+        """Returns the remaining len(ir) - 1 output samples after the last block, one block at a time."""
+        if self._fdl is None:
+            return
+        remaining = len(self.ir) - 1
+        if self._carry is not None:
+            yield self._carry[:remaining]
+            remaining -= self._carry.shape[0]
+            self._carry = None
+        zeros = np.zeros((self.block_size,) + self._inbuf.shape[1:], dtype=self._dtype)
+        while remaining > 0:
+            n = min(remaining, self.block_size)
+            y = self.process(zeros)
+            yield y[:n]
+            remaining -= n
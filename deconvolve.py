@@ -1,16 +1,19 @@
 import os
 import sys
+import glob
+import csv
 import numpy as np
-import librosa
 import soundfile as sf
-import sounddevice as sd
 import json
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib import pyplot as plt
 
 # modules from this software
 import stimulus as stim
-import _parseargs as parse
-import utils as utils
+import audio_io
+import instrument
+from convolution import PartitionedConvolver
 
 
 # 
@@ -21,93 +24,151 @@ def replace_extension(filename, new_extension):
     new_filename = name + new_extension
     return new_filename
 
-# 
-def compute_tdecay(impulse_response_ori, sample_rate, DBdecay, plot=False, title=''):
-    
-    max_position = np.argmax(impulse_response_ori)
-
-    
-    impulse_response = impulse_response_ori[max_position:, :]
-    # Step 1: Calculate the energy of the impulse response
-    energy = impulse_response ** 2
+# Result of decay_analysis. For C channels and thresholds T:
+#   peak:         (C,) sample index of the maximum of each channel
+#   decay_curves: list of C Schroeder decay curves in dB, each starting at its channel peak
+#   times:        {T: (C,) time in seconds to decay by T dB, NaN if the curve does not reach -T dB}
+#   edt:          (C,) early decay time (6 times the time to decay by 10 dB), NaN if not reached
+#   windows:      {T: (start, stop)} samples around the peaks covering +-times[T] in every channel
+DecayAnalysis = namedtuple('DecayAnalysis', ['peak', 'decay_curves', 'times', 'edt', 'windows'])
 
-    # Step 2: Compute the cumulative sum in reverse
-    cumulative_energy = np.cumsum(energy[::-1])[::-1]
+# 
+@instrument.traced('decay_analysis')
+def decay_analysis(impulse_response, sample_rate, thresholds=[30, 60]):
+    """
+    Schroeder decay analysis of a (samples x channels) RIR for several thresholds at once.
 
-    # Step 3: Convert the cumulative sum to a decay curve in dB
-    decay_curve = 10 * np.log10(cumulative_energy / np.max(cumulative_energy))
+    The backward-integrated energy and decay curve are computed once per channel, and all
+    thresholds (plus the EDT) are read from it in one pass.
 
-    # Step 4: Find the time point where the decay curve crosses -Tdecay dB
-    t_Tdecay_point = np.where(decay_curve <= -DBdecay)[0]
+    :param impulse_response: RIR array of shape (samples,) or (samples, channels).
+    :param sample_rate: Sampling rate in Hz.
+    :param thresholds: Decays in dB, e.g. [20, 30, 60].
+    :return: DecayAnalysis.
+    """
+    if impulse_response.ndim == 1:
+        impulse_response = impulse_response[:, np.newaxis]
+    numChans = impulse_response.shape[1]
 
-    if len(t_Tdecay_point) == 0:
-        print("Warning: The decay curve does not reach -Tdecay dB")
-        return None
+    # EDT is read at -10 dB together with the requested thresholds
+    levels = np.concatenate((np.asarray(thresholds, dtype=float), [10.0]))
+    peak = np.argmax(impulse_response, axis=0)
+    crossings = np.full((levels.shape[0], numChans), np.nan)
+    decay_curves = []
 
-    # Step 5: Interpolate to get a more accurate TTdecay
-    index_Tdecay = t_Tdecay_point[0]
+    for idx in range(numChans):
+        # Energy, reverse cumulative sum and decay curve in dB from the peak onwards
+        energy = impulse_response[peak[idx]:, idx].astype(np.float64) ** 2
+        cumulative_energy = np.cumsum(energy[::-1])[::-1]
+        with np.errstate(divide='ignore'):
+            decay_curve = 10 * np.log10(cumulative_energy / cumulative_energy[0])
+        decay_curves.append(decay_curve)
 
-    # Calculate the exact point with linear interpolation
-    if index_Tdecay > 0:
-        t1 = index_Tdecay - 1
-        t2 = index_Tdecay
+        # The decay curve is non-increasing, so the first crossing of each level is a binary search
+        index = np.searchsorted(-decay_curve, levels, side='left')
+        reached = index < decay_curve.shape[0]
+        # Linear interpolation between the samples around the crossing
+        t2 = np.minimum(index, decay_curve.shape[0] - 1)
+        t1 = np.maximum(t2 - 1, 0)
         y1 = decay_curve[t1]
         y2 = decay_curve[t2]
-        t_Tdecay = t1 + (y1 + DBdecay) / (y1 - y2)
-    else:
-        t_Tdecay = index_Tdecay
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_interp = np.where(t2 > 0, t1 + (y1 + levels) / (y1 - y2), t2)
+        crossings[:, idx] = np.where(reached, t_interp, np.nan)
+
+    crossings = crossings / sample_rate
+    times = {T: crossings[k] for k, T in enumerate(thresholds)}
+    edt = 6 * crossings[-1]
+
+    windows = {}
+    for T in thresholds:
+        if np.any(np.isnan(times[T])):
+            windows[T] = None
+            continue
+        Tsamples = (times[T] * sample_rate).astype(int)
+        start = max(int(np.min(peak - Tsamples)), 0)
+        stop = int(np.max(peak + Tsamples))
+        windows[T] = (start, stop)
+
+    return DecayAnalysis(peak, decay_curves, times, edt, windows)
+
+
+def trim(impulse_response, window):
+    """RIR cut to a window of decay_analysis. This is a view, nothing is copied."""
+    return impulse_response[window[0]:window[1]]
+
+def trim0(impulse_response, window):
+    """RIR with everything outside a window of decay_analysis set to zero (same length as the RIR)."""
+    trimmed0 = np.zeros_like(impulse_response)
+    trimmed0[window[0]:window[1]] = impulse_response[window[0]:window[1]]
+    return trimmed0
+
+
+@instrument.traced('plot')
+def plot_decay_curve(decay_curve, sample_rate, DBdecay, title=''):
+    fig = plt.figure(figsize = (9,3))
+    t = np.arange(0, decay_curve.shape[0]) / sample_rate
+    plt.plot(t, decay_curve)
+    plt.grid()
+    plt.xlabel('Time (s)')
+    plt.ylabel('Decay curve (dB)')
+    plt.axhline(y=-DBdecay, color='r', linestyle='--', label=f'-{DBdecay} dB')
+    plt.legend()
+    plt.title(title)
+    plt.show()
+
+
+# 
+def compute_tdecay(impulse_response_ori, sample_rate, DBdecay, plot=False, title=''):
+    
+    analysis = decay_analysis(impulse_response_ori, sample_rate, [DBdecay])
+    window = analysis.windows[DBdecay]
+
+    if window is None:
+        print("Warning: The decay curve does not reach -Tdecay dB")
+        return None
 
-    # Convert samples to time
-    TTdecay = t_Tdecay / sample_rate
+    TTdecay = analysis.times[DBdecay]
+    TTdecay = TTdecay[0] if TTdecay.shape[0] == 1 else TTdecay
     print(f"Reverberation time (T{DBdecay}) is {TTdecay} seconds")
 
-    TTdecay_sample = int(TTdecay * sample_rate)
-    RIRtrimmed = impulse_response_ori.copy()
-    RIRtrimmed = RIRtrimmed[max_position-TTdecay_sample:max_position+TTdecay_sample,:]
-    RIRtrimmed0 = impulse_response_ori.copy()
-    RIRtrimmed0[0:max_position-TTdecay_sample,:] = 0
-    RIRtrimmed0[max_position+TTdecay_sample:,:] = 0
+    decay_curve = analysis.decay_curves[0]
+    RIRtrimmed = trim(impulse_response_ori, window)
+    RIRtrimmed0 = trim0(impulse_response_ori, window)
 
     if plot:
-        fig = plt.figure(figsize = (9,3))
-        t = np.arange(0, impulse_response.shape[0]) / sample_rate
-        plt.plot(t, decay_curve)
-        plt.grid()
-        plt.xlabel('Time (s)')
-        plt.ylabel('Decay curve (dB)')
-        plt.axhline(y=-DBdecay, color='r', linestyle='--', label=f'-{DBdecay} dB')
-        plt.legend()
-        plt.title(title)
-        plt.show()
+        plot_decay_curve(decay_curve, sample_rate, DBdecay, title)
 
     return TTdecay, decay_curve, RIRtrimmed, RIRtrimmed0
 
 
-def process(recorded_audio, sweep_conf_json, plot, Treverb=[30, 60]):
+@instrument.traced('process')
+def process(recorded_audio, sweep_conf_json, plot, Treverb=[30, 60], rir_length=None, rir_predelay=0.0, stimulus_cache=None):
     # 
     # recorded_audio='../recordings/REcbdb0b438839daebf0f87bb84af9d989_sigtest_fs16000_ss3_es1/sigtest_fs16000_ss3_es1_nokia_recording.wav'
     # original_audio='../recordings/REcbdb0b438839daebf0f87bb84af9d989_sigtest_fs16000_ss3_es1/sigtest_fs16000_ss3_es1.wav'
     # sys.argv = 'measure.py --fs 16000 -ss 3 -es 1'.split()
-    with open(sweep_conf_json, 'r') as f:
-        sweep_params = json.load(f)
+    sweep_params = read_sweep_params(sweep_conf_json)
     # 
     # sys.argv = command.split()
     # flag_defaultsInitialized = parse._checkdefaults()
     # args = parse._parse()
     # parse._defaults(args)
 
-    # Create a test signal object, and generate the excitation
-    testStimulus = stim.stimulus('sinesweep', sweep_params['fs'])
-    testStimulus.generate(sweep_params['fs'], sweep_params['duration'], sweep_params['amplitude'],sweep_params['reps'],sweep_params['startsilence'], sweep_params['endsilence'], sweep_params['sweeprange'])
+    # Create a test signal object, and generate the excitation (reused across calls)
+    testStimulus = get_stimulus(sweep_params, stimulus_cache)
 
     # 
     # Load recorded signal
-    x, fs = librosa.load(recorded_audio, sr=sweep_params['fs'])
+    x, fs = audio_io.read_audio(recorded_audio, sweep_params['fs'])
     x = np.expand_dims(x, 1)
 
     # 
-    # Deconvolve
-    impulse_response = testStimulus.deconvolve(x)
+    # Deconvolve, optionally only the window around the linear IR
+    window = None
+    if rir_length is not None:
+        window = testStimulus.irWindow(int(rir_length*fs), predelay=int(rir_predelay*fs))
+    impulse_response = testStimulus.deconvolve(x, window=window)
 
     # 
     maxval = np.max(impulse_response)
@@ -115,24 +176,294 @@ def process(recorded_audio, sweep_conf_json, plot, Treverb=[30, 60]):
     taxis = np.arange(0,impulse_response.shape[0]/fs,1/fs)
 
     if plot:
-        # Plot all on a single figure
-        plt.figure(figsize = (10,6))
-        plt.plot(taxis,impulse_response)
-        plt.ylim((minval+0.05*minval,maxval+0.05*maxval))
-        plt.title(f'RIR {recorded_audio}')
+        with instrument.span('plot'):
+            # Plot all on a single figure
+            plt.figure(figsize = (10,6))
+            plt.plot(taxis,impulse_response)
+            plt.ylim((minval+0.05*minval,maxval+0.05*maxval))
+            plt.title(f'RIR {recorded_audio}')
 
     # 
     output_RIR = replace_extension(recorded_audio, '_RIR.wav')
-    sf.write(output_RIR, impulse_response, fs)
+    with instrument.span('write'):
+        sf.write(output_RIR, impulse_response, fs)
     
+    # All thresholds from a single decay analysis
+    analysis = decay_analysis(impulse_response, fs, Treverb)
+
+    reverb_times = {}
     for T in Treverb:
-        T60, decay_curve_T, RIRtrimmed_T, RIRtrimmed0_T = compute_tdecay(impulse_response, fs, T, plot=plot, title=f'Decay curve RIR T{T}')
+        if analysis.windows[T] is None:
+            print("Warning: The decay curve does not reach -Tdecay dB")
+            reverb_times[T] = None
+            continue
+        reverb_times[T] = float(analysis.times[T][0])
+        print(f"Reverberation time (T{T}) is {reverb_times[T]} seconds")
+        if plot:
+            plot_decay_curve(analysis.decay_curves[0], fs, T, title=f'Decay curve RIR T{T}')
         
         output_RIR_trimmed_T = replace_extension(recorded_audio, f'_RIR_trimmed_T{T}.wav')
         output_RIR_trimmed0_T = replace_extension(recorded_audio, f'_RIR_trimmed0_T{T}.wav')
 
-        sf.write(output_RIR_trimmed_T, RIRtrimmed_T, fs)
-        sf.write(output_RIR_trimmed0_T, RIRtrimmed0_T, fs)
+        with instrument.span('write'):
+            sf.write(output_RIR_trimmed_T, trim(impulse_response, analysis.windows[T]), fs)
+            sf.write(output_RIR_trimmed0_T, trim0(impulse_response, analysis.windows[T]), fs)
+
+    return reverb_times
+
+
+@instrument.traced('detect_sweeps')
+def detect_sweeps(recording, testStimulus, rir_length, rir_predelay=0, floor=1e-3, threshold=0.0, block_size=None):
+    """
+    Finds every occurrence of the sweep in a long recording and deconvolves it, in a single pass.
+
+    The recording is convolved with the inverse filter block by block (uniformly partitioned
+    convolution), so memory does not depend on its length. Each sweep shows up as a linear IR peak
+    in the output, and peaks closer than the sweep period Lp are one occurrence: the largest one
+    (the linear IR) is kept, not the harmonic distortion IRs before it.
+
+    :param recording: One-dimensional recording, at the rate of the stimulus.
+    :param rir_length: Number of samples of each RIR after its linear IR peak.
+    :param rir_predelay: Number of samples of each RIR before the peak.
+    :param floor: Peaks below this magnitude are ignored (1 is the peak of a sweep played at the
+                  stimulus amplitude through a unit-gain channel).
+    :param threshold: Occurrences with a peak below this fraction of the strongest one are dropped
+                      as soon as they are found, before their RIR is extracted.
+    :param block_size: Block size of the convolution. Default: half the inverse filter length.
+    :return: List of (peak sample, peak magnitude, RIR of rir_predelay + rir_length samples), in order.
+    """
+    Lp = int(testStimulus.Lp)
+    block_size = block_size or max(int(2 ** np.ceil(np.log2(testStimulus.invfilter.shape[0] / 2))), 1024)
+    convolver = PartitionedConvolver(testStimulus.invfilter, block_size)
+    # Peaks are searched in windows of half a period, so a window never holds two occurrences
+    search_window = max(Lp // 2, 1)
+
+    occurrences = []
+    history = []
+    # Peak still competing with the peaks of the following period, and final peaks whose RIR is
+    # not complete yet
+    pending = None
+    waiting = []
+    produced = 0
+    strongest = 0.0
+
+    def kept(magnitude):
+        return magnitude >= max(floor, threshold * strongest)
+
+    def extract(peak):
+        # RIR samples [peak - rir_predelay, peak + rir_length) from the output blocks kept in history
+        rir = np.zeros(rir_predelay + rir_length)
+        for start, block in history:
+            first = max(start, peak - rir_predelay)
+            last = min(start + block.shape[0], peak + rir_length)
+            if last > first:
+                rir[first - peak + rir_predelay:last - peak + rir_predelay] = block[first - start:last - start]
+        return rir
+
+    def blocks():
+        for start in range(0, recording.shape[0], block_size):
+            yield convolver.process(recording[start:start + block_size])
+        yield from convolver.flush()
+
+    for output in blocks():
+        history.append((produced, output))
+        envelope = np.abs(output)
+        for first in range(0, output.shape[0], search_window):
+            index = first + int(np.argmax(envelope[first:first + search_window]))
+            magnitude = envelope[index]
+            if magnitude < floor:
+                continue
+            peak = produced + index
+            if magnitude > strongest:
+                # Earlier occurrences may fall below the threshold now, drop them with their RIRs
+                strongest = magnitude
+                waiting = [candidate for candidate in waiting if kept(candidate[1])]
+                occurrences = [occurrence for occurrence in occurrences if kept(occurrence[1])]
+            if pending is not None and peak - pending[0] < Lp:
+                if magnitude > pending[1]:
+                    pending = (peak, magnitude)
+            else:
+                if pending is not None and kept(pending[1]):
+                    waiting.append(pending)
+                pending = (peak, magnitude)
+        produced += output.shape[0]
+
+        # A pending peak is final once the following period is in, and its RIR is extracted once
+        # all of it is in
+        if pending is not None and produced >= pending[0] + Lp:
+            if kept(pending[1]):
+                waiting.append(pending)
+            pending = None
+        while waiting and produced >= waiting[0][0] + rir_length:
+            peak, magnitude = waiting.pop(0)
+            occurrences.append((peak, float(magnitude), extract(peak)))
+        # Only keep the output that later RIRs can still need: from rir_predelay before the oldest
+        # peak not extracted yet, or before the next block for the peaks still to come
+        peaks = [peak for peak, _ in waiting] + ([pending[0]] if pending is not None else [])
+        oldest = min(peaks + [produced]) - rir_predelay
+        history = [(start, block) for start, block in history if start + block.shape[0] > oldest]
+
+    for peak, magnitude in waiting + ([pending] if pending is not None else []):
+        if kept(magnitude):
+            occurrences.append((peak, float(magnitude), extract(peak)))
+    return occurrences
+
+
+@instrument.traced('process_sweeps')
+def process_sweeps(recorded_audio, sweep_conf_json, Treverb=[30, 60], rir_length=None, rir_predelay=0.0, threshold=0.3, stimulus_cache=None):
+    """
+    Deconvolves every sweep occurrence of a long recording (e.g. a call with the sweeps inserted by
+    concatenate_audio_files.py), writing one RIR per occurrence.
+
+    RIRs are written to <recording>_RIR_<n>.wav, and <recording>_sweeps.jsonl lists per occurrence
+    the start of the sweep in the recording, the linear IR peak and the reverberation times.
+
+    :param rir_length: Seconds of RIR after the linear IR peak. Default: the end silence of the sweep.
+    :param rir_predelay: Seconds of RIR before the linear IR peak.
+    :param threshold: Occurrences with a peak below this fraction of the strongest one are ignored.
+    :return: List of the JSONL entries.
+    """
+    sweep_params = read_sweep_params(sweep_conf_json)
+    testStimulus = get_stimulus(sweep_params, stimulus_cache)
+    x, fs = audio_io.read_audio(recorded_audio, sweep_params['fs'])
+
+    rir_length = int((rir_length if rir_length is not None else sweep_params['endsilence']) * fs)
+    predelay = int(rir_predelay * fs)
+    occurrences = detect_sweeps(x, testStimulus, rir_length, predelay, threshold=threshold)
+
+    entries = []
+    for n, (peak, magnitude, impulse_response) in enumerate(occurrences):
+        output_RIR = replace_extension(recorded_audio, f'_RIR_{n:04}.wav')
+        with instrument.span('write'):
+            sf.write(output_RIR, impulse_response, fs)
+
+        analysis = decay_analysis(impulse_response, fs, Treverb)
+        start = peak - testStimulus.linearIRStart
+        entry = {'index': n, 'start': start / fs, 'start_sample': int(start), 'peak_sample': int(peak),
+                 'peak': magnitude, 'rir': output_RIR}
+        for T in Treverb:
+            entry[f'T{T}'] = None if analysis.windows[T] is None else float(analysis.times[T][0])
+        entries.append(entry)
+        print(f"Sweep {n} at {entry['start']:.3f} s, peak {magnitude:.3f}, " +
+              ", ".join(f"T{T} {entry[f'T{T}']}" for T in Treverb))
+
+    with open(replace_extension(recorded_audio, '_sweeps.jsonl'), 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    return entries
+
+
+# Parameters of generate() that define a sweep, in the order generate() takes them
+SWEEP_KEYS = ['fs', 'duration', 'amplitude', 'reps', 'startsilence', 'endsilence', 'sweeprange']
+
+def read_sweep_params(sweep_conf_json):
+    with open(sweep_conf_json, 'r') as f:
+        return json.load(f)
+
+def sweep_config(sweep_params):
+    """Hashable key identifying the sweep described by the parameters of a sweep JSON file."""
+    return tuple(tuple(sweep_params[key]) if key == 'sweeprange' else sweep_params[key] for key in SWEEP_KEYS)
+
+
+# Stimuli already generated in this process, per sweep configuration. Keeping the object (and not
+# only the signals) also keeps its inverse filter spectrum between recordings. Least recently used
+# ones are dropped beyond stim.CACHE_SIZE configurations.
+_stimuli = OrderedDict()
+
+def get_stimulus(sweep_params, stimulus_cache=None):
+    config = sweep_config(sweep_params)
+    if config in _stimuli:
+        _stimuli.move_to_end(config)
+        return _stimuli[config]
+    testStimulus = stim.stimulus('sinesweep', sweep_params['fs'])
+    testStimulus.generate(*config, cachedir=stimulus_cache)
+    _stimuli[config] = testStimulus
+    while len(_stimuli) > stim.CACHE_SIZE:
+        _stimuli.popitem(last=False)
+    return testStimulus
+
+
+def find_recordings(batch, sweep_json=None, pattern='*.wav'):
+    """
+    Lists the (recorded_audio, sweep_json) pairs of a batch.
+
+    :param batch: A JSONL manifest with 'recorded_audio' and 'sweep_json' per line, a directory or a glob pattern.
+    :param sweep_json: Sweep JSON used for directories, globs and manifest lines without 'sweep_json'.
+    :param pattern: Glob pattern for recordings inside a directory. Outputs of this script (*_RIR*) are skipped.
+    """
+    if batch.endswith('.jsonl'):
+        jobs = []
+        with open(batch, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    jobs.append((entry['recorded_audio'], entry.get('sweep_json', sweep_json)))
+        return jobs
+
+    if os.path.isdir(batch):
+        files = glob.glob(os.path.join(batch, pattern))
+    else:
+        files = glob.glob(batch)
+    return [(f, sweep_json) for f in sorted(files) if '_RIR' not in os.path.basename(f)]
+
+
+def _process_job(recorded_audio, sweep_conf_json, kwargs):
+    if sweep_conf_json is None:
+        return None, "No sweep JSON: pass --sweep_json or give 'sweep_json' in the manifest"
+    try:
+        return process(recorded_audio, sweep_conf_json, plot=False, **kwargs), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def _config_key(sweep_conf_json):
+    # Sort key grouping the jobs by sweep configuration. Unreadable sweep JSON files sort first,
+    # their error is reported by _process_job
+    try:
+        return str(sweep_config(read_sweep_params(sweep_conf_json)))
+    except Exception:
+        return ''
+
+
+def process_batch(jobs, summary_file, Treverb=[30, 60], num_workers=1, **kwargs):
+    """
+    Deconvolves many recordings and writes a CSV summary with their reverberation times.
+
+    Jobs are grouped by sweep configuration, so each worker generates every stimulus (and its
+    inverse filter spectrum) only once. Errors are reported per recording without stopping the batch.
+
+    :param jobs: List of (recorded_audio, sweep_json) pairs, e.g. from find_recordings().
+    :param summary_file: Path of the CSV summary (one row per recording, one column per T).
+    :param num_workers: Number of worker processes.
+    :param kwargs: Other arguments of process() (rir_length, rir_predelay, stimulus_cache).
+    """
+    configs = {}
+    for recorded_audio, sweep_conf_json in jobs:
+        if sweep_conf_json not in configs:
+            configs[sweep_conf_json] = _config_key(sweep_conf_json)
+    jobs = sorted(jobs, key=lambda job: configs[job[1]])
+    kwargs['Treverb'] = Treverb
+
+    if num_workers <= 1:
+        results = [_process_job(recorded_audio, sweep_conf_json, kwargs) for recorded_audio, sweep_conf_json in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(_process_job, recorded_audio, sweep_conf_json, kwargs) for recorded_audio, sweep_conf_json in jobs]
+            results = [future.result() for future in futures]
+
+    num_errors = 0
+    with open(summary_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['recorded_audio', 'sweep_json'] + [f'T{T}' for T in Treverb] + ['error'])
+        for (recorded_audio, sweep_conf_json), (reverb_times, error) in zip(jobs, results):
+            if error is not None:
+                print(f"Error processing {recorded_audio}: {error}")
+                num_errors += 1
+                reverb_times = {}
+            writer.writerow([recorded_audio, sweep_conf_json] + [reverb_times.get(T) for T in Treverb] + [error or ''])
+
+    print(f"Processed {len(jobs)} recordings ({num_errors} errors), summary saved to {summary_file}")
+    return num_errors
 
 
 import argparse
@@ -143,16 +474,57 @@ def parse_arguments():
     parser.add_argument('--sweep_json', type=str, help='JSON file with sweep parameters. Example: "../recordings/REcbdb0b438839daebf0f87bb84af9d989_sigtest_fs16000_ss3_es1/sigtest_fs16000_ss3_es1.json"')
     parser.add_argument('--plot', action='store_true', help='Flag to enable plotting. Default: False')
     parser.add_argument('--Treverb', type=int, nargs='+', default=[30, 60], help='List of integers for reverberation times. Default: [30, 60]')
+    parser.add_argument('--rir_length', type=float, default=None, help='Only compute and save this many seconds of RIR after the linear IR onset. Default: full deconvolution output')
+    parser.add_argument('--rir_predelay', type=float, default=0.0, help='With --rir_length, also keep this many seconds before the linear IR (harmonic distortion). Default: 0')
+    parser.add_argument('--stimulus_cache', type=str, default=None, help='Directory where generated sweeps and inverse filters are cached as .npy files. Default: no disk cache')
+    parser.add_argument('--batch', type=str, default=None, help='Process many recordings: a directory, a glob pattern (with --sweep_json) or a JSONL manifest with "recorded_audio" and "sweep_json" per line')
+    parser.add_argument('--batch_pattern', type=str, default='*.wav', help='Pattern for recordings inside a --batch directory. Default: *.wav')
+    parser.add_argument('--summary', type=str, default='deconvolve_summary.csv', help='CSV file with the reverberation times of a --batch run. Default: deconvolve_summary.csv')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes for --batch. Default: 1')
+    parser.add_argument('--detect_sweeps', action='store_true', help='The recording holds many sweeps (e.g. a call with the sweeps of concatenate_audio_files.py): deconvolve every occurrence in one pass and write one RIR per occurrence plus a _sweeps.jsonl index')
+    parser.add_argument('--sweep_threshold', type=float, default=0.3, help='With --detect_sweeps, ignore occurrences whose peak is below this fraction of the strongest one. Default: 0.3')
+    instrument.add_arguments(parser)
 
     return parser.parse_args()
 
 def main():
     args = parse_arguments()
+    instrument.setup(args)
+    if args.batch:
+        if args.plot:
+            sys.exit('--plot is not supported with --batch')
+        jobs = find_recordings(args.batch, args.sweep_json, args.batch_pattern)
+        num_errors = process_batch(
+            jobs,
+            summary_file=args.summary,
+            Treverb=args.Treverb,
+            num_workers=args.jobs,
+            rir_length=args.rir_length,
+            rir_predelay=args.rir_predelay,
+            stimulus_cache=args.stimulus_cache
+        )
+        sys.exit(1 if num_errors else 0)
+
+    if args.detect_sweeps:
+        process_sweeps(
+            recorded_audio=args.recorded_audio,
+            sweep_conf_json=args.sweep_json,
+            Treverb=args.Treverb,
+            rir_length=args.rir_length,
+            rir_predelay=args.rir_predelay,
+            threshold=args.sweep_threshold,
+            stimulus_cache=args.stimulus_cache
+        )
+        return
+
     process(
         recorded_audio=args.recorded_audio,
         sweep_conf_json=args.sweep_json,        
         plot=args.plot,
-        Treverb=args.Treverb
+        Treverb=args.Treverb,
+        rir_length=args.rir_length,
+        rir_predelay=args.rir_predelay,
+        stimulus_cache=args.stimulus_cache
     )
 
 if __name__ == "__main__":
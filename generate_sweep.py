@@ -14,6 +14,7 @@ from scipy.io.wavfile import write as wavwrite
 
 # modules from this software
 import stimulus as stim
+import instrument
 from deconvolve import replace_extension
 
 def process(fs, duration, amplitude, reps, startsilence, endsilence, sweeprange):
@@ -42,13 +43,16 @@ def parse_arguments():
     parser.add_argument("-es", "--endsilence", type = int, help = "Duration of silence at the end of a sweep, in seconds. Default: 1.", default = 6)
     #---
     parser.add_argument("-o", "--output", type = str, help = "Output sweep audio file")
+    #---
+    instrument.add_arguments(parser)
 
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
-    d = vars(args)
+    instrument.setup(args)
+    d = {key: value for key, value in vars(args).items() if key not in ('profile', 'profile_top')}
     testStimulus = process(fs=args.fs, 
                            duration=args.duration,
                            amplitude=args.amplitude,
@@ -57,7 +61,8 @@ def main():
                            endsilence=args.endsilence,
                            sweeprange=args.sweeprange)
     
-    wavwrite(filename=args.output, rate=args.fs, data=testStimulus.signal)
+    with instrument.span('write'):
+        wavwrite(filename=args.output, rate=args.fs, data=testStimulus.signal)
     # sf.write(args.output, testStimulus.signal, args.fs)
     
     json_output = replace_extension(args.output, '.json')
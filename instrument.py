@@ -0,0 +1,234 @@
+import os
+import sys
+import csv
+import json
+import time
+import atexit
+import cProfile
+import heapq
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+from multiprocessing import util as mp_util
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then not recorded
+    resource = None
+
+# Set by enable(), so that worker processes (forked or spawned) record their spans too
+ENV_VAR = 'RIR_PROFILE'
+
+# Columns of the trace, in CSV order
+FIELDS = ['name', 'pid', 'thread', 'start', 'wall', 'cpu', 'peak_rss_mb', 'rss_increase_mb', 'read_mb', 'written_mb']
+
+# Returned by span() when instrumentation is disabled
+_NULL = nullcontext()
+
+_profiler = None
+
+
+def _peak_rss():
+    # Peak resident set size of the process in MB (ru_maxrss is in kB on Linux, in bytes on macOS)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _io_counters():
+    # Bytes read and written by the process, including the page cache (rchar/wchar), Linux only
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            counters = dict(line.split(b':') for line in f.read().splitlines())
+        return int(counters[b'rchar']), int(counters[b'wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _delta_mb(before, after, index):
+    if before is None or after is None:
+        return None
+    return (after[index] - before[index]) / 1024**2
+
+
+class _Profiler:
+    """
+    Collects the spans of one process.
+
+    The main process writes the trace at exit. Worker processes write their spans to
+    <path>.<pid>.part when they exit, and the main process merges those parts into its trace.
+    """
+
+    def __init__(self, path, top=0, main=True, origin=None):
+        self.path = path
+        self.top = top
+        self.pid = os.getpid()
+        # Span starts are relative to the start of the main process (perf_counter is system-wide)
+        self.origin = time.perf_counter() if origin is None else origin
+        self.records = []
+        # (wall, sequence, name, profile) of the top slowest profiled spans
+        self.slowest = []
+        self._sequence = 0
+        self._local = threading.local()
+        self._profiling = threading.Lock()
+        if main:
+            atexit.register(self.dump)
+        else:
+            mp_util.Finalize(self, self.dump_part, exitpriority=10)
+
+    def _check_fork(self):
+        # A forked worker inherits the parent profiler: it starts its own list of spans
+        if os.getpid() != self.pid:
+            self.__init__(self.path, self.top, main=False, origin=self.origin)
+
+    @contextmanager
+    def span(self, name):
+        self._check_fork()
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        path = '/'.join(stack)
+
+        # Only the outermost span of a thread is profiled, and one at a time
+        profile = None
+        if self.top > 0 and len(stack) == 1 and self._profiling.acquire(blocking=False):
+            profile = cProfile.Profile()
+
+        io_start = _io_counters()
+        rss_start = _peak_rss()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        if profile is not None:
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already active (e.g. inherited from the parent process)
+                self._profiling.release()
+                profile = None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            rss_end = _peak_rss()
+            io_end = _io_counters()
+            stack.pop()
+
+            self.records.append({
+                'name': path, 'pid': self.pid, 'thread': threading.current_thread().name,
+                'start': wall_start - self.origin, 'wall': wall, 'cpu': cpu,
+                'peak_rss_mb': rss_end, 'rss_increase_mb': None if rss_end is None else rss_end - rss_start,
+                'read_mb': _delta_mb(io_start, io_end, 0), 'written_mb': _delta_mb(io_start, io_end, 1),
+            })
+            if profile is not None:
+                self._sequence += 1
+                entry = (wall, self._sequence, path, profile)
+                if len(self.slowest) < self.top:
+                    heapq.heappush(self.slowest, entry)
+                else:
+                    heapq.heappushpop(self.slowest, entry)
+                self._profiling.release()
+
+    def _dump_profiles(self):
+        # <path>.<pid>.<rank>.<span>.prof, rank 1 being the slowest span of the process
+        base = os.path.splitext(self.path)[0]
+        for rank, (_, _, path, profile) in enumerate(sorted(self.slowest, reverse=True), 1):
+            profile.dump_stats(f"{base}.{self.pid}.{rank}.{path.replace('/', '_')}.prof")
+
+    def dump_part(self):
+        if not self.records:
+            return
+        with open(f'{self.path}.{self.pid}.part', 'w') as f:
+            json.dump(self.records, f)
+        self._dump_profiles()
+
+    def dump(self):
+        """Writes the trace, as CSV if the path ends with .csv and as JSON otherwise."""
+        records = list(self.records)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + '.'
+        for name in sorted(os.listdir(directory)):
+            if name.startswith(prefix) and name.endswith('.part'):
+                part = os.path.join(directory, name)
+                with open(part, 'r') as f:
+                    records += json.load(f)
+                os.remove(part)
+        records.sort(key=lambda record: (record['pid'] != self.pid, record['pid'], record['start']))
+        self._dump_profiles()
+
+        if self.path.endswith('.csv'):
+            with open(self.path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(records)
+            return
+
+        summary = {}
+        for record in records:
+            total = summary.setdefault(record['name'], {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+            total['count'] += 1
+            total['wall'] += record['wall']
+            total['cpu'] += record['cpu']
+        with open(self.path, 'w') as f:
+            json.dump({'pid': self.pid, 'spans': records, 'summary': summary}, f, indent=4)
+
+
+def span(name):
+    """
+    Context manager timing a named stage, e.g. with span('deconvolve'): ...
+
+    Spans nest: a span opened inside another one is recorded as 'outer/inner'. Each span records
+    its wall time, CPU time of the process, peak RSS (and its increase during the span) and the
+    bytes read and written. When instrumentation is disabled this returns a shared no-op context.
+    """
+    if _profiler is None:
+        return _NULL
+    return _profiler.span(name)
+
+
+def traced(name):
+    """Decorator running every call of the function in span(name)."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(path, top=0):
+    """
+    Records spans from now on and writes the trace to path when the program exits.
+
+    Worker processes started afterwards also record their spans, which are merged into the trace.
+
+    :param path: Trace file, CSV if it ends with .csv and JSON otherwise (spans plus per-name totals).
+    :param top: Also run the outermost spans under cProfile and dump the stats of the top slowest
+                ones per process to <path without extension>.<pid>.<rank>.<span>.prof. Profiling
+                slows the profiled spans down.
+    """
+    global _profiler
+    _profiler = _Profiler(os.path.abspath(path), top)
+    os.environ[ENV_VAR] = json.dumps([_profiler.path, top, _profiler.origin])
+
+
+def add_arguments(parser):
+    """Adds --profile and --profile_top to an argparse parser, see enable()."""
+    parser.add_argument('--profile', type=str, default=None, help='Write a trace of the time, CPU, memory and I/O of each processing stage to this JSON or CSV file')
+    parser.add_argument('--profile_top', type=int, default=0, help='With --profile, also dump cProfile stats of the N slowest stages. Default: 0')
+
+
+def setup(args):
+    """Enables instrumentation if the parsed arguments have --profile."""
+    if args.profile:
+        enable(args.profile, args.profile_top)
+
+
+# Spawned worker processes import this module again: pick up the profiler of the parent
+if ENV_VAR in os.environ and _profiler is None:
+    _path, _top, _origin = json.loads(os.environ[ENV_VAR])
+    _profiler = _Profiler(_path, _top, main=False, origin=_origin)
@@ -12,11 +12,13 @@ from matplotlib import pyplot as plt
 import stimulus as stim
 import _parseargs as parse
 import utils as utils
+import instrument
 
 # --- Parse command line arguments and check defaults
 flag_defaultsInitialized = parse._checkdefaults()
 args = parse._parse()
 parse._defaults(args)
+instrument.setup(args)
 # -------------------------------
 
 if flag_defaultsInitialized == True:
@@ -47,8 +49,9 @@ if flag_defaultsInitialized == True:
     elif args.test == True:
 
         deltapeak = stim.test_deconvolution(args)
-        plt.plot(deltapeak)
-        plt.show()
+        with instrument.span('plot'):
+            plt.plot(deltapeak)
+            plt.show()
 
     else:
 
@@ -56,20 +59,34 @@ if flag_defaultsInitialized == True:
         testStimulus = stim.stimulus('sinesweep', args.fs)
         testStimulus.generate(args.fs, args.duration, args.amplitude,args.reps,args.startsilence, args.endsilence, args.sweeprange)
 
-        # Record
-        recorded = utils.record(testStimulus.signal,args.fs,args.inputChannelMap,args.outputChannelMap)
+        # Deconvolve only the part of the RIR that is kept
+        lenRIR = 1.2
+        # save some more samples before linear part to check for nonlinearities
+        startIdToSave, endId = testStimulus.irWindow(int(lenRIR*args.fs), predelay = int(args.fs/2))
 
-        # Deconvolve
-        RIR = testStimulus.deconvolve(recorded)
+        # Record
+        if args.stream:
+            # Deconvolve the blocks while they are recorded, the RIR is ready when the recording ends
+            online = stim.OnlineDeconvolver(testStimulus, window = (startIdToSave, endId), blocksize = args.blocksize)
+            spillfile = utils.newSpillFile()
+            recorded, metrics = utils.record_stream(testStimulus.signal, args.fs, args.inputChannelMap, args.outputChannelMap,
+                                                    blocksize = args.blocksize, spillfile = spillfile,
+                                                    consumer = online.process)
+            print("Stream metrics:", metrics)
+            with instrument.span('deconvolve'):
+                RIRtoSave = online.result()
+        else:
+            recorded = utils.record(testStimulus.signal,args.fs,args.inputChannelMap,args.outputChannelMap)
+            RIRtoSave = testStimulus.deconvolve(recorded, window = (startIdToSave, endId))
 
         # Truncate
-        lenRIR = 1.2
-        startId = testStimulus.signal.shape[0] - args.endsilence*args.fs -1
-        endId = startId + int(lenRIR*args.fs)
-        # save some more samples before linear part to check for nonlinearities
-        startIdToSave = startId - int(args.fs/2)
-        RIRtoSave = RIR[startIdToSave:endId,:]
-        RIR = RIR[startId:endId,:]
+        startId = testStimulus.linearIRStart
+        RIR = RIRtoSave[startId-startIdToSave:,:]
 
         # Save recordings and RIRs
-        utils.saverecording(RIR, RIRtoSave, testStimulus.signal, recorded, args.fs)
+        store = utils.ResultStore(args.store) if args.store else None
+        utils.saverecording(RIR, RIRtoSave, testStimulus.signal, recorded, args.fs, store = store)
+        if args.stream:
+            # The captured signals are now saved with the measurement
+            del recorded
+            utils.removeAfterWrites(spillfile)
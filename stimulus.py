@@ -1,11 +1,18 @@
 from math import pi as pi
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
 import numpy as np
 from numpy import log as log
 from numpy import exp as exp
 from numpy import sin as sin
 from numpy import cos as cos
 from scipy import signal
-from scipy.signal import fftconvolve
+from scipy import fft as sp_fft
+
+from convolution import PartitionedConvolver
+import instrument
 
 class stimulus:
 
@@ -18,66 +25,32 @@ class stimulus:
         self.Lp = []
         self.signal = []
         self.invfilter = []
+        self._invfilterSpectra = {}
 
-    # Generate the stimulus and set requred attributes
-    def generate(self, fs, duration, amplitude, repetitions, silenceAtStart, silenceAtEnd,sweeprange):
+    # Generate the stimulus and set requred attributes.
+    # Generated signals are kept in an in-process LRU cache (see CACHE_SIZE) and, if cachedir is
+    # given, as .npy files in that directory, so the same sweep is only computed once.
+    # The cached arrays are shared between stimulus objects and therefore read-only.
+    def generate(self, fs, duration, amplitude, repetitions, silenceAtStart, silenceAtEnd,sweeprange, cachedir = None):
 
         if self.type == 'sinesweep':
 
-            f1 = np.max((sweeprange[0],1))             # start of sweep in Hz.
-            if sweeprange[1] == 0:
-                f2 = int(fs/2)      # end of sweep in Hz. Sweep till Nyquist to avoid ringing
-            else:
-                f2 = sweeprange[1]
-
-            w1 = 2*pi*f1/fs     # start of sweep in rad/sample
-            w2 = 2*pi*f2/fs     # end of sweep in rad/sample
-
-            numSamples = duration*fs
-            sinsweep = np.zeros(shape = (numSamples,1))
-            taxis = np.arange(0,numSamples,1)/(numSamples-1)
-
-            # for exponential sine sweeping
-            lw = log(w2/w1)
-            sinsweep = amplitude * sin(w1*(numSamples-1)/lw * (exp(taxis*lw)-1));
-
-            # Find the last zero crossing to avoid the need for fadeout
-            # Comment the whole block to remove this
-            k = np.flipud(sinsweep)
-            error = 1
-            counter = 0
-            while error > 0.001:
-                error = np.abs(k[counter])
-                counter = counter+1
-
-            k = k[counter::]
-            sinsweep_hat = np.flipud(k)
-            sinsweep = np.zeros(shape = (numSamples,))
-            sinsweep[0:sinsweep_hat.shape[0]] = sinsweep_hat
-
-            # the convolutional inverse
-            envelope = (w2/w1)**(-taxis); # Holters2009, Eq.(9)
-            invfilter = np.flipud(sinsweep)*envelope
-            scaling = pi*numSamples*(w1/w2-1)/(2*(w2-w1)*log(w1/w2))*(w2-w1)/pi; # Holters2009, Eq.10
-
-            # fade-in window. Fade out removed because causes ringing - cropping at zero cross instead
-            taperStart = signal.windows.tukey(numSamples,0)
-            taperWindow = np.ones(shape = (numSamples,))
-            taperWindow[0:int(numSamples/2)] = taperStart[0:int(numSamples/2)]
-            sinsweep = sinsweep*taperWindow
-
-            # Final excitation including repetition and pauses
-            sinsweep = np.expand_dims(sinsweep,axis = 1)
-            zerostart = np.zeros(shape = (silenceAtStart*fs,1))
-            zeroend = np.zeros(shape = (silenceAtEnd*fs,1))
-            sinsweep = np.concatenate((np.concatenate((zerostart, sinsweep), axis = 0), zeroend), axis=0)
-            sinsweep = np.transpose(np.tile(np.transpose(sinsweep),repetitions))
+            key = (fs, duration, amplitude, repetitions, silenceAtStart, silenceAtEnd, tuple(sweeprange))
+            with instrument.span('generate'):
+                sinsweep, invfilter = _cachedSinesweep(key, cachedir)
 
             # Set the attributes
             self.Lp = (silenceAtStart + silenceAtEnd + duration)*fs;
-            self.invfilter = invfilter/amplitude**2/scaling
+            self.invfilter = invfilter
             self.repetitions = repetitions
             self.signal = sinsweep
+            self._invfilterSpectra = {}
+
+            # Position of the linear IR in the deconvolved output, and the sweep rate needed
+            # to locate the harmonic distortion IRs before it
+            w1, w2 = _sweepFrequencies(fs, sweeprange)
+            self.linearIRStart = (silenceAtStart + duration)*fs - 1
+            self.harmonicRate = (duration*fs-1)/log(w2/w1)
 
         else:
 
@@ -85,36 +58,72 @@ class stimulus:
             return
 
 
-    def deconvolve(self,systemOutput):
+    # Real FFT of the inverse filter, computed once per FFT length and precision and reset by generate()
+    def invfilterSpectrum(self, nfft, dtype = np.float64):
+
+        key = (nfft, np.dtype(dtype))
+        if key not in self._invfilterSpectra:
+            spectrum = sp_fft.rfft(_fold(self.invfilter, nfft), nfft)
+            # Stored at the precision of the transforms it is multiplied with
+            self._invfilterSpectra[key] = spectrum.astype(np.result_type(dtype, np.complex64), copy=False)
+        return self._invfilterSpectra[key]
+
+
+    # Sample window (start, stop) of the deconvolved output holding the linear IR of the given
+    # length, preceded by predelay samples and/or by the first harmonic distortion IRs
+    # (orders 2 to harmonics+1, i.e. up to the start of order harmonics+2)
+    def irWindow(self, length, predelay = 0, harmonics = 0):
+
+        if harmonics > 0:
+            predelay = max(predelay, int(np.ceil(self.harmonicRate*log(harmonics+2))))
+        start = max(self.linearIRStart - predelay, 0)
+        stop = min(self.linearIRStart + length, self.invfilter.shape[0] + self.Lp - 1)
+        return start, stop
+
+
+    # Deconvolve all channels at once: one 2-D rfft along the time axis, multiplied by the
+    # (broadcast) inverse filter spectrum. workers is passed to scipy.fft, and dtype = np.float32
+    # runs the transforms in single precision to halve the memory.
+    # window = (start, stop), e.g. from irWindow(), returns only those samples of the output. Only
+    # the recording samples that reach the window, [start - len(invfilter) + 1, stop), are
+    # transformed, with a circular convolution just long enough not to alias into the window
+    # (overlap-save). The FFT is then about window + len(invfilter) long instead of
+    # len(invfilter) + Lp: the inverse filter is as long as the sweep, so this is ~2x shorter.
+    def deconvolve(self,systemOutput, workers = None, dtype = np.float64, window = None):
 
         if self.type == 'sinesweep':
 
-            numChans = systemOutput.shape[1]
-            systemOutputLen = systemOutput.shape[0]
-            tmplen = self.invfilter.shape[0] + self.Lp-1
-            RIRs = np.zeros(shape = (tmplen,numChans))
+            filterlen = self.invfilter.shape[0]
+            tmplen = filterlen + self.Lp-1
+            if window is None:
+                start, stop = 0, tmplen
+            else:
+                stop = min(window[1], tmplen)
+                start = min(max(window[0], 0), stop)
+            first = max(start - filterlen + 1, 0)
+            last = min(stop, self.Lp)
+            nfft = max(stop - first, last - start + filterlen - 1)
 
-            for idx in range(0,numChans):
+            # Same FFT length for every recording, so the inverse filter spectrum is reused
+            nfft = sp_fft.next_fast_len(nfft, real=True)
+            invfilterSpectrum = self.invfilterSpectrum(nfft, dtype)
 
-                #currentChannel = systemOutput[0:self.repetitions*self.Lp,idx]
-                # orig: problems with the length of the signal
-                # currentChannel = systemOutput[:,idx]
-                # javi: pad with zeros to match signal length
-                if systemOutputLen < self.Lp:
-                    currentChannel = np.pad(systemOutput[:,idx], (0, self.Lp - systemOutput[:,idx].shape[0]), 'constant')
-                else:
-                    currentChannel = systemOutput[:self.Lp,idx]
-                    
-                RIRs[:,idx] = fftconvolve(self.invfilter,currentChannel)
+            # javi: recordings shorter than the signal are zero padded (rfft pads up to nfft),
+            # longer ones are truncated to the signal length. The recording is cast first, so
+            # float32 recordings (sounddevice, audio_io) are deconvolved at the requested precision
+            currentChannels = systemOutput[first:last,:].astype(dtype, copy=False)
 
-                # # Average over the repetitions - DEPRECATED. Should not be done.
-                # sig_reshaped = currentChannel.reshape((self.repetitions,self.Lp))
-                # sig_avg = np.mean(sig_reshaped,axis = 0)
+            with instrument.span('deconvolve'):
+                spectra = sp_fft.rfft(currentChannels, nfft, axis=0, workers=workers)
+                spectra *= invfilterSpectrum[:,np.newaxis]
+                RIRs = sp_fft.irfft(spectra, nfft, axis=0, workers=workers)[start-first:stop-first,:]
 
-                # # Deconvolution
-                # RIRs[:,idx] = fftconvolve(self.invfilter,sig_avg);
+            # # Average over the repetitions - DEPRECATED. Should not be done.
+            # sig_reshaped = currentChannel.reshape((self.repetitions,self.Lp))
+            # sig_avg = np.mean(sig_reshaped,axis = 0)
 
-            return RIRs
+            # A copy, so that a short window does not keep the whole FFT buffer alive
+            return RIRs.astype(dtype)
 
         else:
 
@@ -124,8 +133,201 @@ class stimulus:
 # End of class definition
 # ===========================================================================
 # ===========================================================================
+
+# Deconvolution of a recording that is still in progress: blocks are fed as they are recorded
+# and convolved with the inverse filter of the stimulus by uniformly partitioned convolution, so
+# the RIR window is complete as soon as the recording reaches its end (i.e. within a block of
+# the end of the sweep for the linear IR), with no long FFT after the recording.
+# The result is the same as stimulus.deconvolve(recording, window = window).
+# The partitions are blocksize samples long, or longer for long inverse filters so that there are
+# at most MAX_PARTITIONS of them: the work per sample grows with the number of partitions, and
+# with short partitions a long sweep could not be deconvolved as fast as it is recorded.
+class OnlineDeconvolver:
+
+    MAX_PARTITIONS = 16
+
+    def __init__(self, stimulus, window = None, blocksize = 2048):
+
+        self.Lp = stimulus.Lp
+        tmplen = stimulus.invfilter.shape[0] + stimulus.Lp - 1
+        if window is None:
+            self.start, self.stop = 0, tmplen
+        else:
+            self.start, self.stop = max(window[0], 0), min(window[1], tmplen)
+        minPartition = int(2**np.ceil(np.log2(max(stimulus.invfilter.shape[0] / self.MAX_PARTITIONS, 1))))
+        self.blocksize = max(blocksize, minPartition)
+        self._convolver = PartitionedConvolver(stimulus.invfilter, self.blocksize)
+        self._pending = None
+        self._numPending = 0
+        self._received = 0
+        self._produced = 0
+        self._RIRs = None
+
+    # True once the whole window has been computed
+    def ready(self):
+
+        return self._produced >= self.stop
+
+    # Feed the next recorded samples, (samples, channels), in blocks of any length. Like
+    # deconvolve(), only the first Lp samples of the recording are used.
+    def process(self, block):
+
+        block = np.asarray(block)[:self.Lp - self._received]
+        if self._pending is None:
+            self._pending = np.zeros((self.blocksize,) + block.shape[1:])
+            self._RIRs = np.zeros((self.stop - self.start,) + block.shape[1:])
+        self._received += block.shape[0]
+
+        while block.shape[0] > 0 and not self.ready():
+            n = min(block.shape[0], self.blocksize - self._numPending)
+            self._pending[self._numPending:self._numPending + n] = block[:n]
+            self._numPending += n
+            block = block[n:]
+            if self._numPending == self.blocksize:
+                self._store(self._convolver.process(self._pending))
+                self._numPending = 0
+
+    # The deconvolved window, (stop - start, channels). A recording that ended before the end of
+    # the window is completed with silence, as deconvolve() zero pads short recordings.
+    def result(self):
+
+        if self._RIRs is None:
+            raise ValueError('No recorded samples were processed')
+        if not self.ready():
+            if self._numPending > 0:
+                self._store(self._convolver.process(self._pending[:self._numPending]))
+                self._numPending = 0
+            for tail in self._convolver.flush():
+                if self.ready():
+                    break
+                self._store(tail)
+        return self._RIRs
+
+    def _store(self, output):
+
+        # Copy the part of the output samples [produced, produced + len) inside the window
+        first = max(self.start, self._produced)
+        last = min(self.stop, self._produced + output.shape[0])
+        if last > first:
+            self._RIRs[first - self.start:last - self.start] = output[first - self._produced:last - self._produced]
+        self._produced += output.shape[0]
+
+# ===========================================================================
+# ===========================================================================
 # NON-CLASS FUNCTIONS
 
+# Maximum number of generated stimuli kept in memory
+CACHE_SIZE = 8
+_cache = OrderedDict()
+
+def clearCache():
+
+    _cache.clear()
+
+
+def _sweepFrequencies(fs, sweeprange):
+
+    f1 = np.max((sweeprange[0],1))             # start of sweep in Hz.
+    if sweeprange[1] == 0:
+        f2 = int(fs/2)      # end of sweep in Hz. Sweep till Nyquist to avoid ringing
+    else:
+        f2 = sweeprange[1]
+
+    w1 = 2*pi*f1/fs     # start of sweep in rad/sample
+    w2 = 2*pi*f2/fs     # end of sweep in rad/sample
+    return w1, w2
+
+
+# Look the sweep up in the in-memory cache, then on disk, and only generate it if needed
+def _cachedSinesweep(key, cachedir):
+
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    arrays = None
+    if cachedir is not None:
+        name = 'sinesweep_' + hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        signalFile = os.path.join(cachedir, name + '_signal.npy')
+        invfilterFile = os.path.join(cachedir, name + '_invfilter.npy')
+        if os.path.exists(signalFile) and os.path.exists(invfilterFile):
+            arrays = (np.load(signalFile, mmap_mode = 'r'), np.load(invfilterFile, mmap_mode = 'r'))
+
+    if arrays is None:
+        arrays = _generateSinesweep(*key)
+        if cachedir is not None:
+            os.makedirs(cachedir, exist_ok = True)
+            # The inverse filter goes first: the pair is complete once the signal file exists
+            _saveAtomic(invfilterFile, arrays[1])
+            _saveAtomic(signalFile, arrays[0])
+
+    for array in arrays:
+        array.flags.writeable = False
+    _cache[key] = arrays
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last = False)
+    return arrays
+
+
+# Write to a temporary file in the same directory first, so that other processes sharing the
+# cache never map a half-written file
+def _saveAtomic(path, array):
+
+    fd, tmpPath = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+
+
+def _generateSinesweep(fs, duration, amplitude, repetitions, silenceAtStart, silenceAtEnd, sweeprange):
+
+    w1, w2 = _sweepFrequencies(fs, sweeprange)
+
+    numSamples = duration*fs
+    taxis = np.arange(0,numSamples,1)/(numSamples-1)
+
+    # for exponential sine sweeping
+    lw = log(w2/w1)
+    sinsweep = amplitude * sin(w1*(numSamples-1)/lw * (exp(taxis*lw)-1));
+
+    # Find the last zero crossing to avoid the need for fadeout: everything after the last
+    # sample with magnitude <= 0.001, and that sample itself, is set to zero
+    # Comment the whole block to remove this
+    counter = np.argmax(np.abs(sinsweep[::-1]) <= 0.001)
+    sinsweep[numSamples-counter-1:] = 0
+
+    # the convolutional inverse
+    envelope = (w2/w1)**(-taxis); # Holters2009, Eq.(9)
+    invfilter = sinsweep[::-1]*envelope
+    scaling = pi*numSamples*(w1/w2-1)/(2*(w2-w1)*log(w1/w2))*(w2-w1)/pi; # Holters2009, Eq.10
+    invfilter = invfilter/amplitude**2/scaling
+
+    # fade-in window. Fade out removed because causes ringing - cropping at zero cross instead
+    taperStart = signal.windows.tukey(numSamples,0)
+    sinsweep[0:int(numSamples/2)] *= taperStart[0:int(numSamples/2)]
+
+    # Final excitation including repetition and pauses, written in place
+    Lp = (silenceAtStart + silenceAtEnd + duration)*fs
+    excitation = np.zeros(shape = (repetitions, Lp))
+    excitation[:, silenceAtStart*fs:silenceAtStart*fs + numSamples] = sinsweep
+
+    return excitation.reshape((repetitions*Lp, 1)), invfilter
+
+# Wrap a signal around a circular buffer of length n (along axis 0): a circular convolution of
+# length n of the folded signals equals the linear convolution aliased modulo n
+def _fold(x, n):
+
+    if x.shape[0] <= n:
+        return x
+    numFolds = int(np.ceil(x.shape[0]/n))
+    padded = np.zeros((numFolds*n,) + x.shape[1:], dtype = x.dtype)
+    padded[:x.shape[0]] = x
+    return padded.reshape((numFolds, n) + x.shape[1:]).sum(axis = 0)
+
 def test_deconvolution(args):
 
     type = 'sinesweep'
@@ -143,8 +345,7 @@ def test_deconvolution(args):
     # Create a test signal object, and generate the excitation
     testStimulus = stimulus(type,fs);
     testStimulus.generate(fs, duration, amplitude,repetitions,silenceAtStart, silenceAtEnd,sweeprange)
-    deltapeak = testStimulus.deconvolve(testStimulus.signal)
     startid = duration*fs + silenceAtStart*fs -150
-    deltapeak = deltapeak[startid:startid + 300]
+    deltapeak = testStimulus.deconvolve(testStimulus.signal, window = (startid, startid + 300))
 
     return deltapeak
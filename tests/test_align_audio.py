@@ -0,0 +1,113 @@
+import json
+
+import numpy as np
+import pytest
+from scipy.signal import correlate
+
+import align_audio
+
+
+def _delayed(rng, length, delay):
+    # Lowpass noise (speech-like spectrum, survives decimation) and a noisy copy delayed by delay
+    original = np.convolve(rng.standard_normal(length + 64), np.hanning(16), mode='same')[:length]
+    recorded = np.zeros(length)
+    if delay >= 0:
+        recorded[delay:] = original[:length - delay]
+    else:
+        recorded[:length + delay] = original[-delay:]
+    return original, recorded + 0.05 * rng.standard_normal(length)
+
+
+@pytest.mark.parametrize('delay', [-1234, -7, 0, 3, 2501])
+@pytest.mark.parametrize('max_lag, decimation', [(None, 1), (4000, 1), (None, 4), (4000, 4), (4000, 8)])
+def test_find_delay_matches_full_correlation(delay, max_lag, decimation):
+    rng = np.random.default_rng(abs(delay))
+    original, recorded = _delayed(rng, 40000, delay)
+    full = correlate(original, recorded, mode='full', method='fft')
+    reference = int(np.argmax(full)) - len(recorded) + 1
+    assert reference == -delay
+
+    assert align_audio.find_delay(original, recorded, max_lag=max_lag, decimation=decimation) == reference
+
+
+def test_correlate_lags_matches_full_correlation():
+    rng = np.random.default_rng(3)
+    original, recorded = _delayed(rng, 10000, 100)
+    full = correlate(original, recorded, mode='full', method='direct')
+    for min_lag, max_lag in [(-50, 50), (-9999, -9000), (9000, 10500)]:
+        correlated = align_audio.correlate_lags(original, recorded, min_lag, max_lag, block_size=1024)
+        lags = np.arange(min_lag, max_lag + 1)
+        inside = (lags > -len(recorded)) & (lags < len(original))
+        expected = np.zeros(len(lags))
+        expected[inside] = full[lags[inside] + len(recorded) - 1]
+        assert np.max(np.abs(correlated - expected)) < 1e-8
+
+
+def test_find_delay_subsample():
+    # A fractional delay of 0.3 samples, made with a windowed sinc
+    rng = np.random.default_rng(4)
+    original = np.convolve(rng.standard_normal(20064), np.hanning(16), mode='same')[:20000]
+    taps = np.arange(-32, 33)
+    recorded = np.convolve(original, np.sinc(taps - 0.3) * np.hanning(65), mode='same')
+    delay = align_audio.find_delay(original, recorded, max_lag=100, decimation=4, subsample=True)
+    assert delay == pytest.approx(-0.3, abs=0.05)
+
+
+def test_global_max_lag_samples():
+    assert align_audio.global_max_lag_samples(align_audio.GLOBAL_MAX_LAG, 8000) == 240000
+    assert align_audio.global_max_lag_samples(0, 8000) is None
+
+
+@pytest.mark.parametrize('true_lag', [-480, -400, -333])
+def test_align_segment_matches_full_correlation(true_lag):
+    # A segment of the original, and a recorded chunk starting offset samples before it
+    rng = np.random.default_rng(5)
+    original, _ = _delayed(rng, 20000, 0)
+    segment = original[5000:9000]
+    offset, max_lag = 400, 100
+    chunk = original[5000 + true_lag:5000 + true_lag + 4800] + 0.01 * rng.standard_normal(4800)
+
+    delay, peak, confidence = align_audio.align_segment(segment, chunk, offset, max_lag, block_size=1024)
+
+    # Reference: argmax of the full correlation over the same lag range
+    full = correlate(segment, chunk, mode='full', method='direct')
+    lags = np.arange(-offset - max_lag, -offset + max_lag + 1)
+    index = int(np.argmax(full[lags + len(chunk) - 1]))
+    assert delay == lags[index] == true_lag
+    assert peak == pytest.approx(full[lags[index] + len(chunk) - 1])
+    assert 0.99 < confidence <= 1.0
+
+
+def test_fit_drift_recovers_rate_and_rejects_outliers():
+    original = np.arange(10) * 100000.0
+    recorded = 12.5 + (1 + 150e-6) * original
+    recorded[4] += 500
+    offset, rate, inliers = align_audio.fit_drift(original, recorded, tolerance=5)
+    assert offset == pytest.approx(12.5, abs=1e-6)
+    assert (rate - 1) * 1e6 == pytest.approx(150, abs=1e-6)
+    assert inliers.tolist() == [idx != 4 for idx in range(10)]
+
+
+def test_estimate_drift_recovers_ppm_offset():
+    fs = 8000
+    sweep_params = {'fs': fs, 'duration': 1, 'amplitude': 0.5, 'reps': 1, 'startsilence': 0, 'endsilence': 1, 'sweeprange': [0, 0]}
+    sweep = align_audio.get_stimulus(sweep_params).signal[:, 0]
+    # 200 ppm fast clock and a 5 sample offset: the sweeps at multiples of 5000 samples land on
+    # whole samples of the recording
+    offset, rate = 5, 1 + 200e-6
+    starts = [5000, 60000, 120000, 180000]
+    rng = np.random.default_rng(6)
+    recorded = 0.01 * rng.standard_normal(200000)
+    lines = []
+    for start in starts:
+        position = offset + int(round(rate * start))
+        recorded[position:position + sweep.shape[0]] += sweep
+        lines.append(json.dumps({'filename': 'sweep.wav', 'is_sweep': True, 'start': start / fs, 'start_sample': start, 'sample_rate': fs}))
+        lines.append(json.dumps({'filename': 'speech.wav', 'is_sweep': False, 'start': (start + 2 * fs) / fs}))
+
+    estimate = align_audio.estimate_drift(lines, recorded, sweep_params, fs, search=int(0.25 * fs), tolerance=40)
+    estimated_offset, estimated_rate, anchors = estimate
+    assert estimated_offset == pytest.approx(offset, abs=0.5)
+    assert (estimated_rate - 1) * 1e6 == pytest.approx(200, abs=2)
+    assert [anchor[0] for anchor in anchors] == starts
+    assert all(kept for *_, kept in anchors)
@@ -0,0 +1,42 @@
+import argparse
+import json
+
+import numpy as np
+import soundfile as sf
+
+import audio_io
+from align_sessions import align_session
+
+
+def test_read_audio_mono_file_is_one_dimensional(tmp_path):
+    sf.write(tmp_path / 'mono.wav', np.zeros(100, dtype=np.float32), 8000, subtype='FLOAT')
+    for kwargs in [{}, {'mono': False}, {'channel': 1}]:
+        audio, _ = audio_io.read_audio(str(tmp_path / 'mono.wav'), 8000, **kwargs)
+        assert audio.shape == (100,)
+
+
+def test_mono_original_with_stereo_recording(tmp_path):
+    # concatenate_audio_files.py writes mono originals, the recording has the call on channel 1
+    SR = 8000
+    session = 'session'
+    rng = np.random.default_rng(0)
+    original = 0.1 * rng.standard_normal(4 * SR).astype(np.float32)
+    delay = 123
+    recorded = np.zeros((4 * SR + delay, 2), dtype=np.float32)
+    recorded[delay:, 1] = original
+    sf.write(tmp_path / f'{session}_original.wav', original, SR, subtype='FLOAT')
+    sf.write(tmp_path / f'{session}_twilio.wav', recorded, SR, subtype='FLOAT')
+    with open(tmp_path / f'{session}_info.jsonl', 'w') as f:
+        for n, (start, end) in enumerate([(0, 2 * SR), (2 * SR, 4 * SR)]):
+            f.write(json.dumps({'filename': f'clip{n}.wav', 'start': start / SR, 'end': end / SR, 'is_sweep': False,
+                                'start_sample': start, 'end_sample': end, 'sample_rate': SR}) + '\n')
+
+    args = argparse.Namespace(sample_rate=SR, recordings_dir=str(tmp_path), report_dir=None, global_max_lag=None,
+                              decimation=4, max_lag=0.25, basedir='', output_dir=str(tmp_path / 'out'), plot=False)
+    report = align_session(session, [('twilio', 1)], args)
+
+    variant = report['variants'][0]
+    assert 'error' not in variant
+    assert variant['global_delay'] == -delay
+    assert variant['errors'] == 0
+    assert len(variant['segments']) == 2
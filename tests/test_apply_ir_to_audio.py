@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import soundfile as sf
+
+import apply_ir_to_audio
+from convolution import IRConvolver, IRBank
+
+
+def test_stream_matches_in_memory_path_when_resampling(tmp_path):
+    rng = np.random.default_rng(0)
+    audio_file = str(tmp_path / 'audio.wav')
+    # File rate differs from the processing rate, and the file is stereo
+    sf.write(audio_file, 0.1 * rng.standard_normal((16000 * 3 + 123, 2)), 16000, subtype='FLOAT')
+    ir = rng.standard_normal(3000) * np.exp(-np.arange(3000) / 500.0)
+    convolver = IRConvolver(ir)
+
+    apply_ir_to_audio.process(audio_file, convolver, 22050, 'memory.wav', '')
+    apply_ir_to_audio.process_stream(audio_file, convolver, 22050, 'stream.wav', '', block_size=4096)
+
+    in_memory, in_memory_rate = sf.read(str(tmp_path / 'audio_memory.wav'))
+    streamed, streamed_rate = sf.read(str(tmp_path / 'audio_stream.wav'))
+    assert streamed_rate == in_memory_rate == 22050
+    assert streamed.shape == in_memory.shape
+    # Both are written as 16-bit PCM
+    assert np.max(np.abs(streamed - in_memory)) <= 1.0 / 32768
+
+
+def test_bank_writes_one_output_per_ir_equal_to_single_ir_output(tmp_path):
+    rng = np.random.default_rng(1)
+    audio_file = str(tmp_path / 'audio.wav')
+    sf.write(audio_file, 0.1 * rng.standard_normal(16000), 16000, subtype='FLOAT')
+    # Two impulse responses with the same base name in different directories
+    ir_files = [str(tmp_path / room / 'ir.wav') for room in ['roomA', 'roomB']]
+    irs = []
+    for ir_file in ir_files:
+        os.makedirs(os.path.dirname(ir_file))
+        irs.append(0.5 * rng.standard_normal(500) * np.exp(-np.arange(500) / 100.0))
+        sf.write(ir_file, irs[-1], 16000, subtype='FLOAT')
+
+    names = apply_ir_to_audio.ir_names(ir_files)
+    assert names == ['roomA_ir.wav', 'roomB_ir.wav']
+    assert apply_ir_to_audio.ir_names(ir_files + ir_files[:1]) is None
+
+    apply_ir_to_audio.process_bank(audio_file, IRBank(irs, names=names), 16000, '')
+    for name, ir in zip(names, irs):
+        bank_output, _ = sf.read(str(tmp_path / ('audio_' + name)))
+        apply_ir_to_audio.process(audio_file, IRConvolver(ir), 16000, 'single.wav', '')
+        single_output, _ = sf.read(str(tmp_path / 'audio_single.wav'))
+        assert bank_output.shape == single_output.shape
+        assert np.max(np.abs(bank_output - single_output)) <= 1.0 / 32768
+    assert sorted(name for name in os.listdir(tmp_path) if name.startswith('audio_')) == ['audio_roomA_ir.wav', 'audio_roomB_ir.wav', 'audio_single.wav']
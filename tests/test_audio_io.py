@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+import audio_io
+
+
+@pytest.mark.parametrize('orig_sr, target_sr', [(44100, 22050), (16000, 22050), (48000, 16000), (8000, 48000)])
+@pytest.mark.parametrize('block_size', [1, 100, 4096])
+def test_block_resampler_matches_resample(orig_sr, target_sr, block_size):
+    rng = np.random.default_rng(0)
+    x = rng.standard_normal(12345).astype(np.float32)
+    resampler = audio_io.BlockResampler(orig_sr, target_sr)
+    blocks = [resampler.process(x[start:start + block_size]) for start in range(0, x.shape[0], block_size)]
+    y = np.concatenate(blocks + [resampler.flush()])
+
+    reference = audio_io.resample(x, orig_sr, target_sr)
+    assert y.dtype == np.float32
+    assert y.shape == reference.shape
+    assert np.max(np.abs(y - reference)) < 1e-6
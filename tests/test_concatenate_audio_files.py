@@ -0,0 +1,119 @@
+import os
+import random
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+import audio_io
+import concatenate_audio_files as concatenate
+
+
+def _clip(tmp_path, name, data, sample_rate, subtype='PCM_16'):
+    path = str(tmp_path / name)
+    sf.write(path, data, sample_rate, subtype=subtype)
+    return concatenate.AudioClip.from_file(path)
+
+
+def test_write_long_audio_is_sample_exact(tmp_path):
+    rng = np.random.default_rng(0)
+    first = (rng.integers(-2 ** 15, 2 ** 15, 1234)).astype(np.int16)
+    second = (rng.integers(-2 ** 15, 2 ** 15, 777)).astype(np.int16)
+    # A clip at another rate is resampled to the output rate
+    low_rate = 0.1 * rng.standard_normal(800)
+    clips = [(_clip(tmp_path, 'first.wav', first, 16000), 'first.wav', False),
+             (_clip(tmp_path, 'low.wav', low_rate, 8000, subtype='FLOAT'), 'low.wav', False),
+             (_clip(tmp_path, 'second.wav', second, 16000), 'second.wav', True)]
+
+    output_file = str(tmp_path / 'long.wav')
+    file_info, duration = concatenate.write_long_audio(clips, output_file)
+
+    output, sample_rate = sf.read(output_file, dtype='int16')
+    assert sample_rate == 16000
+    assert sf.info(output_file).subtype == 'PCM_32'
+    assert [entry['start_sample'] for entry in file_info] == [0, 1234, 1234 + 1600]
+    assert [entry['end_sample'] for entry in file_info] == [1234, 1234 + 1600, 1234 + 1600 + 777]
+    assert [entry['is_sweep'] for entry in file_info] == [False, False, True]
+    assert duration == (1234 + 1600 + 777) / 16000
+    assert output.shape[0] == file_info[-1]['end_sample']
+
+    # PCM clips at the output rate are copied bit for bit (the 32-bit output holds them in its top bits)
+    output32, _ = sf.read(output_file, dtype='int32')
+    assert np.array_equal(output32[:1234] >> 16, first)
+    assert np.array_equal(output32[1234 + 1600:] >> 16, second)
+    # The other clip is the resampled one, as long as AudioClip.output_frames says
+    resampled = audio_io.resample(low_rate, 8000, 16000)
+    assert clips[1][0].output_frames(16000) == resampled.shape[0] == 1600
+    low, _ = sf.read(output_file, start=1234, stop=1234 + 1600)
+    assert np.max(np.abs(low - resampled)) < 1e-6
+
+
+def _corpus(tmp_path, seconds):
+    names = []
+    for idx, duration in enumerate(seconds):
+        names.append(f'{idx}.wav')
+        sf.write(str(tmp_path / names[-1]), np.zeros(int(duration * 100), dtype=np.int16), 100, subtype='PCM_16')
+    return names
+
+
+def _packed_lengths(plans):
+    # Seconds of input files per output, and the files of each output
+    lengths, files = [], []
+    for clips in plans:
+        assert clips[0][2] and clips[-1][2]
+        members = [clip for clip in clips if not clip[2]]
+        lengths.append(sum(clip.duration_seconds for clip, _, _ in members))
+        files.append([os.path.basename(file) for _, file, _ in members])
+    return lengths, files
+
+
+@pytest.mark.parametrize('packing', ['first_fit', 'balanced'])
+def test_pack_long_audios_layout(tmp_path, packing):
+    seconds = [7, 3, 5, 2, 2, 8, 1, 4, 6, 12]
+    names = _corpus(tmp_path, seconds)
+    sweep = concatenate.AudioClip('sweep.wav', 200, 100, 1, 2)
+    input_files = list(names)
+    random.seed(0)
+
+    plans = concatenate.pack_long_audios(input_files, sweep, 0.0, str(tmp_path), 12, packing=packing)
+
+    assert input_files == []
+    lengths, files = _packed_lengths(plans)
+    # Every file goes to exactly one output
+    assert sorted(name for members in files for name in members) == sorted(names)
+    capacity = 12 - 2
+    if packing == 'first_fit':
+        # Outputs only exceed the capacity with a single file that does not fit
+        assert all(length <= capacity or len(members) == 1 for length, members in zip(lengths, files))
+    else:
+        # As few outputs as the total length allows
+        assert len(plans) == int(np.ceil(sum(seconds) / capacity))
+
+
+def test_pack_long_audios_rejects_outputs_shorter_than_the_sweep(tmp_path):
+    names = _corpus(tmp_path, [1, 2])
+    sweep = concatenate.AudioClip('sweep.wav', 500, 100, 1, 2)
+    for packing in ['first_fit', 'balanced']:
+        with pytest.raises(ValueError):
+            concatenate.pack_long_audios(list(names), sweep, 0.0, str(tmp_path), 5, packing=packing)
+
+
+def test_duration_index_round_trip(tmp_path):
+    names = _corpus(tmp_path, [1, 2.5])
+    index_file = str(tmp_path / 'index.json')
+    index = concatenate.DurationIndex(index_file)
+    clips = [index.clip(str(tmp_path / name)) for name in names]
+    index.save()
+
+    reloaded = concatenate.DurationIndex(index_file)
+    for name, clip in zip(names, clips):
+        cached = reloaded.clip(str(tmp_path / name))
+        assert (cached.frames, cached.sample_rate, cached.channels, cached.sample_width) == (clip.frames, 100, 1, 2)
+    assert [clip.duration_seconds for clip in clips] == [1.0, 2.5]
+    # Entries read from the index are not written again
+    assert not reloaded._dirty
+
+    # A changed file is read again
+    sf.write(str(tmp_path / names[0]), np.zeros(300, dtype=np.int16), 100, subtype='PCM_16')
+    os.utime(str(tmp_path / names[0]), ns=(0, 10 ** 9))
+    assert reloaded.clip(str(tmp_path / names[0])).frames == 300
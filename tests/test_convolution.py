@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from convolution import IRConvolver, choose_method
+
+
+@pytest.mark.parametrize('method', ['auto', 'direct', 'fft', 'oa'])
+@pytest.mark.parametrize('signal_length', [1, 50, 1000, 20000])
+def test_ir_convolver_matches_np_convolve(method, signal_length):
+    rng = np.random.default_rng(0)
+    ir = rng.standard_normal(300)
+    x = rng.standard_normal(signal_length)
+    convolver = IRConvolver(ir, method=method)
+    y = convolver.convolve(x)
+    assert y.shape == (signal_length + ir.shape[0] - 1,)
+    assert np.max(np.abs(y - np.convolve(x, ir))) < 1e-10
+    # The cached spectrum gives the same result for a second file
+    assert np.array_equal(convolver.convolve(x), y)
+
+
+def test_choose_method():
+    assert choose_method(10, 100000) == 'direct'
+    assert choose_method(100000, 10) == 'direct'
+    # Long signals with a short IR are cheaper with overlap-add than with one huge FFT
+    assert choose_method(10 ** 7, 1000) == 'oa'
+
+
+@pytest.mark.parametrize('channels', [None, 3])
+@pytest.mark.parametrize('ir_length, block_size', [(1, 64), (100, 64), (1000, 256), (4096, 1024)])
+def test_partitioned_convolver_matches_np_convolve(channels, ir_length, block_size):
+    rng = np.random.default_rng(1)
+    ir = rng.standard_normal(ir_length)
+    shape = (5000,) if channels is None else (5000, channels)
+    x = rng.standard_normal(shape)
+    partitioned = IRConvolver(ir).partitioned(block_size)
+
+    # The last block is shorter than block_size
+    blocks = [partitioned.process(x[start:start + block_size]) for start in range(0, x.shape[0], block_size)]
+    y = np.concatenate(blocks + list(partitioned.flush()))
+
+    reference = np.convolve(x, ir) if channels is None else np.stack([np.convolve(x[:, c], ir) for c in range(channels)], axis=1)
+    assert y.shape == reference.shape
+    assert np.max(np.abs(y - reference)) < 1e-10
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+from scipy.signal import fftconvolve
+
+import stimulus as stim
+import deconvolve
+
+
+def _sweep(fs=8000, duration=1):
+    testStimulus = stim.stimulus('sinesweep', fs)
+    testStimulus.generate(fs, duration, 0.5, 1, 1, 1, [0, 0])
+    return testStimulus
+
+
+def _recording(testStimulus, starts, length, rng):
+    # Sweeps through a short synthetic room, plus a little noise
+    room = np.zeros(200)
+    room[[0, 40, 130]] = [1.0, 0.5, -0.25]
+    recording = 1e-4 * rng.standard_normal(length)
+    for start in starts:
+        recording[start:start + testStimulus.Lp] += testStimulus.signal[:, 0]
+    return fftconvolve(recording, room)[:length]
+
+
+def test_detect_sweeps_predelay_and_length_longer_than_blocks():
+    testStimulus = _sweep()
+    Lp = int(testStimulus.Lp)
+    rng = np.random.default_rng(0)
+    starts = [3000, 3000 + Lp, 3000 + 2 * Lp + 4000]
+    recording = _recording(testStimulus, starts, starts[-1] + Lp + 6000, rng)
+    reference = fftconvolve(recording, testStimulus.invfilter)
+
+    # RIRs longer than the spacing of the sweeps, predelay longer than the blocks
+    block_size, rir_predelay, rir_length = 1024, 3000, Lp + 4000
+    occurrences = deconvolve.detect_sweeps(recording, testStimulus, rir_length, rir_predelay, block_size=block_size)
+
+    assert [peak for peak, _, _ in occurrences] == [start + testStimulus.linearIRStart for start in starts]
+    for peak, _, rir in occurrences:
+        expected = reference[peak - rir_predelay:peak + rir_length]
+        expected = np.pad(expected, (0, rir_predelay + rir_length - expected.shape[0]))
+        assert np.max(np.abs(rir - expected)) < 1e-9
+
+
+def test_detect_sweeps_threshold_matches_filtering_afterwards():
+    testStimulus = _sweep()
+    Lp = int(testStimulus.Lp)
+    rng = np.random.default_rng(1)
+    # Weak sweeps before and after the strongest one: the first is only dropped once the stronger
+    # ones are found, the last is never extracted
+    starts = [2000, 2000 + Lp + 3000, 2000 + 2 * Lp + 6000, 2000 + 3 * Lp + 9000]
+    gains = [0.1, 1.0, 0.5, 0.2]
+    recording = 1e-4 * rng.standard_normal(starts[-1] + Lp + 6000)
+    for start, gain in zip(starts, gains):
+        recording[start:start + Lp] += gain * testStimulus.signal[:, 0]
+
+    everything = deconvolve.detect_sweeps(recording, testStimulus, 4000, 100, floor=0.05)
+    assert [peak for peak, _, _ in everything] == [start + testStimulus.linearIRStart for start in starts]
+    strongest = max(magnitude for _, magnitude, _ in everything)
+
+    occurrences = deconvolve.detect_sweeps(recording, testStimulus, 4000, 100, floor=0.05, threshold=0.3)
+    expected = [occurrence for occurrence in everything if occurrence[1] >= 0.3 * strongest]
+    assert [peak for peak, _, _ in occurrences] == [peak for peak, _, _ in expected]
+    assert [peak for peak, _, _ in occurrences] == [start + testStimulus.linearIRStart for start in starts[1:3]]
+    for (_, magnitude, rir), (_, expected_magnitude, expected_rir) in zip(occurrences, expected):
+        assert magnitude == expected_magnitude
+        assert np.array_equal(rir, expected_rir)
+
+
+def _reference_tdecay(impulse_response, sample_rate, DBdecay):
+    # The single-channel compute_tdecay of the original implementation
+    max_position = np.argmax(impulse_response)
+    energy = impulse_response[max_position:] ** 2
+    cumulative_energy = np.cumsum(energy[::-1])[::-1]
+    with np.errstate(divide='ignore'):
+        decay_curve = 10 * np.log10(cumulative_energy / np.max(cumulative_energy))
+    t_Tdecay_point = np.where(decay_curve <= -DBdecay)[0]
+    if len(t_Tdecay_point) == 0:
+        return None
+    index_Tdecay = t_Tdecay_point[0]
+    if index_Tdecay > 0:
+        y1, y2 = decay_curve[index_Tdecay - 1], decay_curve[index_Tdecay]
+        t_Tdecay = index_Tdecay - 1 + (y1 + DBdecay) / (y1 - y2)
+    else:
+        t_Tdecay = index_Tdecay
+    TTdecay = t_Tdecay / sample_rate
+    TTdecay_sample = int(TTdecay * sample_rate)
+    return TTdecay, impulse_response[max_position - TTdecay_sample:max_position + TTdecay_sample]
+
+
+def test_decay_analysis_matches_reference_compute_tdecay():
+    fs = 8000
+    rng = np.random.default_rng(2)
+    t = np.arange(fs) / fs
+    # Three channels with different reverberation times and onsets
+    impulse_response = np.zeros((fs + 6000, 3))
+    for channel, (rt60, onset) in enumerate([(0.2, 4000), (0.4, 5000), (0.6, 6000)]):
+        impulse_response[onset:onset + fs, channel] = rng.standard_normal(fs) * np.exp(-6.9 * t / rt60)
+        impulse_response[onset, channel] = 5.0
+
+    analysis = deconvolve.decay_analysis(impulse_response, fs, [20, 30, 60])
+    for channel in range(3):
+        for T in [20, 30, 60]:
+            reference = _reference_tdecay(impulse_response[:, channel], fs, T)
+            assert analysis.times[T][channel] == pytest.approx(reference[0], rel=1e-12)
+        assert analysis.edt[channel] == pytest.approx(6 * _reference_tdecay(impulse_response[:, channel], fs, 10)[0], rel=1e-12)
+
+    # compute_tdecay keeps its interface for single-channel RIRs
+    mono = impulse_response[:, 1:2]
+    TTdecay, _, trimmed, _ = deconvolve.compute_tdecay(mono, fs, 30)
+    reference = _reference_tdecay(mono[:, 0], fs, 30)
+    assert TTdecay == pytest.approx(reference[0], rel=1e-12)
+    assert np.array_equal(trimmed[:, 0], reference[1])
+    # A decay that is never reached
+    flat = np.ones((100, 1))
+    flat[0] = 2.0
+    assert _reference_tdecay(flat[:, 0], fs, 60) is None
+    assert deconvolve.compute_tdecay(flat, fs, 60) is None
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+from scipy.signal import fftconvolve
+
+import stimulus as stim
+
+
+def _sweep(fs=8000, duration=2):
+    testStimulus = stim.stimulus('sinesweep', fs)
+    testStimulus.generate(fs, duration, 0.5, 1, 1, 1, [0, 0])
+    return testStimulus
+
+
+def test_deconvolve_float32_recording_in_double_precision():
+    testStimulus = _sweep()
+    rng = np.random.default_rng(0)
+    recorded = (testStimulus.signal + 1e-3 * rng.standard_normal((testStimulus.signal.shape[0], 2))).astype(np.float32)
+    reference = np.stack([fftconvolve(recorded[:, idx].astype(np.float64), testStimulus.invfilter) for idx in range(2)], axis=1)
+
+    RIRs = testStimulus.deconvolve(recorded)
+    assert RIRs.dtype == np.float64
+    assert np.max(np.abs(RIRs - reference[:RIRs.shape[0]])) < 1e-12
+
+    RIRs32 = testStimulus.deconvolve(recorded, dtype=np.float32)
+    assert RIRs32.dtype == np.float32
+    assert np.max(np.abs(RIRs32 - reference[:RIRs32.shape[0]])) < 1e-4
+
+
+def test_disk_cache_round_trip(tmp_path):
+    stim.clearCache()
+    generated = _sweep()
+    stim.clearCache()
+    testStimulus = stim.stimulus('sinesweep', 8000)
+    testStimulus.generate(8000, 2, 0.5, 1, 1, 1, [0, 0], cachedir=str(tmp_path))
+    stim.clearCache()
+    cached = stim.stimulus('sinesweep', 8000)
+    cached.generate(8000, 2, 0.5, 1, 1, 1, [0, 0], cachedir=str(tmp_path))
+
+    # Only the two complete files are left, no temporary files
+    assert sorted(name.rsplit('_', 1)[1] for name in os.listdir(tmp_path)) == ['invfilter.npy', 'signal.npy']
+    assert np.array_equal(cached.signal, generated.signal)
+    assert np.array_equal(cached.invfilter, generated.invfilter)
+
+
+@pytest.mark.parametrize('window', [None, 'rir'])
+@pytest.mark.parametrize('blocksize', [256, 2048])
+def test_online_deconvolver_matches_deconvolve(window, blocksize):
+    testStimulus = _sweep()
+    if window == 'rir':
+        window = testStimulus.irWindow(8000, predelay=4000)
+    rng = np.random.default_rng(1)
+    # A longer recording than the stimulus, fed in blocks of varying length
+    recorded = np.concatenate((testStimulus.signal, np.zeros((500, 1))))
+    recorded = recorded + 1e-3 * rng.standard_normal((recorded.shape[0], 2))
+    online = stim.OnlineDeconvolver(testStimulus, window=window, blocksize=blocksize)
+    start = 0
+    while start < recorded.shape[0]:
+        length = int(rng.integers(1, 3000))
+        online.process(recorded[start:start + length])
+        start += length
+
+    reference = testStimulus.deconvolve(recorded, window=window)
+    RIRs = online.result()
+    assert online.ready()
+    assert RIRs.shape == reference.shape
+    assert np.max(np.abs(RIRs - reference)) < 1e-12
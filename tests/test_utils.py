@@ -0,0 +1,106 @@
+import functools
+import os
+
+import numpy as np
+
+import utils
+
+
+def test_record_stream_loopback(tmp_path):
+    fs, blocksize = 8000, 256
+    rng = np.random.default_rng(0)
+    testsignal = 0.1 * rng.standard_normal(fs)
+    # A pure delay of 5 samples, on top of the one block latency of the loopback
+    ir = np.zeros(8)
+    ir[5] = 1.0
+    spillfile = str(tmp_path / 'capture.wav')
+
+    recorded, metrics = utils.record_stream(testsignal, fs, [1, 2], [1], blocksize=blocksize, spillfile=spillfile,
+                                            streamFactory=functools.partial(utils.LoopbackStream, ir, speed=10))
+
+    assert recorded.shape == (fs, 2)
+    assert metrics['frames'] == fs
+    for key in ['input_overflows', 'output_underflows', 'output_underruns', 'dropped_frames']:
+        assert metrics[key] == 0
+    delay = blocksize + 5
+    expected = testsignal[:fs - delay].astype(np.float32)
+    for channel in range(2):
+        assert np.allclose(recorded[:delay, channel], 0, atol=1e-6)
+        assert np.allclose(recorded[delay:, channel], expected, atol=1e-6)
+
+    # The spill file goes once the writes submitted before are done
+    del recorded
+    utils.removeAfterWrites(spillfile)
+    utils.waitForWrites()
+    assert not os.path.exists(spillfile)
+
+
+def _save(fs=1000):
+    RIR = np.zeros((100, 1))
+    recorded = np.zeros((fs, 1), dtype=np.float32)
+    utils.saverecording(RIR, RIR, np.zeros(fs), recorded, fs)
+    utils.waitForWrites()
+
+
+def test_last_recording_replaces_an_old_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # recorded/lastRecording as written by older versions: a copy of a recording
+    os.makedirs('recorded/lastRecording')
+    _save()
+    _save()
+
+    assert utils.lastRecording() == os.path.join('recorded', 'newrir2')
+    assert os.path.isdir('recorded/lastRecording.old')
+    assert os.path.realpath('recorded/lastRecording') == os.path.realpath('recorded/newrir2')
+
+
+def test_last_recording_without_symbolic_links(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def no_symlink(*args):
+        raise OSError('symbolic links need privileges')
+    monkeypatch.setattr(os, 'symlink', no_symlink)
+    _save()
+
+    assert utils.lastRecording() == os.path.join('recorded', 'newrir1')
+    assert os.path.exists(os.path.join(utils.lastRecording(), 'sigrec1.wav'))
+    assert not os.path.lexists('recorded/lastRecording')
+
+
+def test_result_store_round_trip(tmp_path):
+    path = str(tmp_path / 'results.zip')
+    store = utils.ResultStore(path)
+    rng = np.random.default_rng(1)
+    first = {'RIR': rng.standard_normal((100, 2)), 'sigrec': rng.standard_normal((1000, 2)).astype(np.float32)}
+    second = {'RIR': rng.standard_normal((50, 1))}
+    assert store.save(first, {'fs': 1000}) == 'measurement1'
+    assert store.save(second, {'fs': 2000}) == 'measurement2'
+
+    arrays, meta = store.load('measurement1')
+    assert meta == {'fs': 1000}
+    assert sorted(arrays) == ['RIR', 'sigrec']
+    for key in first:
+        assert arrays[key].dtype == first[key].dtype
+        assert np.array_equal(arrays[key], first[key])
+    arrays, meta = store.load()
+    assert meta == {'fs': 2000}
+    assert np.array_equal(arrays['RIR'], second['RIR'])
+
+    # A store opened again continues the numbering
+    reopened = utils.ResultStore(path)
+    assert reopened.measurements() == ['measurement1', 'measurement2']
+    assert reopened.save(second, {'fs': 3000}) == 'measurement3'
+    assert reopened.load()[1] == {'fs': 3000}
+
+
+def test_spill_files_are_unique_and_removed(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    spillfiles = [utils.newSpillFile() for _ in range(3)]
+    assert len(set(spillfiles)) == 3
+    assert all(os.path.dirname(os.path.realpath(spillfile)) == os.path.realpath('recorded') and os.path.exists(spillfile)
+               for spillfile in spillfiles)
+
+    for spillfile in spillfiles:
+        utils.removeAfterWrites(spillfile)
+    utils.waitForWrites()
+    assert os.listdir('recorded') == []
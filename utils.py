@@ -1,12 +1,28 @@
 import os
+import time
+import json
+import atexit
+import zipfile
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from scipy.io.wavfile import write as wavwrite
 import numpy as np
-import sounddevice as sd
+import soundfile as sf
+
+import audio_io
+import instrument
+from convolution import PartitionedConvolver
 
 
 #--------------------------
+@instrument.traced('record')
 def record(testsignal,fs,inputChannels,outputChannels):
 
+    # Imported here, so that the rest of the module works without PortAudio
+    import sounddevice as sd
     sd.default.samplerate = fs
     sd.default.dtype = 'float32'
     print("Input channels:",  inputChannels)
@@ -20,18 +36,350 @@ def record(testsignal,fs,inputChannels,outputChannels):
 
 
 #--------------------------
-def saverecording(RIR, RIRtoSave, testsignal, recorded, fs):
-
-        dirflag = False
-        counter = 1
-        dirname = 'recorded/newrir1'
-        while dirflag == False:
-            if os.path.exists(dirname):
-                counter = counter + 1
-                dirname = 'recorded/newrir' + str(counter)
-            else:
-                os.mkdir(dirname)
-                dirflag = True
+# Single-producer, single-consumer ring buffer of audio frames. The producer only moves the write
+# position and the consumer only the read position, so the audio callback never waits for a lock.
+class RingBuffer:
+
+    def __init__(self, frames, channels, dtype = 'float32'):
+
+        self._data = np.zeros((frames, channels), dtype = dtype)
+        self._size = frames
+        # Total number of frames written and read so far
+        self._written = 0
+        self._read = 0
+
+    def available(self):
+
+        return self._written - self._read
+
+    def space(self):
+
+        return self._size - self.available()
+
+    # Copies as many frames of data as fit and returns their number
+    def write(self, data):
+
+        n = min(data.shape[0], self.space())
+        pos = self._written % self._size
+        first = min(n, self._size - pos)
+        self._data[pos:pos+first] = data[:first]
+        self._data[:n-first] = data[first:n]
+        # Publish the frames only once they are copied
+        self._written += n
+        return n
+
+    # Reads up to out.shape[0] frames into out, without allocating, and returns their number
+    def readinto(self, out):
+
+        n = min(out.shape[0], self.available())
+        pos = self._read % self._size
+        first = min(n, self._size - pos)
+        out[:first] = self._data[pos:pos+first]
+        out[first:n] = self._data[:n-first]
+        self._read += n
+        return n
+
+    # Reads all available frames into a new array
+    def read(self):
+
+        out = np.empty((self.available(), self._data.shape[1]), dtype = self._data.dtype)
+        self.readinto(out)
+        return out
+
+
+#--------------------------
+# Play the test signal and record the input channels with a callback stream, in blocks.
+# The stimulus goes to the callback through one ring buffer and the captured blocks come back
+# through another, so memory does not grow with the length of the session:
+# - spillfile: the captured blocks are written to this float32 WAV file as they arrive and the
+#   recording is returned memory-mapped from it. Without it, the recording is kept in memory.
+# - consumer: called with each captured block (frames, channels), e.g. to deconvolve online. It
+#   runs on its own thread, so a slow consumer never delays the ring buffers, and the function
+#   returns once it has processed every block.
+# - streamFactory: creates the stream, with the arguments of sounddevice.Stream. LoopbackStream
+#   (with an IR, e.g. functools.partial(LoopbackStream, ir)) measures without an audio interface.
+# Returns the recording (frames, channels) and a dict of xrun metrics: PortAudio input overflows
+# and output underflows, and the blocks where the ring buffers could not keep up (output blocks
+# padded with silence, captured frames dropped).
+@instrument.traced('record')
+def record_stream(testsignal, fs, inputChannels, outputChannels, blocksize = 2048, spillfile = None,
+                  consumer = None, bufferBlocks = 16, streamFactory = None):
+
+    testsignal = np.asarray(testsignal, dtype = np.float32).reshape((testsignal.shape[0], -1))
+    total = testsignal.shape[0]
+    # Channel maps are 1-based, as in sd.playrec
+    inputIdx = [ch - 1 for ch in inputChannels]
+    outputIdx = [ch - 1 for ch in outputChannels]
+    print("Input channels:",  inputChannels)
+    print("Output channels:", outputChannels)
+
+    outRing = RingBuffer(bufferBlocks*blocksize, testsignal.shape[1])
+    inRing = RingBuffer(bufferBlocks*blocksize, len(inputIdx))
+    metrics = {'input_overflows': 0, 'output_underflows': 0, 'output_underruns': 0, 'dropped_frames': 0}
+    progress = {'played': 0, 'received': 0}
+
+    playBuffer = np.zeros((blocksize, testsignal.shape[1]), dtype = np.float32)
+
+    def callback(indata, outdata, frames, timeinfo, status):
+        if status.input_overflow:
+            metrics['input_overflows'] += 1
+        if status.output_underflow:
+            metrics['output_underflows'] += 1
+
+        block = playBuffer[:frames]
+        n = outRing.readinto(block)
+        block[n:] = 0
+        if n < frames and progress['played'] + n < total:
+            metrics['output_underruns'] += 1
+        progress['played'] += n
+        # A mono test signal goes to every output channel
+        outdata.fill(0)
+        outdata[:, outputIdx] = block
+
+        # Capture exactly as many frames as were played, as sd.playrec does
+        n = min(frames, total - progress['received'])
+        written = inRing.write(indata[:n, inputIdx])
+        metrics['dropped_frames'] += n - written
+        progress['received'] += n
+
+    if streamFactory is None:
+        import sounddevice as sd
+        streamFactory = sd.Stream
+    stream = streamFactory(samplerate = fs, blocksize = blocksize, channels = (max(inputChannels), max(outputChannels)),
+                           dtype = 'float32', callback = callback)
+
+    spill = sf.SoundFile(spillfile, 'w', samplerate = fs, channels = len(inputIdx), subtype = 'FLOAT') if spillfile else None
+    consumerThread = ThreadPoolExecutor(max_workers = 1) if consumer is not None else None
+    consumed = deque()
+    blocks = []
+    fed = outRing.write(testsignal)
+    captured = 0
+    try:
+        with stream:
+            while captured + metrics['dropped_frames'] < total:
+                if fed < total:
+                    fed += outRing.write(testsignal[fed:])
+                block = inRing.read()
+                if block.shape[0] == 0:
+                    if not stream.active:
+                        break
+                    time.sleep(blocksize/fs/4)
+                    continue
+                captured += block.shape[0]
+                if spill is not None:
+                    spill.write(block)
+                else:
+                    blocks.append(block)
+                if consumer is not None:
+                    consumed.append(consumerThread.submit(consumer, block))
+                    # Drop the finished blocks, raising the consumer errors
+                    while consumed and consumed[0].done():
+                        consumed.popleft().result()
+    finally:
+        if spill is not None:
+            spill.close()
+        if consumerThread is not None:
+            consumerThread.shutdown(wait = True)
+    while consumed:
+        consumed.popleft().result()
+
+    metrics['frames'] = captured
+    if spill is not None:
+        recorded = audio_io.wav_memmap(spillfile)[0]
+    else:
+        recorded = np.concatenate(blocks) if blocks else np.zeros((0, len(inputIdx)), dtype = np.float32)
+    return recorded, metrics
+
+
+#--------------------------
+# Stand-in for sounddevice.Stream without an audio interface: every input channel records the
+# sum of the output channels convolved with a known IR. Like a real interface, the input lags
+# the output by one block. speed > 1 runs faster than real time.
+class LoopbackStream:
+
+    def __init__(self, ir, samplerate, blocksize, channels, dtype, callback, speed = 1.0):
+
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.channels = channels
+        self.dtype = dtype
+        self.callback = callback
+        self.speed = speed
+        self._convolver = PartitionedConvolver(np.asarray(ir, dtype = np.float64), blocksize)
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def active(self):
+
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def stop(self):
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self):
+
+        self.stop()
+
+    def __enter__(self):
+
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def _run(self):
+
+        numInputs, numOutputs = self.channels
+        indata = np.zeros((self.blocksize, numInputs), dtype = self.dtype)
+        outdata = np.zeros((self.blocksize, numOutputs), dtype = self.dtype)
+        status = SimpleNamespace(input_overflow = False, output_underflow = False)
+        period = self.blocksize/self.samplerate/self.speed
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            indata[:] = self._convolver.process(outdata.sum(axis = 1))[:, np.newaxis]
+            self.callback(indata, outdata, self.blocksize, None, status)
+            deadline += period
+            time.sleep(max(deadline - time.monotonic(), 0))
+
+
+#--------------------------
+# Recordings are saved by one background thread, in the order they are submitted, so the
+# measurement thread does not wait for the disk: a process running several measurements starts
+# the next one while the previous one is saved. A script still waits for the writes at exit.
+_writer = None
+_pending = []
+
+def _submit(fn, *args):
+
+    global _writer
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers = 1)
+        atexit.register(waitForWrites)
+    _pending.append(_writer.submit(fn, *args))
+
+
+# A new spill file for record_stream in recorded/, unique per measurement: the recording returned
+# is a memory map of it, which the background writer may still be reading when the next
+# measurement starts. Remove it with removeAfterWrites once the recording is saved.
+def newSpillFile():
+
+    os.makedirs('recorded', exist_ok = True)
+    fd, spillfile = tempfile.mkstemp(prefix = 'capture_', suffix = '.wav', dir = 'recorded')
+    os.close(fd)
+    return spillfile
+
+
+# Remove a file once everything submitted so far is saved, e.g. the spill file of record_stream
+# when its memory map was handed to saverecording
+def removeAfterWrites(path):
+
+    _submit(_remove, path)
+
+
+def _remove(path):
+
+    try:
+        os.remove(path)
+    except OSError as e:
+        print('Warning: could not remove ' + path + ': ' + str(e))
+
+
+# Block until everything submitted so far is saved, raising the first error
+def waitForWrites():
+
+    while _pending:
+        _pending.pop(0).result()
+
+
+#--------------------------
+# One compressed container per session: a zip file with a group per measurement
+# (measurement1/RIR.npy, measurement1/sigrec.npy, ..., measurement1/meta.json), readable with
+# np.load like an .npz file. Measurements are appended by the background writer.
+class ResultStore:
+
+    def __init__(self, path):
+
+        self.path = path
+        self._count = len(self.measurements())
+
+    def measurements(self):
+
+        if not os.path.exists(self.path):
+            return []
+        with zipfile.ZipFile(self.path) as zf:
+            names = {name.split('/')[0] for name in zf.namelist() if name.endswith('/meta.json')}
+        return sorted(names, key = lambda name: int(name[len('measurement'):]))
+
+    # Queue a measurement: arrays is a dict of named arrays, meta a JSON serializable dict.
+    # Returns the name of the measurement group.
+    def save(self, arrays, meta):
+
+        self._count += 1
+        name = 'measurement' + str(self._count)
+        _submit(self._write, name, arrays, meta)
+        return name
+
+    @instrument.traced('write')
+    def _write(self, name, arrays, meta):
+
+        # Fast compression: the signals are mostly noise, the gain of higher levels is small
+        with zipfile.ZipFile(self.path, 'a', compression = zipfile.ZIP_DEFLATED, compresslevel = 1) as zf:
+            for key, array in arrays.items():
+                with zf.open(name + '/' + key + '.npy', 'w', force_zip64 = True) as f:
+                    np.lib.format.write_array(f, np.asarray(array))
+            zf.writestr(name + '/meta.json', json.dumps(meta))
+
+    # Arrays and metadata of a measurement, the last one by default
+    def load(self, name = None):
+
+        waitForWrites()
+        name = name or self.measurements()[-1]
+        with zipfile.ZipFile(self.path) as zf:
+            meta = json.loads(zf.read(name + '/meta.json'))
+            arrays = {}
+            for entry in zf.namelist():
+                if entry.startswith(name + '/') and entry.endswith('.npy'):
+                    with zf.open(entry) as f:
+                        arrays[entry[len(name) + 1:-4]] = np.lib.format.read_array(f)
+        return arrays, meta
+
+
+#--------------------------
+def saverecording(RIR, RIRtoSave, testsignal, recorded, fs, store = None):
+
+        if store is not None:
+            name = store.save({'RIR': RIR, 'RIRac': RIRtoSave, 'sigtest': testsignal, 'sigrec': recorded},
+                              {'fs': fs, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')})
+            print('Success! Recording saved in ' + store.path + ' as ' + name)
+            return
+
+        # Next directory number, from a single listing of the recordings
+        os.makedirs('recorded', exist_ok = True)
+        numbers = [int(entry[len('newrir'):]) for entry in os.listdir('recorded')
+                   if entry.startswith('newrir') and entry[len('newrir'):].isdigit()]
+        dirname = 'recorded/newrir' + str(max(numbers, default = 0) + 1)
+        os.mkdir(dirname)
+
+        _submit(_writeRecording, dirname, RIR, RIRtoSave, testsignal, recorded, fs)
+        _linkLastRecording(dirname)
+
+        print('Success! Recording saved in directory ' + dirname)
+
+
+@instrument.traced('write')
+def _writeRecording(dirname, RIR, RIRtoSave, testsignal, recorded, fs):
 
         # Saving the RIRs and the captured signals
         np.save(dirname+ '/RIR.npy',RIR)
@@ -42,13 +390,50 @@ def saverecording(RIR, RIRtoSave, testsignal, recorded, fs):
             wavwrite(dirname+ '/sigrec' + str(idx+1) + '.wav',fs,recorded[:,idx])
             wavwrite(dirname+ '/RIR' + str(idx+1) + '.wav',fs,RIR[:,idx])
 
-        # Save in the recorded/lastRecording for a quick check
-        np.save('recorded/lastRecording/RIR.npy',RIR)
-        np.save( 'recorded/lastRecording/RIRac.npy',RIRtoSave)
-        wavwrite( 'recorded/lastRecording/sigtest.wav',fs,testsignal)
-        for idx in range(recorded.shape[1]):
-            wavwrite('sigrec' + str(idx+1) + '.wav',fs,recorded[:,idx])
-            wavwrite(dirname+ '/RIR' + str(idx+1) + '.wav',fs,RIR[:,idx])
 
+# The last recording directory, for a quick check (checkLastRec.py), is named in
+# recorded/lastRecording.txt. recorded/lastRecording is also linked to it where symbolic links
+# are allowed (on Windows they need privileges).
+LAST_RECORDING_POINTER = 'recorded/lastRecording.txt'
+LAST_RECORDING_LINK = 'recorded/lastRecording'
 
-        print('Success! Recording saved in directory ' + dirname)
+def _linkLastRecording(dirname):
+
+        # Write the pointer to a temporary file first, so that it is never half written
+        tmpPointer = LAST_RECORDING_POINTER + '.tmp'
+        with open(tmpPointer, 'w') as f:
+            f.write(os.path.basename(dirname))
+        os.replace(tmpPointer, LAST_RECORDING_POINTER)
+
+        link = LAST_RECORDING_LINK
+        if os.path.isdir(link) and not os.path.islink(link):
+            # A copy of a recording written by an older version: moved away, so it is not mistaken
+            # for the last recording
+            old = link + '.old'
+            count = 1
+            while os.path.lexists(old):
+                count += 1
+                old = link + '.old' + str(count)
+            os.replace(link, old)
+            print('Moved the old ' + link + ' directory to ' + old)
+        tmplink = link + '.tmp'
+        try:
+            if os.path.lexists(tmplink):
+                os.remove(tmplink)
+            os.symlink(os.path.basename(dirname), tmplink)
+            os.replace(tmplink, link)
+        except OSError:
+            # No symbolic links: only the pointer file names the last recording
+            if os.path.islink(link):
+                os.remove(link)
+
+
+# Directory of the last recording saved by saverecording, None if there is none
+def lastRecording():
+
+        if os.path.exists(LAST_RECORDING_POINTER):
+            with open(LAST_RECORDING_POINTER, 'r') as f:
+                return os.path.join('recorded', f.read().strip())
+        if os.path.islink(LAST_RECORDING_LINK):
+            return os.path.join('recorded', os.readlink(LAST_RECORDING_LINK))
+        return None